@@ -0,0 +1,525 @@
+"""
+QFlow 离线压测：真实的 Scheduler / QbitClient 对着进程内模拟的 qBittorrent WebUI 跑，
+rclone 换成 PATH 上的桩程序 (按 延迟 + 大小/速度 睡眠后删除源文件)，磁盘容量也是模拟的。
+不需要真实的种子、网盘和大硬盘，版本之间跑同一组参数就能对比调度开销和吞吐。
+
+    python3 bench.py --torrents 2000 --files 20 --duration 300 --json result.json
+
+输出：每轮调度耗时 (p50/p95/max + 各阶段均值)、每轮 qBit API 调用数、数据库耗时、
+磁盘预算利用率、完成文件数/小时。
+"""
+import argparse
+import bisect
+import collections
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+MB = 1024**2
+GB = 1024**3
+PIECE_SIZE = 4 * MB
+DiskUsage = collections.namedtuple('usage', 'total used free') # 和 shutil.disk_usage 的返回值同形
+
+# rclone 桩：move / rcat / lsjson / about / rcd，上传耗时 = BENCH_UL_LATENCY + 大小 / BENCH_UL_MBPS
+RCLONE_STUB = r'''
+import sys, os, json, time, threading
+args = [a for a in sys.argv[1:] if not a.startswith('--')]
+flags = dict(a[2:].split('=', 1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+latency = float(os.environ.get('BENCH_UL_LATENCY', '0.5'))
+rate = float(os.environ.get('BENCH_UL_MBPS', '100')) * 1024**2
+fail = float(os.environ.get('BENCH_UL_FAIL', '0'))
+cmd = args[0] if args else ''
+
+def transfer(size, report):
+    """按模型睡完一次上传，期间每秒报告一次进度。返回是否成功"""
+    total = latency + size / rate
+    start = time.time()
+    while True:
+        spent = time.time() - start
+        if spent >= total: break
+        report(int(min(size, max(0, spent - latency) * rate)), rate, total - spent)
+        time.sleep(min(1.0, total - spent))
+    return int.from_bytes(os.urandom(2), 'big') / 65536 >= fail
+
+def stats_line(sent, speed, eta):
+    sys.stderr.write(json.dumps({'level': 'notice', 'msg': 'stats', 'stats': {'bytes': sent, 'speed': speed, 'eta': eta}}) + '\n')
+    sys.stderr.flush()
+
+if cmd == 'move':
+    src = args[1]
+    size = os.path.getsize(src) if os.path.exists(src) else 0
+    if not transfer(size, stats_line):
+        sys.stderr.write(json.dumps({'level': 'error', 'msg': 'bench: injected failure'}) + '\n')
+        sys.exit(1)
+    if os.path.exists(src): os.remove(src)
+    sys.exit(0)
+if cmd == 'rcat':
+    n = 0
+    while True:
+        b = sys.stdin.buffer.read(1 << 20)
+        if not b: break
+        n += len(b)
+    transfer(0, stats_line)
+    stats_line(n, rate, 0)
+    sys.exit(0)
+if cmd == 'lsjson':
+    print('[]'); sys.exit(0)
+if cmd == 'about':
+    print(json.dumps({'total': 10**15, 'used': 0, 'free': 10**15})); sys.exit(0)
+if cmd == 'rcd':
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    host, port = flags.get('rc-addr', '127.0.0.1:5572').rsplit(':', 1)
+    jobs, lock, seq = {}, threading.Lock(), [0]
+    def work(jid, p):
+        src = os.path.join(p['srcFs'], p['srcRemote'])
+        size = os.path.getsize(src) if os.path.exists(src) else 0
+        job = jobs[jid]
+        def report(sent, speed, eta): job['stats'] = {'bytes': sent, 'speed': speed, 'eta': eta}
+        ok = os.path.exists(src) and transfer(size, report)
+        if ok: os.remove(src)
+        job.update(finished=True, success=ok, error='' if ok else 'bench: injected failure')
+    class H(BaseHTTPRequestHandler):
+        def log_message(self, *a): pass
+        def do_POST(self):
+            n = int(self.headers.get('Content-Length') or 0)
+            p = json.loads(self.rfile.read(n) or b'{}')
+            path = self.path.strip('/')
+            out = {}
+            if path == 'operations/movefile':
+                with lock:
+                    seq[0] += 1; jid = seq[0]
+                jobs[jid] = {'id': jid, 'finished': False, 'success': False, 'stats': {}}
+                threading.Thread(target=work, args=(jid, p), daemon=True).start()
+                out = {'jobid': jid}
+            elif path == 'job/status':
+                job = jobs.get(p.get('jobid'), {'finished': True, 'success': False, 'error': 'job not found'})
+                out = {k: v for k, v in job.items() if k != 'stats'}
+                if job.get('finished'): jobs.pop(p.get('jobid'), None)
+            elif path == 'core/stats':
+                jid = int(str(p.get('group', '')).rpartition('/')[2] or 0)
+                out = jobs.get(jid, {}).get('stats', {})
+            body = json.dumps(out).encode()
+            self.send_response(200); self.send_header('Content-Length', str(len(body))); self.end_headers(); self.wfile.write(body)
+    ThreadingHTTPServer((host, int(port)), H).serve_forever()
+'''
+
+# ==============================================================================
+# 🧪 模拟的 qBittorrent
+# ==============================================================================
+class SimFile:
+    __slots__ = ('index', 'name', 'size', 'offset', 'done', 'priority', 'availability', 'cap', 'on_disk')
+
+    def __init__(self, index, name, size, offset, availability, cap):
+        self.index, self.name, self.size, self.offset = index, name, size, offset
+        self.done = 0             # 已下载字节
+        self.priority = 1
+        self.availability = availability
+        self.cap = cap            # 能下到的最大字节数 (死种下不完)
+        self.on_disk = False      # 下完后在本地落了一个 (稀疏) 文件
+
+    def info(self):
+        first = self.offset // PIECE_SIZE
+        last = max(first, (self.offset + self.size - 1) // PIECE_SIZE)
+        return {'index': self.index, 'name': self.name, 'size': self.size, 'progress': self.done / self.size if self.size else 1.0,
+                'priority': self.priority, 'availability': self.availability, 'piece_range': [first, last]}
+
+class SimTorrent:
+    def __init__(self, name, files, speed):
+        self.hash = hashlib.sha1(name.encode()).hexdigest()
+        self.name = name
+        self.files = files
+        self.offsets = [f.offset for f in files]
+        self.total_size = sum(f.size for f in files)
+        self.speed = speed        # 这个种子的下载能力 (B/s)
+        self.state = 'pausedDL'
+        self.seq_dl = False
+        self.dlspeed = 0
+        self.seq = 0              # 最后一次变化的同步序号
+
+    def info(self):
+        done = sum(f.done for f in self.files)
+        return {'name': self.name, 'state': self.state, 'total_size': self.total_size, 'size': self.total_size,
+                'progress': done / self.total_size if self.total_size else 1.0, 'seq_dl': self.seq_dl, 'dlspeed': self.dlspeed}
+
+    def piece_states(self):
+        """piece 覆盖的每个文件都下到了这个 piece 的末尾才算完成 (文件内按顺序下载)"""
+        n = (self.total_size + PIECE_SIZE - 1) // PIECE_SIZE
+        states = []
+        for p in range(n):
+            start, end = p * PIECE_SIZE, min(self.total_size, (p + 1) * PIECE_SIZE)
+            i = bisect.bisect_right(self.offsets, start) - 1
+            ok = True
+            while i < len(self.files) and self.files[i].offset < end:
+                f = self.files[i]
+                if f.offset + f.done < min(end, f.offset + f.size):
+                    ok = False
+                    break
+                i += 1
+            states.append(2 if ok else 0)
+        return states
+
+class SimQbit:
+    """按时间推进下载进度；文件下完时在下载目录落一个同大小的稀疏文件，供 rclone 桩搬走"""
+    def __init__(self, args, download_dir):
+        self.lock = threading.Lock()
+        self.download_dir = download_dir
+        self.capacity = int(args.disk_gb * GB)
+        self.link = args.link_mbps * MB
+        self.limit = 0            # qBit 全局下载限速 (背压设置)，0=不限
+        self.seq = 0
+        self.removed = []         # [(序号, hash)]
+        self.calls = collections.Counter()
+        self.torrents = {}
+        self.completed = {}       # 下完且还在本地的文件 { 路径: 大小 }
+        self.partial = 0          # 还没下完的文件已下载的字节
+        self.downloaded = 0
+        rng = random.Random(args.seed)
+        mu = math.log(args.file_mb * MB)
+        for i in range(args.torrents):
+            name = f"bench-{i:05d}"
+            stalled = rng.random() < args.stall_frac
+            files, offset = [], 0
+            for j in range(args.files):
+                size = max(1024, int(rng.lognormvariate(mu, args.size_sigma)))
+                if stalled:
+                    avail = rng.uniform(0.2, 0.95)
+                    cap = int(size * rng.uniform(0, avail))
+                else:
+                    avail, cap = rng.uniform(1.0, 20.0), size
+                files.append(SimFile(j, f"{name}/d{j // 50}/f{j:04d}.bin", size, offset, round(avail, 3), cap))
+                offset += size
+            speed = rng.lognormvariate(math.log(args.dl_mbps * MB), 0.7)
+            t = SimTorrent(name, files, speed)
+            self.torrents[t.hash] = t
+            self.touch(t)
+
+    def touch(self, t):
+        self.seq += 1
+        t.seq = self.seq
+
+    def step(self, dt):
+        """推进 dt 秒：各种子按自身速度均分给在下的文件，总量受链路带宽和全局限速约束"""
+        with self.lock:
+            active = []
+            for t in self.torrents.values():
+                if t.state.startswith(('paused', 'stopped')): continue
+                files = [f for f in t.files if f.priority > 0 and f.done < f.cap]
+                if files: active.append((t, files))
+                elif t.dlspeed:
+                    t.dlspeed = 0
+                    t.state = 'stalledDL'
+                    self.touch(t)
+            want = sum(t.speed for t, _ in active)
+            link = min(self.link, self.limit) if self.limit else self.link
+            scale = min(1.0, link / want) if want else 0
+            for t, files in active:
+                share = t.speed * scale * dt / len(files)
+                for f in files:
+                    got = min(f.cap - f.done, int(share))
+                    f.done += got
+                    self.partial += got
+                    self.downloaded += got
+                    if f.done >= f.size:
+                        self.materialize(f)
+                t.dlspeed = int(t.speed * scale)
+                t.state = 'downloading'
+                self.touch(t)
+
+    def materialize(self, f):
+        path = os.path.join(self.download_dir, f.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as fp:
+            fp.truncate(f.size)
+        f.on_disk = True
+        self.partial -= f.done
+        self.completed[path] = f.size
+
+    def disk_usage(self):
+        """模拟磁盘：下载中文件的已下载字节 + 已下完但还没被搬走的文件"""
+        with self.lock:
+            for path in [p for p in self.completed if not os.path.exists(p)]:
+                del self.completed[path]
+            used = self.partial + sum(self.completed.values())
+        return DiskUsage(self.capacity, used, max(0, self.capacity - used))
+
+    def set_priority(self, t, ids, prio):
+        for i in ids:
+            f = t.files[i]
+            if prio == 0 and not f.on_disk and f.done < f.size:
+                self.partial -= f.done # 不下了：调度器会删掉残留数据
+                f.done = 0
+            f.priority = prio
+        self.touch(t)
+
+    def maindata(self, rid):
+        if rid == 0 or (self.removed and rid < self.removed[0][0]):
+            out = {'full_update': True, 'torrents': {h: t.info() for h, t in self.torrents.items()}}
+        else:
+            out = {'torrents': {h: t.info() for h, t in self.torrents.items() if t.seq > rid}}
+            gone = [h for s, h in self.removed if s > rid]
+            if gone: out['torrents_removed'] = gone
+        out['rid'] = self.seq
+        return out
+
+    def delete(self, h):
+        t = self.torrents.pop(h, None)
+        if t:
+            self.partial -= sum(f.done for f in t.files if not f.on_disk)
+            self.seq += 1
+            self.removed.append((self.seq, h))
+
+class WebUI(BaseHTTPRequestHandler):
+    """QFlow 用到的 /api/v2 接口"""
+    sim = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args): pass
+
+    def reply(self, obj=b'', code=200):
+        body = obj if isinstance(obj, bytes) else json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self): self.dispatch()
+    def do_POST(self): self.dispatch()
+
+    def dispatch(self):
+        url = urllib.parse.urlparse(self.path)
+        p = dict(urllib.parse.parse_qsl(url.query))
+        n = int(self.headers.get('Content-Length') or 0)
+        if n: p.update(urllib.parse.parse_qsl(self.rfile.read(n).decode()))
+        sim, path = self.sim, url.path
+        sim.calls[path] += 1
+        with sim.lock:
+            t = sim.torrents.get(p.get('hash'))
+            hashes = [h for h in p.get('hashes', '').split('|') if h in sim.torrents]
+            if path == '/api/v2/auth/login': return self.reply(b'Ok.')
+            if path == '/api/v2/app/webapiVersion': return self.reply(b'2.9.3')
+            if path == '/api/v2/sync/maindata': return self.reply(sim.maindata(int(p.get('rid', 0))))
+            if path == '/api/v2/torrents/info':
+                return self.reply([dict(t.info(), hash=h) for h, t in sim.torrents.items()])
+            if path in ('/api/v2/torrents/files', '/api/v2/torrents/properties', '/api/v2/torrents/pieceStates',
+                        '/api/v2/torrents/filePrio') and t is None:
+                return self.reply(b'Not Found', 404)
+            if path == '/api/v2/torrents/files':
+                files = t.files
+                if 'indexes' in p:
+                    files = [t.files[int(i)] for i in p['indexes'].split('|') if i and int(i) < len(t.files)]
+                return self.reply([f.info() for f in files])
+            if path == '/api/v2/torrents/properties':
+                return self.reply({'piece_size': PIECE_SIZE, 'total_size': t.total_size})
+            if path == '/api/v2/torrents/pieceStates': return self.reply(t.piece_states())
+            if path == '/api/v2/torrents/filePrio':
+                sim.set_priority(t, [int(i) for i in p['id'].split('|')], int(p['priority']))
+                return self.reply()
+            if path in ('/api/v2/torrents/resume', '/api/v2/torrents/start'):
+                for h in hashes:
+                    sim.torrents[h].state = 'downloading'
+                    sim.touch(sim.torrents[h])
+                return self.reply()
+            if path in ('/api/v2/torrents/pause', '/api/v2/torrents/stop'):
+                for h in hashes:
+                    sim.torrents[h].state = 'pausedDL'
+                    sim.touch(sim.torrents[h])
+                return self.reply()
+            if path == '/api/v2/torrents/toggleSequentialDownload':
+                for h in hashes:
+                    sim.torrents[h].seq_dl = not sim.torrents[h].seq_dl
+                    sim.touch(sim.torrents[h])
+                return self.reply()
+            if path == '/api/v2/torrents/delete':
+                for h in hashes: sim.delete(h)
+                return self.reply()
+            if path == '/api/v2/transfer/setDownloadLimit':
+                sim.limit = int(p.get('limit', 0))
+                return self.reply()
+            if path == '/api/v2/transfer/downloadLimit':
+                return self.reply(str(sim.limit).encode())
+            # reannounce / setForceStart / recheck / setPreferences / add: 模拟里没有效果
+            return self.reply()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def percentile(values, q):
+    if not values: return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+# ==============================================================================
+# 🏁 压测主流程
+# ==============================================================================
+def main():
+    ap = argparse.ArgumentParser(description="QFlow 离线压测 (模拟 qBittorrent + rclone 桩)")
+    ap.add_argument('--torrents', type=int, default=200, help="种子数")
+    ap.add_argument('--files', type=int, default=20, help="每个种子的文件数")
+    ap.add_argument('--file-mb', type=float, default=64, help="文件大小中位数 (MB，对数正态分布)")
+    ap.add_argument('--size-sigma', type=float, default=0.8, help="文件大小对数正态分布的 sigma")
+    ap.add_argument('--dl-mbps', type=float, default=4, help="单个种子下载速度中位数 (MB/s)")
+    ap.add_argument('--link-mbps', type=float, default=100, help="下行总带宽 (MB/s)")
+    ap.add_argument('--stall-frac', type=float, default=0.05, help="死种比例 (可用度 < 1，文件下不完)")
+    ap.add_argument('--ul-mbps', type=float, default=50, help="单个上传的速度 (MB/s)")
+    ap.add_argument('--ul-latency', type=float, default=0.5, help="单个上传的固定开销 (秒)")
+    ap.add_argument('--ul-fail', type=float, default=0.0, help="上传失败概率")
+    ap.add_argument('--disk-gb', type=float, default=20, help="模拟磁盘容量 (GB)")
+    ap.add_argument('--margin-gb', type=float, default=1, help="DISK_SAFE_MARGIN_GB")
+    ap.add_argument('--backend', choices=('rcd', 'subprocess'), default='rcd', help="UPLOAD_BACKEND")
+    ap.add_argument('--duration', type=float, default=120, help="压测时长 (秒)，全部文件完成会提前结束")
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help="额外覆盖 CONFIG (值按 JSON 解析)")
+    ap.add_argument('--json', help="结果另存为 JSON，方便版本之间对比")
+    ap.add_argument('--verbose', action='store_true', help="保留 QFlow 的 INFO 日志")
+    args = ap.parse_args()
+    if args.json: args.json = os.path.abspath(args.json)
+
+    workdir = tempfile.mkdtemp(prefix='qflow-bench-')
+    download_dir = os.path.join(workdir, 'downloads')
+    os.makedirs(os.path.join(workdir, 'bin'))
+    stub = os.path.join(workdir, 'bin', 'rclone')
+    with open(stub, 'w') as fp:
+        fp.write(f"#!{sys.executable}\n{RCLONE_STUB}")
+    os.chmod(stub, 0o755)
+
+    print(f"🧪 生成模拟数据: {args.torrents} 个种子 x {args.files} 个文件 ...")
+    sim = SimQbit(args, download_dir)
+    WebUI.sim = sim
+    server = ThreadingHTTPServer(('127.0.0.1', free_port()), WebUI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # main.py 在 import 时就读配置、建库，所以配置要在 import 之前通过环境变量给进去
+    env = {
+        'QBIT_URL': f"http://127.0.0.1:{server.server_address[1]}",
+        'DOWNLOAD_DIR': download_dir,
+        'DISK_SAFE_MARGIN_GB': args.margin_gb,
+        'UPLOAD_BACKEND': args.backend,
+        'RCLONE_RC_ADDR': f"127.0.0.1:{free_port()}",
+        'RCLONE_DEST_PATH': 'bench',
+    }
+    for key, value in env.items():
+        os.environ[f"QFLOW_{key}"] = value if isinstance(value, str) else json.dumps(value)
+    for item in args.set:
+        key, _, value = item.partition('=')
+        os.environ[f"QFLOW_{key}"] = value
+    os.environ['PATH'] = os.path.dirname(stub) + os.pathsep + os.environ['PATH']
+    os.environ.update(BENCH_UL_MBPS=str(args.ul_mbps), BENCH_UL_LATENCY=str(args.ul_latency), BENCH_UL_FAIL=str(args.ul_fail))
+    os.chdir(workdir) # qflow.db 建在临时目录里
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as qflow
+    if not args.verbose:
+        qflow.logger.setLevel('WARNING')
+    qflow.qbit.connect()
+
+    # 数据库耗时：所有线程的 SQL 执行时间累加
+    db = {'seconds': 0.0, 'statements': 0}
+    @qflow.event.listens_for(qflow.engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, params, context, executemany):
+        conn.info.setdefault('bench_t0', []).append(time.perf_counter())
+    @qflow.event.listens_for(qflow.engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, params, context, executemany):
+        db['seconds'] += time.perf_counter() - conn.info['bench_t0'].pop()
+        db['statements'] += 1
+
+    sch = qflow.scheduler
+    sch.get_disk_usage = sim.disk_usage # 调度器和磁盘看门狗都从这里拿磁盘水位
+
+    ticks, utilization = [], []
+    real_tick = sch.tick
+    def timed_tick():
+        calls, db_s = sum(sim.calls.values()), db['seconds']
+        started = time.perf_counter()
+        try:
+            return real_tick()
+        finally:
+            usage = sim.disk_usage()
+            info = sch.budget_info
+            usable = usage.total - info.get('margin', 0)
+            if usable > 0:
+                utilization.append(min(1.5, (usage.used + info.get('debt', 0)) / usable))
+            ticks.append((time.perf_counter() - started, sum(sim.calls.values()) - calls, db['seconds'] - db_s))
+    sch.tick = timed_tick
+
+    def simulate():
+        last = time.time()
+        while True:
+            time.sleep(0.1)
+            now = time.time()
+            sim.step(now - last)
+            last = now
+    threading.Thread(target=simulate, daemon=True).start()
+
+    total_files = args.torrents * args.files
+    print(f"🚀 开始压测: {args.duration:.0f}s | 磁盘 {args.disk_gb}G | 上传后端 {args.backend} | 工作目录 {workdir}")
+    started = time.time()
+    sch.start()
+    qflow.disk_guard.start()
+    peak, overflow, done = 0, 0, 0
+    while time.time() - started < args.duration:
+        time.sleep(1)
+        usage = sim.disk_usage()
+        peak = max(peak, usage.used)
+        if usage.used > usage.total: overflow += 1
+        done = qflow.file_store.count(4) + qflow.file_store.count(5)
+        if done >= total_files: break
+    elapsed = time.time() - started
+
+    s = qflow.Session()
+    counts = dict(s.execute(qflow.select(qflow.FileItem.status, qflow.func.count()).group_by(qflow.FileItem.status)).all())
+    uploaded = s.execute(qflow.select(qflow.func.sum(qflow.FileItem.size)).where(qflow.FileItem.status == 4)).scalar() or 0
+    latencies = [t[0] for t in ticks]
+    phases = {}
+    for (name, labels), (_, total, count) in list(qflow.metrics.hists.items()):
+        if name == 'qflow_phase_seconds' and count:
+            phases[dict(labels)['phase']] = round(total / count * 1000, 2)
+    n = max(1, len(ticks))
+    result = {
+        'params': vars(args),
+        'elapsed': round(elapsed, 1),
+        'ticks': len(ticks),
+        'tick_ms': {'p50': round(percentile(latencies, 0.5) * 1000, 2), 'p95': round(percentile(latencies, 0.95) * 1000, 2),
+                    'max': round(max(latencies, default=0) * 1000, 2), 'phases': phases},
+        'api_calls_per_tick': round(sum(sim.calls.values()) / n, 1),
+        'api_calls': dict(sim.calls.most_common()),
+        'db': {'seconds': round(db['seconds'], 3), 'ms_per_tick': round(db['seconds'] / n * 1000, 2), 'statements': db['statements']},
+        'disk': {'utilization_mean': round(sum(utilization) / len(utilization), 3) if utilization else 0,
+                 'peak_gb': round(peak / GB, 2), 'overflow_samples': overflow},
+        'files': {'total': total_files, 'done': counts.get(4, 0), 'killed': counts.get(5, 0),
+                  'per_hour': round(counts.get(4, 0) / elapsed * 3600, 1)},
+        'uploaded_gb_per_hour': round(uploaded / GB / elapsed * 3600, 2),
+        'downloaded_gb': round(sim.downloaded / GB, 2),
+    }
+
+    print(f"\n📊 压测结果 ({result['elapsed']}s, {result['ticks']} 轮调度)")
+    print(f"  调度耗时 ms     p50={result['tick_ms']['p50']} p95={result['tick_ms']['p95']} max={result['tick_ms']['max']}")
+    print("  各阶段均值 ms   " + " ".join(f"{k}={v}" for k, v in sorted(phases.items())))
+    print(f"  qBit API/轮     {result['api_calls_per_tick']}  (" + ", ".join(f"{k.rsplit('/', 1)[-1] or k}={v}" for k, v in list(result['api_calls'].items())[:6]) + ")")
+    print(f"  数据库          {result['db']['seconds']}s 共 {db['statements']} 条语句, {result['db']['ms_per_tick']} ms/轮")
+    print(f"  磁盘预算利用率  平均 {result['disk']['utilization_mean']:.1%} | 峰值占用 {result['disk']['peak_gb']}G / {args.disk_gb}G | 超容量采样 {overflow}")
+    print(f"  文件            完成 {result['files']['done']}/{total_files} | 放弃 {result['files']['killed']} | {result['files']['per_hour']} 个/小时 | 上传 {result['uploaded_gb_per_hour']} G/小时")
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(result, fp, ensure_ascii=False, indent=2)
+
+    # 上传线程和 rclone 桩可能还在跑：停掉 rcd 桩、删掉工作目录后直接退出，不等它们
+    sys.stdout.flush()
+    if hasattr(sch.uploader, 'stop'): sch.uploader.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+    os._exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,25 @@ import time
 import os
 import sys
 import json
+import zlib
 import shutil
 import logging
 import subprocess
+import collections
+import contextlib
+import tarfile
+import atexit
+import secrets
+import heapq
+import bisect
+import math
+import ctypes
+import ctypes.util
+import urllib.parse
 import requests
-from flask import Flask, request, jsonify, render_template_string
-from sqlalchemy import create_engine, Column, Integer, String, Float, event
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify, render_template_string
+from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Index, UniqueConstraint, LargeBinary, event, inspect, select, insert, update, delete, bindparam, func
 from sqlalchemy.orm import sessionmaker, declarative_base, scoped_session
 from sqlalchemy.exc import OperationalError
 # ==============================================================================
@@ -24,19 +37,106 @@ CONFIG = {
     # --- Rclone 配置 ---
     "RCLONE_REMOTE": "od1enc:",       # 你的加密 remote 名称 (注意冒号)
     "RCLONE_DEST_PATH": "BT_Uploads", # 网盘内的目标文件夹
-    "MAX_UPLOAD_THREADS": 12,          # 并发上传文件的数量
+    # 多网盘分流: 每个文件发往预计最快传完的那个 remote。留空 = 只用上面的 RCLONE_REMOTE
+    # 例: [{"remote": "od1enc:", "weight": 2, "max_threads": 8}, {"remote": "123pan:", "weight": 1, "max_threads": 4, "dest": "QFlow"}]
+    "UPLOAD_TARGETS": [],
+    "UPLOAD_QUOTA_REFRESH": 600,       # 每隔多少秒用 rclone about 刷新一次各网盘剩余空间
+    "UPLOAD_RATE_FLOOR": 1024**2,      # 还没测出吞吐的网盘按 1MB/s 估算
+    "MAX_UPLOAD_THREADS": 12,          # 并发上传文件数的上限 (实际并发由 AIMD 控制器在 MIN~MAX 之间自动调整)
+    "MIN_UPLOAD_THREADS": 2,           # 并发上传文件数的下限
+    "UPLOAD_AIMD_INTERVAL": 30,        # 每隔多少秒根据实测吞吐调整一次并发
+    "UPLOAD_CPU_HIGH": 0.9,            # 每核 1 分钟负载超过此值视为 CPU 吃紧 -> 减半
+    "UPLOAD_MEM_MIN_MB": 256,          # 可用内存低于此值视为内存吃紧 -> 减半
+    "UPLOAD_BACKEND": "rcd",           # rcd=常驻 rclone rcd + HTTP 提交任务 / subprocess=每个文件一个 rclone move
+    "RCLONE_RC_ADDR": "127.0.0.1:5572", # rclone rcd 监听地址 (仅本机)
+    "RCLONE_RC_POLL": 1.0,             # 轮询 job/status 的间隔(秒)
+    "REMOTE_INDEX_ENABLED": True,      # 启动时用 rclone lsjson 建立网盘文件索引 (只建一次，之后随上传增量更新)，同路径同大小的文件不再下载
+    "REMOTE_INDEX_HASH": False,        # 建索引时顺带记录网盘哈希 (加密 remote 没有哈希，开了也只是更慢)
+
+    # --- 📦 小文件打包上传 (字幕/图片/扫描件多的种子) ---
+    "BUNDLE_ENABLED": False,           # 同目录的小文件打成 tar 流式上传 (一个对象)，省掉逐个文件的网盘 API 往返
+    "BUNDLE_MAX_FILE_MB": 8,           # 小于此大小的文件才参与打包
+    "BUNDLE_TARGET_MB": 512,           # 单个包的大小上限
+    "BUNDLE_MIN_FILES": 8,             # 凑不够这么多个小文件就还是逐个上传
+    "BUNDLE_MAX_WAIT": 600,            # 同目录还有小文件没下完时最多等多久(秒)再打包
+
+    # --- 🌊 超大文件流式上传 (边下边传) ---
+    "STREAM_ENABLED": False,           # 比整块盘还大的文件：顺序下载，已完成的连续前缀直接灌进 rclone rcat，传过的部分打洞释放
+    "STREAM_WINDOW_GB": 8.0,           # 单个流式文件在本地最多占用的空间，超出就暂停该种子等上传追上
+    "STREAM_MAX_ACTIVE": 1,            # 同时进行的流式上传数 (每个占一个上传槽位)
+    "STREAM_POLL": 2.0,                # 查询 piece 完成情况的间隔(秒)
+    "STREAM_PUNCH_MB": 64,             # 已上传的前缀每攒够这么多就打一次洞
+    "STREAM_STALL_TIMEOUT": 3600,      # 前缀这么久没推进就判失败(秒)
     
     # --- 磁盘空间控制 ---
     "DISK_SAFE_MARGIN_GB": 20.0,       # 保留 2GB 空间，防止系统爆满
-    "SCAN_INTERVAL": 3,               # 调度器扫描频率(秒)
+    "SCAN_INTERVAL": 3,               # 调度器扫描频率(秒)，有事件(上传完成/增删任务/磁盘告警)时立即唤醒
+    "SCAN_INTERVAL_MAX": 15,          # 有下载/上传在跑但没有状态变化时，扫描间隔逐步放宽到此值
+    "SCAN_INTERVAL_IDLE": 60,         # 完全空闲时的最大扫描间隔
+    "SCAN_MIN_GAP": 0.5,              # 两轮调度的最小间隔，合并短时间内的一串事件
+    "DEBT_STAT_MIN_INTERVAL": 15,     # 同一文件两次 stat 的最短间隔(秒)，期间用 qBit 进度估算占用
+    "DEBT_STAT_MAX_INTERVAL": 120,    # 进度没怎么动时，最长多久强制 stat 一次(秒)
+    "DEBT_PROGRESS_STEP": 0.05,       # 进度前进超过 5% 才值得重新 stat
+    "DISK_GUARD_INTERVAL": 0.5,       # 磁盘看门狗采样间隔(秒)
+    "DISK_GUARD_HYSTERESIS_GB": 2.0,  # 剩余空间回到 安全线+此值 以上才开始恢复被暂停的下载
+    "DISK_GUARD_STEP_MB": 256,        # 已经暂停过之后，剩余空间比上次暂停时又少了这么多才再暂停一个 (持平不算在掉)
+    "QBIT_FETCH_WORKERS": 8,          # 每轮快照并发拉取文件列表的线程数
+    "SYNC_MODE": "maindata",          # maindata=增量同步(rid 游标) / full=每轮全量拉取 torrents/info
+    "QBIT_INDEX_SUBSET_MAX": 500,     # 单个种子关注的文件数超过此值时直接拉全量列表 (避免 URL 过长)
+    "QBIT_PRIO_CHUNK": 1000,          # filePrio 每次请求最多携带的文件 id 数
+    "INGEST_CHUNK": 2000,             # 每轮最多入库的文件行数 (超大种子分多轮入库，不阻塞调度)
+    "PANEL_PUSH_INTERVAL": 1.0,       # 面板 (SSE) 推送状态增量的间隔(秒)，期间的变化合并成一条
+    "PANEL_SUMMARY_INTERVAL": 3,      # 面板顶部统计 (剩余空间/上传并发/上传进度) 的推送间隔(秒)
+
+    # --- 🧠 下载调度策略 ---
+    "SCHED_POLICY": "knapsack",       # knapsack=窗口内背包装箱 / greedy=按优先级贪心填充 (旧逻辑)
+    "SCHED_PACK_WINDOW": 64,          # 每轮参与装箱的候选数 (按优先级取前 N 个放得下的)
+    "SCHED_PACK_BUCKETS": 512,        # 背包容量离散化的格数 (越大越精确、越慢)
+    "SCHED_PIECE_AWARE": True,        # 按 piece 边界记账 (共享块里不下载的邻居字节会落进 .parts) 并优先把相邻文件一起放行
+    "SCHED_UNHEALTHY_MIN": 0.9,       # 可用度低于此值的文件视为不健康...
+    "SCHED_UNHEALTHY_BUDGET_GB": 10,  # ...预算不足这么多 GB 时不放行不健康的文件，留给好文件
     
+    # --- 🚰 下载/上传背压 ---
+    # 上传跟不上下载时，待上传积压会吃光磁盘预算，下载就 "灌满 -> 停 -> 灌满" 地震荡。
+    # 按实测的上传能力限制在途工作量，并动态设置 qBit 全局下载限速，让下载速度贴着上传速度走
+    "BACKPRESSURE_ENABLED": True,
+    "BACKPRESSURE_HORIZON": 1800,      # 在途工作量 (待上传积压 + 下载中未落盘) 最多相当于多少秒的上传量
+    "BACKPRESSURE_LOW": 0.3,           # 积压低于 HORIZON 的这个比例时不限速
+    "BACKPRESSURE_MIN_LIMIT": 1024**2, # 下载限速的下限 (B/s)，防止完全停住
+
     # --- 🧟 僵尸文件杀手 (Zombie Killer) ---
     # 作用：防止死种或龟速文件长时间占用宝贵的硬盘空间
     "ZOMBIE_MAX_LIFETIME": 24 * 3600, # 12小时下不完 -> 杀
-    "ZOMBIE_MIN_SPEED": 10 * 1024,    # 平均速度低于 20KB/s -> 杀
+    "ZOMBIE_MIN_SPEED": 10 * 1024,    # 近期速度低于 10KB/s 视为停滞
     "ZOMBIE_WARMUP": 240 * 60,         # 给种子 15分钟 预热时间，期间不杀低速
+    "ZOMBIE_WINDOW": 1800,            # 速度窗口(秒)：按最近这段时间的进度算速度，窗口覆盖过半才做判断
+    "ZOMBIE_EWMA_TAU": 600,           # 速度 EWMA 的时间常数(秒)
+    "ZOMBIE_MAX_ETA": 6 * 3600,       # 预计剩余时间超过此值 -> 杀 (占盘比例大的文件按比例缩短)
+    "ZOMBIE_SHARE_REF": 0.1,          # 占可用磁盘超过这个比例的文件，允许的剩余时间 = MAX_ETA / (占比 / 此值)
+    "ZOMBIE_REQUEUE": 2,              # 被杀的文件自动重新排队的次数，用完才判死 (0=直接判死)
+    "RECHECK_MIN_INTERVAL": 600,      # 同一个种子两次 recheck 的最短间隔(秒)，期间需要 recheck 的重排文件先不放行
+
+    # --- 📼 调度轨迹 (给 replay.py 离线回放、比较不同策略用) ---
+    "TRACE_ENABLED": False,           # 每轮记录观察到的磁盘水位 / 可用度 / 进度 / 状态变化
+    "TRACE_FILE": "qflow-trace.jsonl",
+    "TRACE_MAX_MB": 64,               # 单个轨迹文件的大小上限，超过就滚动
+    "TRACE_BACKUPS": 4,               # 保留几个滚动出去的旧文件 (.1 最新)
+
+    # --- 🗄️ 历史归档 (活跃表只留在跑的种子，调度查询不随历史变慢) ---
+    "HISTORY_RETENTION_HOURS": 72,    # 所有文件都 完成/放弃 的种子保留这么久后归档：文件清单压缩进 archive 表，移出活跃表 (0=不归档)
+    "HISTORY_DELETE_FROM_QBIT": False, # 归档后顺带把种子从 qBit 删掉 (连同本地残留)；关着时 qBit 里的种子不动，同步时按归档记录跳过
+    "HISTORY_INTERVAL": 600,          # 归档检查间隔(秒)
+    "HISTORY_BATCH": 200,             # 每次最多归档的种子数
+    "DB_CHECKPOINT_INTERVAL": 3600,   # WAL checkpoint(TRUNCATE) + 增量 vacuum 的间隔(秒)，有归档时立即做一次
 }
 
+# 环境变量覆盖: QFLOW_<键名>=值 (能按 JSON 解析的按 JSON，否则当字符串)，容器部署和离线压测 (bench.py) 不用改代码
+for _key in CONFIG:
+    _raw = os.environ.get(f"QFLOW_{_key}")
+    if _raw is None: continue
+    try: CONFIG[_key] = json.loads(_raw)
+    except ValueError: CONFIG[_key] = _raw
+
 # --- Rclone 优化参数 (针对国内/OneDrive/GoogleDrive) ---
 # --- Rclone 暴力优化参数 ---
 # --- Rclone 暴力优化参数 (修正版) ---
@@ -64,6 +164,8 @@ RCLONE_FLAGS = [
     "--no-check-certificate",
     "--no-traverse"               # 不扫描目录，直接传，秒开始
 ]
+# 日志改为 JSON 并每秒输出一次传输统计，上传线程逐行解析实时进度 (不再整体缓冲 stderr)
+RCLONE_LOG_FLAGS = ["--use-json-log", "--stats=1s", "--stats-log-level=NOTICE"]
 # ==============================================================================
 # 🔧 初始化与数据库模型
 # ==============================================================================
@@ -71,6 +173,88 @@ RCLONE_FLAGS = [
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("QFlow")
 
+class Metrics:
+    """进程内指标，/metrics 按 Prometheus 文本格式输出 (计数器 + 直方图；瞬时值在抓取时现算)。
+    自己实现是为了不多装一个依赖"""
+    TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}       # { name: (类型, 说明, 直方图分桶) }
+        self.counters = {}   # { (name, labels): 值 }
+        self.hists = {}      # { (name, labels): [各桶计数, 总和, 次数] }
+
+    def describe(self, name, kind, text, buckets=None):
+        self.meta[name] = (kind, text, buckets or self.TIME_BUCKETS)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.meta[name][2]
+        with self.lock:
+            h = self.hists.get(key)
+            if h is None: h = self.hists[key] = [[0] * len(buckets), 0.0, 0]
+            for i, b in enumerate(buckets):
+                if value <= b: h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items: return ""
+        esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+    def render(self, gauges=()):
+        """gauges: [(name, 说明, [(labels dict, 值)])]"""
+        out = []
+        with self.lock:
+            counters = dict(self.counters)
+            hists = {k: [list(v[0]), v[1], v[2]] for k, v in self.hists.items()}
+        for name, (kind, text, buckets) in sorted(self.meta.items()):
+            out += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+            if kind == 'counter':
+                for (n, labels), v in sorted(counters.items()):
+                    if n == name: out.append(f"{name}{self._labels(labels)} {v}")
+            else:
+                for (n, labels), (counts, total, count) in sorted(hists.items()):
+                    if n != name: continue
+                    for b, c in zip(buckets, counts):
+                        out.append(f"{name}_bucket{self._labels(labels, [('le', b)])} {c}")
+                    out.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                    out.append(f"{name}_sum{self._labels(labels)} {total}")
+                    out.append(f"{name}_count{self._labels(labels)} {count}")
+        for name, text, samples in gauges:
+            out += [f"# HELP {name} {text}", f"# TYPE {name} gauge"]
+            for labels, v in samples:
+                out.append(f"{name}{self._labels(sorted(labels.items()))} {v}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.describe('qflow_tick_seconds', 'histogram', '一轮调度的总耗时')
+metrics.describe('qflow_phase_seconds', 'histogram', '调度各阶段耗时')
+metrics.describe('qflow_qbit_requests_total', 'counter', 'qBittorrent WebAPI 调用次数')
+metrics.describe('qflow_qbit_request_seconds', 'histogram', 'qBittorrent WebAPI 响应耗时')
+metrics.describe('qflow_qbit_errors_total', 'counter', 'qBittorrent WebAPI 连接失败次数')
+metrics.describe('qflow_db_lock_retries_total', 'counter', '数据库锁冲突重试次数')
+metrics.describe('qflow_db_lock_failures_total', 'counter', '数据库锁重试耗尽次数')
+metrics.describe('qflow_upload_bytes_total', 'counter', '上传成功的字节数')
+metrics.describe('qflow_uploads_total', 'counter', '上传任务数 (按结果)')
+metrics.describe('qflow_upload_seconds', 'histogram', '单个上传任务耗时', (1, 5, 15, 60, 300, 900, 3600, 3 * 3600, 12 * 3600))
+
 # 数据库初始化
 Base = declarative_base()
 engine = create_engine(
@@ -84,6 +268,7 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor = dbapi_connection.cursor()
     cursor.execute("PRAGMA journal_mode=WAL") # 开启 Write-Ahead Logging
     cursor.execute("PRAGMA synchronous=NORMAL") # 提升写入性能
+    cursor.execute("PRAGMA foreign_keys=ON") # SQLite 默认不检查外键
     cursor.close()
 
 Session = scoped_session(sessionmaker(bind=engine))
@@ -98,8 +283,10 @@ def db_execute(func):
         except OperationalError as e:
             if "database is locked" in str(e):
                 retries -= 1
+                metrics.inc('qflow_db_lock_retries_total')
                 time.sleep(0.5) # 歇一会再试
                 if retries == 0:
+                    metrics.inc('qflow_db_lock_failures_total')
                     logger.error(f"❌ 数据库死锁，操作失败: {e}")
             else:
                 raise e
@@ -113,11 +300,17 @@ class Torrent(Base):
     name = Column(String)
     status = Column(String) 
     total_size = Column(Integer)
+    finished_at = Column(Float, default=0) # 所有文件都 完成/放弃 的时刻 (0=还在跑)，满保留期后归档
 
 class FileItem(Base):
     __tablename__ = 'files'
+    __table_args__ = (
+        # (torrent_hash, index) 唯一索引同时覆盖按 torrent_hash 的查询 (最左前缀)
+        UniqueConstraint('torrent_hash', 'index', name='uq_files_torrent_index'),
+        Index('ix_files_status', 'status'),
+    )
     id = Column(Integer, primary_key=True)
-    torrent_hash = Column(String)
+    torrent_hash = Column(String, ForeignKey('torrents.hash', ondelete='CASCADE'))
     index = Column(Integer) # qBit 的文件索引
     path = Column(String)   # 本地绝对路径
     rel_path = Column(String) # 相对路径 (用于上传结构)
@@ -126,8 +319,498 @@ class FileItem(Base):
     status = Column(Integer) 
     started_at = Column(Float, default=0)
     failed_reason = Column(String, default="")
+    bundle_id = Column(Integer, default=None) # 打包上传时所在的包 (bundles.id)
+    stream = Column(Integer, default=0) # 1=边下边传 (本地前缀会被打洞释放，中断后不能按普通文件续传)
+    remote = Column(String, default=None) # 上传到了哪个 remote (多网盘分流)
+    requeues = Column(Integer, default=0) # 被僵尸杀手 (或手动) 重新排队的次数
+
+class Bundle(Base):
+    """小文件打包上传的清单：网盘上一个 tar 对应多个 FileItem"""
+    __tablename__ = 'bundles'
+    id = Column(Integer, primary_key=True)
+    torrent_hash = Column(String, ForeignKey('torrents.hash', ondelete='CASCADE'), index=True)
+    remote_path = Column(String)  # tar 在 RCLONE_DEST_PATH 下的相对路径
+    size = Column(Integer)        # 包内文件总大小
+    file_count = Column(Integer)
+    manifest = Column(String)     # JSON: [{index, name(包内文件名), rel_path, size}]
+    created_at = Column(Float)
+    remote = Column(String)       # 传到了哪个 remote
+
+class RemoteFile(Base):
+    """网盘上已有文件的索引 (rclone lsjson 建立，上传成功后增量追加)，用来跳过重复下载"""
+    __tablename__ = 'remote_files'
+    path = Column(String, primary_key=True) # 相对 RCLONE_DEST_PATH 的路径 (= FileItem.rel_path)
+    size = Column(Integer)
+    hash = Column(String)      # JSON {算法: 值}，网盘不支持哈希时为空
+    updated_at = Column(Float)
+
+class ArchivedTorrent(Base):
+    """已归档的种子：一行一个种子，文件和打包清单 zlib 压缩后存在 detail 里"""
+    __tablename__ = 'archive'
+    id = Column(Integer, primary_key=True)
+    hash = Column(String, index=True)
+    name = Column(String)
+    total_size = Column(Integer)
+    files_done = Column(Integer)
+    files_killed = Column(Integer)
+    bytes_done = Column(Integer)
+    finished_at = Column(Float)
+    archived_at = Column(Float)
+    detail = Column(LargeBinary)  # zlib(JSON {files: [[index, rel_path, size, status, failed_reason, remote, bundle_id]], bundles: [...]})
+
+# ------------------------------------------------------------------------------
+# 数据库迁移: 按 PRAGMA user_version 逐个执行，旧的 qflow.db 启动时原地升级
+# 约定: 模型定义 == 依次执行所有迁移后的结构。新库直接 create_all 并打上最新版本号
+# ------------------------------------------------------------------------------
+MIGRATIONS = [
+    # v1: files 表加唯一约束 + 外键 + status 索引 (SQLite 不能 ALTER 约束，只能重建表)
+    [
+        """CREATE TABLE files_v1 (
+            id INTEGER NOT NULL PRIMARY KEY,
+            torrent_hash VARCHAR REFERENCES torrents (hash) ON DELETE CASCADE,
+            "index" INTEGER,
+            path VARCHAR,
+            rel_path VARCHAR,
+            size INTEGER,
+            status INTEGER,
+            started_at FLOAT,
+            failed_reason VARCHAR,
+            CONSTRAINT uq_files_torrent_index UNIQUE (torrent_hash, "index")
+        )""",
+        # 丢弃孤儿行 (种子已删) 与重复行 (保留最新一条)
+        """INSERT INTO files_v1 SELECT id, torrent_hash, "index", path, rel_path, size, status, started_at, failed_reason
+           FROM files WHERE torrent_hash IN (SELECT hash FROM torrents)
+           AND id IN (SELECT MAX(id) FROM files GROUP BY torrent_hash, "index")""",
+        "DROP TABLE files",
+        "ALTER TABLE files_v1 RENAME TO files",
+        "CREATE INDEX ix_files_status ON files (status)",
+    ],
+    # v2: 小文件打包清单
+    [
+        """CREATE TABLE bundles (
+            id INTEGER NOT NULL PRIMARY KEY,
+            torrent_hash VARCHAR REFERENCES torrents (hash) ON DELETE CASCADE,
+            remote_path VARCHAR,
+            size INTEGER,
+            file_count INTEGER,
+            manifest VARCHAR,
+            created_at FLOAT
+        )""",
+        "CREATE INDEX ix_bundles_torrent_hash ON bundles (torrent_hash)",
+        "ALTER TABLE files ADD COLUMN bundle_id INTEGER",
+    ],
+    # v3: 流式上传标记
+    [
+        "ALTER TABLE files ADD COLUMN stream INTEGER DEFAULT 0",
+    ],
+    # v4: 网盘文件索引 (去重)
+    [
+        """CREATE TABLE remote_files (
+            path VARCHAR NOT NULL PRIMARY KEY,
+            size INTEGER,
+            hash VARCHAR,
+            updated_at FLOAT
+        )""",
+    ],
+    # v5: 多网盘分流，记录每个文件/包实际传到了哪个 remote
+    [
+        "ALTER TABLE files ADD COLUMN remote VARCHAR",
+        "ALTER TABLE bundles ADD COLUMN remote VARCHAR",
+    ],
+    # v6: 僵尸文件重新排队次数
+    [
+        "ALTER TABLE files ADD COLUMN requeues INTEGER DEFAULT 0",
+    ],
+    # v7: 历史归档
+    [
+        "ALTER TABLE torrents ADD COLUMN finished_at FLOAT DEFAULT 0",
+        """CREATE TABLE archive (
+            id INTEGER NOT NULL PRIMARY KEY,
+            hash VARCHAR,
+            name VARCHAR,
+            total_size INTEGER,
+            files_done INTEGER,
+            files_killed INTEGER,
+            bytes_done INTEGER,
+            finished_at FLOAT,
+            archived_at FLOAT,
+            detail BLOB
+        )""",
+        "CREATE INDEX ix_archive_hash ON archive (hash)",
+    ],
+]
+
+def migrate_db():
+    """启动时执行未完成的迁移 (每个版本一个事务)"""
+    if not inspect(engine).has_table('files'):
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.exec_driver_sql(f"PRAGMA user_version={len(MIGRATIONS)}")
+        enable_incremental_vacuum()
+        return
+
+    raw = engine.raw_connection()
+    try:
+        dbapi = raw.driver_connection
+        dbapi.isolation_level = None # 手动控制事务，保证 PRAGMA 生效
+        version = dbapi.execute("PRAGMA user_version").fetchone()[0]
+        # 重建表期间关闭外键检查 (该 PRAGMA 在事务内无效，必须放在 BEGIN 之前)
+        dbapi.execute("PRAGMA foreign_keys=OFF")
+        for v in range(version, len(MIGRATIONS)):
+            logger.info(f"🛠️ 数据库迁移: v{v} -> v{v+1}")
+            dbapi.execute("BEGIN")
+            try:
+                for stmt in MIGRATIONS[v]:
+                    dbapi.execute(stmt)
+                dbapi.execute(f"PRAGMA user_version={v+1}")
+                dbapi.execute("COMMIT")
+            except Exception:
+                dbapi.execute("ROLLBACK")
+                raise
+        dbapi.execute("PRAGMA foreign_keys=ON")
+        dbapi.isolation_level = ''
+    finally:
+        raw.close()
+    Base.metadata.create_all(engine) # 补建迁移之外新增的表
+    enable_incremental_vacuum()
+
+def enable_incremental_vacuum():
+    """归档删掉的页要能还给文件系统：auto_vacuum 只能在 VACUUM 时切换，老库第一次启动会整库重写一遍"""
+    raw = engine.raw_connection()
+    try:
+        dbapi = raw.driver_connection
+        if dbapi.execute("PRAGMA auto_vacuum").fetchone()[0] == 2: return
+        logger.info("🛠️ 数据库切换到增量 vacuum 模式 (一次性整理，大库需要一点时间)")
+        dbapi.isolation_level = None # VACUUM 不能在事务里执行
+        dbapi.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        dbapi.execute("VACUUM")
+        dbapi.isolation_level = ''
+    finally:
+        raw.close()
+
+migrate_db()
+
+# ==============================================================================
+# 🗂️ 内存文件状态机 (写回式持久化)
+# ==============================================================================
+# 合法的状态迁移: 0=Wait, 1=Downloading, 2=ReadyUpload, 3=Uploading, 4=Done, 5=Killed
+TRANSITIONS = {
+    0: {1, 4},    # 网盘上已存在 -> 直接完成
+    1: {0, 2, 4, 5}, # 僵尸重新排队 / 下完 / 流式上传完成 / 判死
+    2: {3},
+    3: {2, 4},  # 上传失败回退 / 上传成功
+    5: {0},     # 手动重新排队
+}
+
+class FileRecord:
+    """FileItem 的内存镜像，__slots__ 节省内存 (几十万文件也只占几十 MB)"""
+    __slots__ = ('id', 'torrent_hash', 'index', 'path', 'rel_path', 'size', 'status', 'started_at', 'failed_reason', 'bundle_id', 'stream', 'remote', 'requeues',
+                 'saved') # saved: 数据库里现在的状态 (面板统计用它修正还没写回的变化，不用回查数据库)
+
+    def __init__(self, **kw):
+        for k in self.__slots__:
+            setattr(self, k, kw.get(k))
+        if self.started_at is None: self.started_at = 0
+        if self.failed_reason is None: self.failed_reason = ""
+        if self.stream is None: self.stream = 0
+        if self.requeues is None: self.requeues = 0
+        if self.saved is None: self.saved = self.status
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(**{k: getattr(row, k) for k in cls.__slots__ if k != 'saved'})
+
+class FileStore:
+    """权威的文件生命周期：活跃文件 (0~3) 常驻内存，按状态/种子建索引；
+    脏数据由主循环每轮一次性批量写回 SQLite，上传线程只改内存，不再抢数据库锁"""
+    PERSIST_FIELDS = ('status', 'started_at', 'failed_reason', 'bundle_id', 'stream', 'remote', 'requeues')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.records = {}                         # { id: FileRecord }
+        self.by_status = {s: {} for s in range(6)} # { status: { id: FileRecord } }
+        self.by_torrent = {}                      # { hash: { id: FileRecord } }
+        self.dirty = {}                           # { id: FileRecord } 待写回
+        self.flush_lock = threading.Lock()        # 写回期间持有：需要 "数据库 + 未写回的内存" 一致视图的地方 (面板统计) 拿它
+
+    def load(self):
+        """启动时从数据库加载活跃文件。上次退出时 "上传中" 的文件回退为待上传；
+        待上传/上传中但本地文件已经没了的 (上传成功、还没写回就崩了)，网盘索引里有就算完成，否则重新下载"""
+        session = Session()
+        try:
+            rows = session.query(FileItem).filter(FileItem.status.in_([0, 1, 2, 3])).all()
+            recs = [FileRecord.from_row(r) for r in rows]
+        finally:
+            Session.remove()
+        recovered = lost = 0
+        with self.lock:
+            for rec in recs:
+                if rec.status in (2, 3) and not rec.stream and not os.path.exists(rec.path):
+                    if remote_index.has(rec.rel_path, rec.size):
+                        rec.status = 4
+                        recovered += 1
+                    else:
+                        # qBit 还记着这些块已完成，requeues 记 1 让放行时 recheck
+                        rec.status, rec.started_at, rec.requeues = 0, 0, max(1, rec.requeues)
+                        rec.failed_reason = "本地文件丢失"
+                        lost += 1
+                    self.dirty[rec.id] = rec
+                elif rec.status == 3:
+                    rec.status = 2
+                    self.dirty[rec.id] = rec
+                self._index(rec)
+        logger.info(f"🗂️ 已加载 {len(recs)} 个活跃文件到内存")
+        if recovered or lost:
+            logger.warning(f"🗂️ 待上传文件本地已不存在: {recovered} 个网盘上已有 -> 完成，{lost} 个重新下载")
+
+    def _index(self, rec):
+        self.records[rec.id] = rec
+        self.by_status[rec.status][rec.id] = rec
+        self.by_torrent.setdefault(rec.torrent_hash, {})[rec.id] = rec
+
+    def add(self, recs):
+        """登记新入库的文件 (调用方负责先写入数据库拿到 id)，已登记的跳过"""
+        with self.lock:
+            for rec in recs:
+                if rec.id not in self.records: self._index(rec)
+
+    def with_status(self, status):
+        with self.lock:
+            return list(self.by_status[status].values())
+
+    def count(self, status):
+        return len(self.by_status[status])
+
+    def of_torrent(self, hash_str):
+        with self.lock:
+            return list(self.by_torrent.get(hash_str, {}).values())
+
+    def update(self, rec, **fields):
+        """修改非状态字段 (如 started_at)，标记为脏"""
+        with self.lock:
+            if rec.id not in self.records: return False
+            for k, v in fields.items():
+                setattr(rec, k, v)
+            self.dirty[rec.id] = rec
+            return True
+
+    def transition(self, rec, status, **fields):
+        """状态迁移，非法迁移 (或文件已被删除) 返回 False"""
+        with self.lock:
+            if rec.id not in self.records: return False
+            if status not in TRANSITIONS.get(rec.status, ()):
+                logger.warning(f"⚠️ 非法状态迁移 {rec.status} -> {status}: {rec.rel_path}")
+                return False
+            old = rec.status
+            del self.by_status[old][rec.id]
+            rec.status = status
+            self.by_status[status][rec.id] = rec
+            for k, v in fields.items():
+                setattr(rec, k, v)
+            self.dirty[rec.id] = rec
+            trace.event(rec.id, status)
+            panel.moved(rec, old)
+            return True
 
-Base.metadata.create_all(engine)
+    def revive(self, fid):
+        """把被杀的文件放回等待队列。已写回并移出内存的，从数据库改状态后重新登记。
+        和僵尸重排一样 requeues 至少记 1 (放行时触发 recheck)：本地数据已删/已打洞，qBit 却还记着那些块已完成"""
+        with self.lock:
+            rec = self.records.get(fid)
+            if rec is not None:
+                return self.transition(rec, 0, started_at=0, requeues=max(1, rec.requeues), stream=0)
+        table = FileItem.__table__
+        def write():
+            with engine.begin() as conn:
+                n = conn.execute(update(table).where(table.c.id == fid, table.c.status == 5).values(
+                    status=0, started_at=0, stream=0, requeues=func.max(1, func.coalesce(table.c.requeues, 0)))).rowcount
+                return conn.execute(select(table).where(table.c.id == fid)).first() if n else False
+        row = db_execute(write)
+        if not row: return False
+        self.add([FileRecord.from_row(row)])
+        trace.event(fid, 0)
+        panel.refresh(row.torrent_hash)
+        return True
+
+    def drop_torrent(self, hash_str):
+        """种子被删除时移出内存 (数据库由调用方删除)"""
+        with self.lock:
+            for rec in self.by_torrent.pop(hash_str, {}).values():
+                self.records.pop(rec.id, None)
+                self.by_status[rec.status].pop(rec.id, None)
+                self.dirty.pop(rec.id, None)
+
+    def _evict(self, rec):
+        """终态文件写回后不再常驻内存"""
+        self.records.pop(rec.id, None)
+        self.by_status[rec.status].pop(rec.id, None)
+        files = self.by_torrent.get(rec.torrent_hash)
+        if files is not None:
+            files.pop(rec.id, None)
+            if not files: del self.by_torrent[rec.torrent_hash]
+
+    def flush(self):
+        """把本轮所有脏数据在一个事务里批量写回 (executemany)"""
+        with self.flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self.lock:
+            if not self.dirty: return 0
+            batch = self.dirty
+            self.dirty = {}
+            params = [dict({'_id': r.id}, **{k: getattr(r, k) for k in self.PERSIST_FIELDS}) for r in batch.values()]
+
+        stmt = update(FileItem.__table__).where(FileItem.__table__.c.id == bindparam('_id')).values(
+            **{k: bindparam(k) for k in self.PERSIST_FIELDS})
+        def write():
+            with engine.begin() as conn:
+                conn.execute(stmt, params)
+            return True
+
+        try: ok = db_execute(write)
+        except Exception: ok = False # db_execute 已记录日志
+        if not ok:
+            # 写回失败：放回脏表，下一轮重试 (期间更新过的记录以内存为准)
+            with self.lock:
+                for rid, rec in batch.items():
+                    if rid in self.records: self.dirty.setdefault(rid, rec)
+            return 0
+
+        with self.lock:
+            for p in params:
+                batch[p['_id']].saved = p['status']
+            for rec in batch.values():
+                if rec.status in (4, 5) and rec.id not in self.dirty:
+                    self._evict(rec)
+        return len(params)
+
+file_store = FileStore()
+
+class PanelFeed:
+    """📣 面板推送 (SSE)：内存里维护每个种子各状态的文件数/字节数，状态变化按增量广播给所有打开的面板。
+    面板不再每 3 秒拉一次全量 /api/stats，文件列表只在展开种子卡片时按需加载"""
+    QUEUE_MAX = 5000 # 单个连接积压的事件上限，超过说明它跟不上了，改发一次全量快照
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.torrents = None # { hash: {'name': 种子名, 'n': [各状态文件数], 'b': [各状态字节数]} }，首次使用时加载
+        self.subs = {}       # { 连接: deque[事件] }，None = 溢出，下次改发快照
+
+    def count(self, hash_str=None):
+        """从数据库统计 (一条 GROUP BY)，再用还没写回的内存状态修正；数据库忙返回 None。
+        调用方持有 file_store.flush_lock (查询期间数据库不变)，但不能持有 file_store.lock ——
+        查询 (含锁冲突重试) 期间上传线程和调度器照常改状态，回来后在 _overlay 里一次补上"""
+        table = FileItem.__table__
+        def read():
+            with engine.connect() as conn:
+                q = select(table.c.torrent_hash, table.c.status, func.count(), func.sum(table.c.size)).group_by(table.c.torrent_hash, table.c.status)
+                names = select(Torrent.__table__.c.hash, Torrent.__table__.c.name).order_by(Torrent.__table__.c.id)
+                if hash_str is not None:
+                    q = q.where(table.c.torrent_hash == hash_str)
+                    names = names.where(Torrent.__table__.c.hash == hash_str)
+                return conn.execute(names).all(), conn.execute(q).all()
+        try: res = db_execute(read)
+        except Exception: res = None # db_execute 已记录日志
+        if res is None: return None
+        names, counts = res
+        out = {h: {'name': name, 'n': [0] * 6, 'b': [0] * 6} for h, name in names}
+        for h, st, n, size in counts:
+            e = out.setdefault(h, {'name': h, 'n': [0] * 6, 'b': [0] * 6})
+            e['n'][st] += n
+            e['b'][st] += size or 0
+        return out
+
+    @staticmethod
+    def _overlay(out):
+        """用还没写回的内存状态修正数据库统计。调用方持有 file_store.lock"""
+        for rec in file_store.dirty.values():
+            e = out.get(rec.torrent_hash)
+            if rec.saved == rec.status or e is None: continue
+            e['n'][rec.saved] -= 1
+            e['b'][rec.saved] -= rec.size
+            e['n'][rec.status] += 1
+            e['b'][rec.status] += rec.size
+
+    def load(self):
+        with file_store.flush_lock:
+            if self.torrents is not None: return
+            counts = self.count()
+            if counts is None: return # 下次订阅时再试
+            with file_store.lock:
+                self._overlay(counts)
+                with self.lock:
+                    self.torrents = counts
+
+    def publish(self, event):
+        """调用方持有 self.lock"""
+        for sub, q in self.subs.items():
+            if q is None: continue
+            if len(q) >= self.QUEUE_MAX: self.subs[sub] = None
+            else: q.append(event)
+
+    def moved(self, rec, old):
+        """FileStore.transition 里调用 (持有 file_store.lock)"""
+        with self.lock:
+            if self.torrents is None: return # 还没加载，加载时会统计到
+            e = self.torrents.get(rec.torrent_hash)
+            if e is not None:
+                e['n'][old] -= 1
+                e['b'][old] -= rec.size
+                e['n'][rec.status] += 1
+                e['b'][rec.status] += rec.size
+            self.publish(('f', rec.id, rec.torrent_hash, rec.status, rec.failed_reason))
+
+    def refresh(self, hash_str):
+        """文件行有增减 (分块入库、从数据库复活) 后重新统计这个种子"""
+        if self.torrents is None: return
+        with file_store.flush_lock:
+            counts = self.count(hash_str)
+            if counts is None: return
+            with file_store.lock:
+                self._overlay(counts)
+                with self.lock:
+                    if hash_str in counts: self.torrents[hash_str] = counts[hash_str]
+                    self.publish(('t', hash_str))
+
+    def remove(self, hash_str):
+        if self.torrents is None: return
+        with self.lock:
+            self.torrents.pop(hash_str, None)
+            self.publish(('x', hash_str))
+
+    def subscribe(self, sub):
+        """(重新) 订阅，返回全量快照"""
+        self.load()
+        with self.lock:
+            self.subs[sub] = collections.deque()
+            return {'torrents': {h: dict(e, n=list(e['n']), b=list(e['b'])) for h, e in (self.torrents or {}).items()}}
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subs.pop(sub, None)
+
+    def drain(self, sub):
+        """取走积压的事件合并成一条增量：{'files': {id: [hash, 状态, 原因]}, 'torrents': {hash: 统计 或 None(已删除)}}。
+        溢出返回 None (调用方改发快照)，没有变化返回 {}"""
+        with self.lock:
+            q = self.subs.get(sub)
+            if q is None: return None
+            if not q: return {}
+            files, hashes, removed = {}, set(), set()
+            for ev in q:
+                if ev[0] == 'f': files[ev[1]] = [ev[2], ev[3], ev[4]]
+                elif ev[0] == 'x': removed.add(ev[1])
+                hashes.add(ev[2] if ev[0] == 'f' else ev[1])
+            q.clear()
+            torrents = {}
+            for h in hashes:
+                e = self.torrents.get(h)
+                if e: torrents[h] = dict(e, n=list(e['n']), b=list(e['b']))
+                elif h in removed: torrents[h] = None
+            return {'files': files, 'torrents': torrents}
+
+panel = PanelFeed()
 
 # ==============================================================================
 # 📡 qBittorrent 客户端封装
@@ -135,17 +818,46 @@ Base.metadata.create_all(engine)
 class QbitClient:
     def __init__(self):
         self.s = requests.Session()
+        # 连接池覆盖 快照并发拉取 + 上传线程回调，避免反复建连
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=CONFIG["QBIT_FETCH_WORKERS"] + CONFIG["MAX_UPLOAD_THREADS"])
+        self.s.mount('http://', adapter)
+        self.s.mount('https://', adapter)
+        self.s.hooks['response'].append(self.observe)
+        self.s.request = self.counted(self.s.request)
         # 增加 Header 伪装，防止某些版本拦截
         self.s.headers.update({
             'User-Agent': 'Mozilla/5.0', 
             'Referer': CONFIG["QBIT_URL"]
         })
         self.base_url = CONFIG["QBIT_URL"]
+        self.api_version = (0,)
+
+    def connect(self):
+        """登录并注入参数。启动时调用 (import 本模块不连 qBit，压测/回放工具可以直接复用里面的类)"""
         if not self.login():
             logger.error("❌ 无法连接到 qBittorrent，请检查配置或服务是否启动")
             sys.exit(1)
+        self.detect_api_version()
         self.apply_optimizations()
 
+    @staticmethod
+    def observe(r, *args, **kwargs):
+        """每个响应按接口记次数和耗时 (elapsed = 发出请求到收到响应头)"""
+        endpoint = urllib.parse.urlparse(r.request.url).path
+        metrics.inc('qflow_qbit_requests_total', endpoint=endpoint, code=r.status_code)
+        metrics.observe('qflow_qbit_request_seconds', r.elapsed.total_seconds(), endpoint=endpoint)
+
+    @staticmethod
+    def counted(request):
+        """连接失败拿不到响应，单独计数"""
+        def wrapper(method, url, *args, **kwargs):
+            try:
+                return request(method, url, *args, **kwargs)
+            except requests.RequestException:
+                metrics.inc('qflow_qbit_errors_total', endpoint=urllib.parse.urlparse(url).path)
+                raise
+        return wrapper
+
     def login(self):
         try:
             # 尝试访问首页获取 Cookie (CSRF token 需要)
@@ -158,11 +870,18 @@ class QbitClient:
             logger.error(f"Login Error: {e}")
             return False
 
+    def detect_api_version(self):
+        """WebAPI >= 2.8.2 (qBit 4.4+) 的 torrents/files 支持 indexes 参数并返回 index 字段"""
+        try:
+            v = self.s.get(f"{self.base_url}/api/v2/app/webapiVersion").text.strip()
+            self.api_version = tuple(int(x) for x in v.split('.'))
+        except: pass
+
     def apply_optimizations(self):
         prefs = {
             'max_connec': 500,
             'enable_os_cache': False,
-            'preallocate_all': True,
+            'preallocate_all': not CONFIG["STREAM_ENABLED"], # 流式上传要求稀疏文件，预分配会一次占满整个文件
             'queueing_enabled': False,
             'autorun_enabled': False, # 确保添加任务时不自动开始，由脚本控制
         }
@@ -183,15 +902,35 @@ class QbitClient:
         try: return self.s.get(f"{self.base_url}/api/v2/torrents/info").json()
         except: return []
 
-    def get_files(self, hash_str):
-        try: return self.s.get(f"{self.base_url}/api/v2/torrents/files", params={'hash': hash_str}).json()
+    def sync_maindata(self, rid=0):
+        """增量同步：只返回自 rid 以来变化/删除的种子，失败返回 None"""
+        try: return self.s.get(f"{self.base_url}/api/v2/sync/maindata", params={'rid': rid}).json()
+        except: return None
+
+    def get_files(self, hash_str, indexes=None):
+        """获取文件列表，每项都带 index 字段。indexes 不为空时只取这些文件 (旧版 qBit 在本地过滤)"""
+        params = {'hash': hash_str}
+        native = indexes is not None and self.api_version >= (2, 8, 2)
+        if native:
+            params['indexes'] = '|'.join(map(str, indexes))
+        try: files = self.s.get(f"{self.base_url}/api/v2/torrents/files", params=params).json()
         except: return []
+        if native: return files
+        for i, f in enumerate(files):
+            f.setdefault('index', i)
+        if indexes is not None:
+            wanted = set(indexes)
+            files = [f for f in files if f['index'] in wanted]
+        return files
 
     def set_priority(self, hash_str, file_indexes, prio):
         # ⚠️ 修复：改为 POST 请求
         if not file_indexes: return
-        ids = '|'.join(map(str, file_indexes))
-        self.s.post(f"{self.base_url}/api/v2/torrents/filePrio", data={'hash': hash_str, 'id': ids, 'priority': prio})
+        # 分块发送，避免几万个 id 拼成一个巨型请求
+        step = CONFIG["QBIT_PRIO_CHUNK"]
+        for i in range(0, len(file_indexes), step):
+            ids = '|'.join(map(str, file_indexes[i:i + step]))
+            self.s.post(f"{self.base_url}/api/v2/torrents/filePrio", data={'hash': hash_str, 'id': ids, 'priority': prio})
 
     def resume(self, hash_str):
         # ⚠️ 修复：改为 POST 请求
@@ -199,43 +938,1206 @@ class QbitClient:
         # 额外操作：强制重新宣告 (Reannounce) 以加速磁力链连接
         self.s.post(f"{self.base_url}/api/v2/torrents/reannounce", data={'hashes': hash_str})
     
+    def pause(self, hash_str):
+        # qBit 5.x 把 pause 改名为 stop
+        r = self.s.post(f"{self.base_url}/api/v2/torrents/pause", data={'hashes': hash_str})
+        if r.status_code == 404:
+            self.s.post(f"{self.base_url}/api/v2/torrents/stop", data={'hashes': hash_str})
+
+    def get_properties(self, hash_str):
+        try: return self.s.get(f"{self.base_url}/api/v2/torrents/properties", params={'hash': hash_str}).json()
+        except: return {}
+
+    def get_piece_states(self, hash_str):
+        """每个 piece 的状态: 0=未下载 1=下载中 2=已完成"""
+        try: return self.s.get(f"{self.base_url}/api/v2/torrents/pieceStates", params={'hash': hash_str}).json()
+        except: return []
+
+    def set_sequential(self, hash_str, enable, current):
+        """toggleSequentialDownload 只能翻转，需要对照当前状态 (种子信息里的 seq_dl)"""
+        if bool(enable) != bool(current):
+            self.s.post(f"{self.base_url}/api/v2/torrents/toggleSequentialDownload", data={'hashes': hash_str})
+
+    def recheck(self, hash_str):
+        self.s.post(f"{self.base_url}/api/v2/torrents/recheck", data={'hashes': hash_str})
+
+    def get_download_limit(self):
+        """当前全局下载限速 (B/s)，0=不限，读取失败返回 None"""
+        try:
+            r = self.s.get(f"{self.base_url}/api/v2/transfer/downloadLimit")
+            return int(r.text) if r.ok else None
+        except: return None
+
+    def set_download_limit(self, limit):
+        """全局下载限速 (B/s)，0=不限"""
+        try:
+            r = self.s.post(f"{self.base_url}/api/v2/transfer/setDownloadLimit", data={'limit': int(limit)})
+            return r.ok
+        except: return False
+
     def delete(self, hash_str):
+        """返回 qBit 是否接受了删除 (会话过期 403 等都算失败)"""
         # ⚠️ 修复：改为 POST 请求
-        self.s.post(f"{self.base_url}/api/v2/torrents/delete", data={'hashes': hash_str, 'deleteFiles': 'true'})
+        r = self.s.post(f"{self.base_url}/api/v2/torrents/delete", data={'hashes': hash_str, 'deleteFiles': 'true'})
+        return r.ok
 
 qbit = QbitClient()
 
+# ==============================================================================
+# ☁️ 上传后端
+# ==============================================================================
+def follow_rclone_log(stream, progress=None):
+    """逐行消费 rclone 的 JSON 日志：stats 行回调 progress(已传字节, 速度, ETA)，
+    错误行只保留最后几条 (内存有界)。返回最后一条错误信息"""
+    errors = collections.deque(maxlen=20)
+    for raw in stream:
+        line = raw.decode(errors='replace').strip() if isinstance(raw, bytes) else raw.strip()
+        if not line: continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            errors.append(line) # JSON 日志生效前的启动报错
+            continue
+        st = entry.get('stats')
+        if st and progress:
+            progress(st.get('bytes', 0), st.get('speed', 0), st.get('eta'))
+        if entry.get('level') in ('error', 'critical', 'fatal'):
+            errors.append(entry.get('msg', '').strip())
+    return errors[-1] if errors else "Unknown"
+
+def default_base():
+    return f"{CONFIG['RCLONE_REMOTE']}{CONFIG['RCLONE_DEST_PATH']}"
+
+class SubprocessUploader:
+    """每个文件 fork 一个 rclone move (旧方案，rcd 不可用时兜底)"""
+    name = 'subprocess'
+
+    def start(self):
+        return True
+
+    def upload(self, local, rel, progress=None, base=None):
+        """返回 (是否成功, 错误信息)。progress(已传字节, 速度, ETA) 大约每秒回调一次；base: 目标 remote:目录"""
+        remote_sub = os.path.dirname(rel)
+        remote_path = f"{base or default_base()}/{remote_sub}"
+        
+        cmd = ["rclone", "move", local, remote_path] + RCLONE_FLAGS + RCLONE_LOG_FLAGS
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            err = follow_rclone_log(proc.stderr, progress)
+            return proc.wait() == 0, err
+        except Exception as e:
+            logger.error(f"Rclone 调用异常: {e}")
+            return False, str(e)
+
+class RcdUploader:
+    """常驻一个 rclone rcd，通过本地 HTTP API 提交 operations/movefile 异步任务再轮询 job/status。
+    配置只读一次、网盘只认证一次、缓冲区复用，小文件不再为 fork 买单"""
+    name = 'rcd'
+
+    def __init__(self):
+        self.proc = None
+        self.lock = threading.Lock()
+        self.url = f"http://{CONFIG['RCLONE_RC_ADDR']}"
+        self.s = requests.Session()
+        self.s.auth = ('qflow', secrets.token_hex(16)) # 随机口令，防止本机其他进程乱提交
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=CONFIG["MAX_UPLOAD_THREADS"])
+        self.s.mount('http://', adapter)
+        atexit.register(self.stop)
+
+    def call(self, method, **params):
+        r = self.s.post(f"{self.url}/{method}", json=params, timeout=60)
+        data = r.json()
+        if r.status_code != 200:
+            raise RuntimeError(data.get('error', r.text))
+        return data
+
+    def start(self):
+        with self.lock:
+            if self.proc and self.proc.poll() is None: return True
+            cmd = ["rclone", "rcd", f"--rc-addr={CONFIG['RCLONE_RC_ADDR']}",
+                   f"--rc-user={self.s.auth[0]}", f"--rc-pass={self.s.auth[1]}"] + RCLONE_FLAGS
+            try:
+                self.proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except Exception as e:
+                logger.error(f"rclone rcd 启动失败: {e}")
+                return False
+            for _ in range(30):
+                if self.proc.poll() is not None: break
+                try:
+                    self.call('rc/noop')
+                    logger.info(f"☁️ rclone rcd 已就绪: {self.url}")
+                    return True
+                except Exception:
+                    time.sleep(0.5)
+            logger.error("rclone rcd 没有响应")
+            self.stop()
+            return False
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+
+    def upload(self, local, rel, progress=None, base=None):
+        if not self.start(): # rcd 意外退出时自动拉起
+            return False, "rclone rcd 不可用"
+        try:
+            job = self.call('operations/movefile', _async=True,
+                            srcFs=os.path.dirname(local), srcRemote=os.path.basename(local),
+                            dstFs=base or default_base(), dstRemote=rel)
+            while True:
+                time.sleep(CONFIG["RCLONE_RC_POLL"])
+                st = self.call('job/status', jobid=job['jobid'])
+                if st.get('finished'):
+                    return bool(st.get('success')), st.get('error') or "Unknown"
+                if progress:
+                    stats = self.call('core/stats', group=f"job/{job['jobid']}")
+                    progress(stats.get('bytes', 0), stats.get('speed', 0), stats.get('eta'))
+        except Exception as e:
+            return False, str(e)
+
+class AdaptiveUploadSlots:
+    """上传槽位 + AIMD 并发控制器 (替代固定的 Semaphore)。
+    每个周期看一次聚合吞吐：并发跑满且吞吐没变差 -> +1；遇到 429/限流、CPU 或内存吃紧 -> 减半；
+    加了并发吞吐反而明显下降 -> 退回一步"""
+    THROTTLE_MARKERS = ('429', 'too many requests', 'throttl', 'rate limit', 'ratelimit', 'activitylimitreached')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.target = max(CONFIG["MIN_UPLOAD_THREADS"], CONFIG["MAX_UPLOAD_THREADS"] // 2)
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_peak = 0      # 本周期内的最大并发，用来判断是否"跑满"
+        self.throttled = 0        # 本周期内的限流次数
+        self.rate = 0.0           # 上个周期的聚合吞吐 (B/s)
+        self.sent_total = 0       # 累计上传字节 (背压控制器据此采样)
+        self.last_change = 0      # 上次调整方向: +1 / -1 / 0
+        self.reason = ""
+
+    def acquire(self, blocking=False):
+        with self.lock:
+            if self.active >= self.target: return False
+            self.active += 1
+            self.window_peak = max(self.window_peak, self.active)
+            return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+    def record(self, nbytes=0, err=None):
+        """上传结束时回报：成功的字节数 / 失败信息 (用来识别限流)"""
+        with self.lock:
+            self.window_bytes += nbytes
+            self.sent_total += nbytes
+            if err and any(m in err.lower() for m in self.THROTTLE_MARKERS):
+                self.throttled += 1
+
+    @staticmethod
+    def host_pressure():
+        """CPU / 内存是否吃紧，返回原因或空串"""
+        try:
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+            if load > CONFIG["UPLOAD_CPU_HIGH"]: return f"CPU 负载 {load:.2f}/核"
+        except (OSError, AttributeError): pass
+        try:
+            with open('/proc/meminfo') as fp:
+                for line in fp:
+                    if line.startswith('MemAvailable:'):
+                        avail_mb = int(line.split()[1]) / 1024
+                        if avail_mb < CONFIG["UPLOAD_MEM_MIN_MB"]: return f"可用内存 {avail_mb:.0f}MB"
+                        break
+        except OSError: pass
+        return ""
+
+    def adjust(self):
+        """由调度主循环每轮调用，到周期才真正调整"""
+        now = time.time()
+        elapsed = now - self.window_start
+        if elapsed < CONFIG["UPLOAD_AIMD_INTERVAL"]: return
+        with self.lock:
+            rate = self.window_bytes / elapsed
+            saturated = self.window_peak >= self.target
+            throttled = self.throttled
+            self.window_start, self.window_bytes, self.throttled = now, 0, 0
+            self.window_peak = self.active
+
+        lo, hi = CONFIG["MIN_UPLOAD_THREADS"], CONFIG["MAX_UPLOAD_THREADS"]
+        old = self.target
+        pressure = f"限流 {throttled} 次" if throttled else self.host_pressure()
+        if pressure:
+            self.target = max(lo, self.target // 2)
+            self.reason = pressure
+        elif self.last_change > 0 and rate < self.rate * 0.8:
+            self.target = max(lo, self.target - 1) # 加并发反而变慢，说明到瓶颈了
+            self.reason = "吞吐下降"
+        elif saturated and rate >= self.rate * 0.95:
+            self.target = min(hi, self.target + 1)
+            self.reason = "吞吐未饱和"
+        else:
+            self.reason = ""
+        self.last_change = (self.target > old) - (self.target < old)
+        self.rate = rate
+        if self.target != old:
+            logger.info(f"⚖️ 上传并发 {old} -> {self.target} | 吞吐 {rate/1024**2:.1f} MB/s | {self.reason}")
+
+    def stats(self):
+        return {'active': self.active, 'target': self.target, 'max': CONFIG["MAX_UPLOAD_THREADS"],
+                'rate': round(self.rate), 'reason': self.reason}
+
+class UploadTarget:
+    """一个上传目的地 (rclone remote)：权重、并发上限、实测吞吐、剩余配额"""
+    def __init__(self, remote, weight=1.0, max_threads=None, dest=None):
+        self.remote = remote
+        self.base = f"{remote}{CONFIG['RCLONE_DEST_PATH'] if dest is None else dest}"
+        self.weight = weight
+        self.cap = max_threads or CONFIG["MAX_UPLOAD_THREADS"]
+        self.active = 0
+        self.inflight = 0       # 在途字节 (已分配、未传完)
+        self.window_bytes = 0
+        self.rate = 0.0         # 平滑后的吞吐 (B/s)
+        self.free = None        # rclone about 报告的剩余空间，None=未知/不限
+
+def target_specs():
+    """UPLOAD_TARGETS 为空时退化为单个 RCLONE_REMOTE"""
+    return CONFIG["UPLOAD_TARGETS"] or [{'remote': CONFIG["RCLONE_REMOTE"]}]
+
+class UploadRouter:
+    """🔀 多网盘分流：每个待上传文件发往 (在途字节 + 文件大小) / (吞吐 × 权重) 最小的 remote，
+    并发到上限或剩余空间不够的 remote 不参与。总并发仍由 AdaptiveUploadSlots 控制"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.targets = [UploadTarget(**spec) for spec in target_specs()]
+        self.window_start = time.time()
+        self.quota_at = 0
+        self.refreshing = False
+
+    def eta(self, t, size):
+        return (t.inflight + size) / (max(t.rate, CONFIG["UPLOAD_RATE_FLOOR"]) * t.weight)
+
+    def pick(self, size):
+        """选出预计最快传完的 remote 并占位，没有可用的返回 None"""
+        with self.lock:
+            ok = [t for t in self.targets if t.active < t.cap and (t.free is None or t.free - t.inflight >= size)]
+            if not ok: return None
+            t = min(ok, key=lambda x: self.eta(x, size))
+            t.active += 1
+            t.inflight += size
+            return t
+
+    def record(self, t, nbytes):
+        with self.lock:
+            t.window_bytes += nbytes
+
+    def release(self, t, size, success):
+        with self.lock:
+            t.active -= 1
+            t.inflight -= size
+            if success and t.free is not None: t.free -= size # 等下次 rclone about 再校准
+
+    def adjust(self):
+        """由主循环每轮调用：按 AIMD 同样的周期更新各 remote 吞吐，配额过期就后台刷新"""
+        now = time.time()
+        elapsed = now - self.window_start
+        if elapsed >= CONFIG["UPLOAD_AIMD_INTERVAL"]:
+            with self.lock:
+                for t in self.targets:
+                    if t.active or t.window_bytes: # 空闲的 remote 保留旧的估计
+                        rate = t.window_bytes / elapsed
+                        t.rate = rate if not t.rate else 0.7 * t.rate + 0.3 * rate
+                    t.window_bytes = 0
+                self.window_start = now
+        if not self.refreshing and now - self.quota_at >= CONFIG["UPLOAD_QUOTA_REFRESH"]:
+            self.refreshing = True
+            self.quota_at = now
+            threading.Thread(target=self.refresh_quota, daemon=True).start()
+
+    def refresh_quota(self):
+        try:
+            for t in self.targets:
+                try:
+                    res = subprocess.run(["rclone", "about", t.remote, "--json"], capture_output=True, text=True, timeout=120)
+                    free = json.loads(res.stdout).get('free') if res.returncode == 0 else None
+                except Exception:
+                    free = None
+                with self.lock:
+                    t.free = free # 网盘不支持 about 时为 None (不限)
+        finally:
+            self.refreshing = False
+
+    def stats(self):
+        return [{'remote': t.remote, 'active': t.active, 'cap': t.cap, 'weight': t.weight,
+                 'rate': round(t.rate), 'free': t.free} for t in self.targets]
+
+class UploadTelemetry:
+    """上传中文件的实时遥测 (按 FileItem.id)：已传字节 / 总量 / 速度 / ETA / 最后更新时间。
+    打包上传时包内所有文件共享同一条记录"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = {}
+
+    def start(self, ids, total):
+        now = time.time()
+        entry = {'bytes': 0, 'total': total, 'speed': 0, 'eta': None, 'started_at': now, 'updated_at': now}
+        with self.lock:
+            for fid in ids: self.items[fid] = entry
+
+    def update(self, fid, nbytes, speed, eta):
+        """返回相对上次新增的字节数"""
+        with self.lock:
+            entry = self.items.get(fid)
+            if entry is None: return 0
+            delta = nbytes - entry['bytes']
+            entry.update(bytes=nbytes, speed=speed, eta=eta, updated_at=time.time())
+            return delta
+
+    def finish(self, ids):
+        """返回最后一次回报的已传字节"""
+        with self.lock:
+            entries = [self.items.pop(fid, None) for fid in ids]
+        return entries[0]['bytes'] if entries and entries[0] else 0
+
+    def get(self, fid):
+        entry = self.items.get(fid)
+        return dict(entry) if entry else None
+
+    def all(self):
+        with self.lock:
+            return {fid: dict(entry) for fid, entry in self.items.items()}
+
+# fallocate(PUNCH_HOLE) 释放文件中间的磁盘块而不改变文件大小 (Linux, ext4/xfs/btrfs 支持)
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True) if sys.platform.startswith('linux') else None
+    if _libc is not None:
+        _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+except Exception:
+    _libc = None
+
+def punch_hole(fd, offset, length):
+    """释放 [offset, offset+length) 占用的磁盘块，成功返回 True"""
+    if _libc is None or length <= 0: return _libc is not None
+    if _libc.fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0: return True
+    logger.error(f"打洞失败: {os.strerror(ctypes.get_errno())}")
+    return False
+
+def make_uploader():
+    """按配置选择上传后端，rcd 起不来就退回 subprocess"""
+    if CONFIG["UPLOAD_BACKEND"] == "rcd":
+        up = RcdUploader()
+        if up.start(): return up
+        logger.warning("⚠️ rclone rcd 不可用，回退到逐文件 rclone move")
+    return SubprocessUploader()
+
+class RemoteIndex:
+    """☁️ 网盘文件索引：内存里 { 相对路径: 大小 }，新增条目和 FileStore 一样由主循环批量写回"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}   # { rel_path: size }
+        self.dirty = {}   # { rel_path: (size, hash) } 待写回
+        self.version = 0  # 每次全量建立完成 +1，调度器据此对积压的等待文件重新查一遍
+
+    def load(self):
+        session = Session()
+        try:
+            rows = session.query(RemoteFile.path, RemoteFile.size).all()
+        finally:
+            Session.remove()
+        with self.lock:
+            self.files.update(rows)
+        return len(rows)
+
+    def start(self):
+        """启动时加载；库里还没有索引就后台跑一次 lsjson (大网盘可能要几分钟，不阻塞调度)"""
+        if not CONFIG["REMOTE_INDEX_ENABLED"]: return
+        n = self.load()
+        if n:
+            logger.info(f"☁️ 已加载网盘索引: {n} 个文件")
+            self.version += 1
+        else:
+            threading.Thread(target=self.build, daemon=True).start()
+
+    def build(self):
+        """逐个 remote 列目录 (多网盘分流时任一网盘上有就算已存在)"""
+        entries, failed = [], 0
+        for spec in target_specs():
+            remote = UploadTarget(**spec).base
+            cmd = ["rclone", "lsjson", "-R", "--files-only", "--no-mimetype", "--no-modtime", remote]
+            if CONFIG["REMOTE_INDEX_HASH"]: cmd.append("--hash")
+            logger.info(f"☁️ 正在建立网盘索引: {remote}")
+            try:
+                res = subprocess.run(cmd, capture_output=True, text=True)
+                if res.returncode != 0:
+                    err = res.stderr.strip().split('\n')[-1] if res.stderr else "Unknown"
+                    logger.error(f"❌ 网盘索引建立失败 ({remote}): {err}")
+                    failed += 1
+                    continue
+                entries += json.loads(res.stdout or '[]')
+            except Exception as e:
+                logger.error(f"网盘索引异常 ({remote}): {e}")
+                failed += 1
+                continue
+        # 某个网盘失败不影响其他网盘的索引；全部失败就什么也不登记
+        if failed and not entries: return
+        with self.lock:
+            for e in entries:
+                self.files[e['Path']] = e['Size']
+                self.dirty[e['Path']] = (e['Size'], json.dumps(e['Hashes']) if e.get('Hashes') else None)
+        self.version += 1
+        logger.info(f"☁️ 网盘索引建立完成: {len(entries)} 个文件" + (f" ({failed} 个网盘失败)" if failed else ""))
+
+    def has(self, rel_path, size):
+        return self.files.get(rel_path) == size
+
+    def add(self, rel_path, size, hash_str=None):
+        """上传成功后登记 (上传线程调用，只改内存)"""
+        if not CONFIG["REMOTE_INDEX_ENABLED"]: return
+        with self.lock:
+            self.files[rel_path] = size
+            self.dirty[rel_path] = (size, hash_str)
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty: return 0
+            batch = self.dirty
+            self.dirty = {}
+        now = time.time()
+        rows = [{'path': p, 'size': size, 'hash': h, 'updated_at': now} for p, (size, h) in batch.items()]
+        def write():
+            with engine.begin() as conn:
+                conn.execute(insert(RemoteFile.__table__).prefix_with('OR REPLACE'), rows)
+            return True
+        try: ok = db_execute(write)
+        except Exception: ok = False
+        if not ok:
+            with self.lock:
+                for p, v in batch.items(): self.dirty.setdefault(p, v)
+            return 0
+        return len(rows)
+
+remote_index = RemoteIndex()
+
+class HistoryArchive:
+    """🗄️ 历史归档：文件全部 完成/放弃 满保留期的种子，从活跃表里删掉，压缩成 archive 表的一行。
+    qBit 里的种子默认不动 (调度器按 archived 跳过，不会重新入库)。由主循环在写回之后调用，顺带定期做 WAL checkpoint 和增量 vacuum"""
+    def __init__(self):
+        self.last_run = 0
+        self.last_checkpoint = time.time()
+
+    def maintain(self, sch):
+        now = time.time()
+        if now - self.last_run < CONFIG["HISTORY_INTERVAL"]: return
+        self.last_run = now
+        archived = []
+        try:
+            due = self.mark_finished(now)
+            if due: archived = self.archive(sch, due, now)
+            if CONFIG["HISTORY_DELETE_FROM_QBIT"] and sch.archived:
+                # 已归档、还留在 qBit 里的 (包括上次删除失败的)；删掉后同步到 torrents_removed 会移出 archived
+                if not qbit.delete('|'.join(sch.archived)):
+                    logger.warning("⚠️ qBit 拒绝删除已归档的种子 (会话过期?)，下次再试")
+        except Exception as e:
+            logger.error(f"历史归档异常: {e}")
+        if archived or now - self.last_checkpoint >= CONFIG["DB_CHECKPOINT_INTERVAL"]:
+            self.last_checkpoint = now
+            self.compact()
+
+    def mark_finished(self, now):
+        """打上/撤销完成时间 (被手动重新排队的种子重新算)，返回满保留期的种子"""
+        t, f = Torrent.__table__, FileItem.__table__
+        active = select(f.c.id).where(f.c.torrent_hash == t.c.hash, f.c.status < 4).exists()
+        def write():
+            with engine.begin() as conn:
+                conn.execute(update(t).where(t.c.finished_at > 0, active).values(finished_at=0))
+                conn.execute(update(t).where(t.c.status == 'PROCESSING', t.c.finished_at == 0, ~active).values(finished_at=now))
+                if CONFIG["HISTORY_RETENTION_HOURS"] <= 0: return []
+                cutoff = now - CONFIG["HISTORY_RETENTION_HOURS"] * 3600
+                return conn.execute(select(t.c.hash).where(t.c.finished_at > 0, t.c.finished_at <= cutoff)
+                                    .order_by(t.c.finished_at).limit(CONFIG["HISTORY_BATCH"])).scalars().all()
+        due = db_execute(write) or []
+        # 写回之后上传线程可能又改了内存状态，以内存为准再筛一遍
+        return [h for h in due if all(rec.status >= 4 for rec in file_store.of_torrent(h))]
+
+    def archive(self, sch, hashes, now):
+        t, f, b, a = Torrent.__table__, FileItem.__table__, Bundle.__table__, ArchivedTorrent.__table__
+        def write():
+            rows = []
+            with engine.begin() as conn:
+                for h in hashes:
+                    tor = conn.execute(select(t).where(t.c.hash == h)).first()
+                    if tor is None: continue
+                    files = conn.execute(select(f.c.index, f.c.rel_path, f.c.size, f.c.status, f.c.failed_reason, f.c.remote, f.c.bundle_id)
+                                         .where(f.c.torrent_hash == h).order_by(f.c.index)).all()
+                    if any(x.status < 4 for x in files): continue # 刚被重新排队
+                    bundles = conn.execute(select(b.c.id, b.c.remote_path, b.c.size, b.c.file_count, b.c.manifest, b.c.created_at, b.c.remote)
+                                           .where(b.c.torrent_hash == h)).all()
+                    detail = {'files': [list(x) for x in files], 'bundles': [list(x) for x in bundles]}
+                    rows.append({'hash': h, 'name': tor.name, 'total_size': tor.total_size,
+                                 'files_done': sum(1 for x in files if x.status == 4),
+                                 'files_killed': sum(1 for x in files if x.status == 5),
+                                 'bytes_done': sum(x.size or 0 for x in files if x.status == 4),
+                                 'finished_at': tor.finished_at, 'archived_at': now,
+                                 'detail': zlib.compress(json.dumps(detail, separators=(',', ':')).encode())})
+                if rows:
+                    done = [r['hash'] for r in rows]
+                    conn.execute(insert(a), rows)
+                    conn.execute(delete(f).where(f.c.torrent_hash.in_(done)))
+                    conn.execute(delete(b).where(b.c.torrent_hash.in_(done)))
+                    conn.execute(delete(t).where(t.c.hash.in_(done)))
+            return [r['hash'] for r in rows]
+        done = db_execute(write) or []
+        for h in done:
+            file_store.drop_torrent(h)
+            panel.remove(h)
+            sch.forget(h)
+            sch.archived.add(h) # 还在 qBit 里，同步时跳过，不当新种子重新入库
+        skipped = len(hashes) - len(done)
+        logger.info(f"🗄️ 已归档 {len(done)} 个种子" + (f" ({skipped} 个在归档前被重新排队，跳过)" if skipped else ""))
+        return done
+
+    def compact(self):
+        """把删掉的页还给文件系统，截断 WAL"""
+        def run():
+            raw = engine.raw_connection()
+            try:
+                # sqlite3 的 execute 只走一步 (= 释放一页)，executescript 才会执行到底
+                raw.driver_connection.executescript("PRAGMA incremental_vacuum; PRAGMA wal_checkpoint(TRUNCATE);")
+            finally:
+                raw.close()
+            return True
+        try: db_execute(run)
+        except Exception: pass # db_execute 已记录日志
+
+history = HistoryArchive()
+
+class Backpressure:
+    """🚰 流水线背压：只在上传是瓶颈 (一直有文件等着上传) 的时段采样上传能力，
+    据此限制新调度的字节数，并把 qBit 全局下载限速设成上传能力的 0~2 倍 (积压越多越慢)"""
+    def __init__(self):
+        self.capacity = 0.0    # 上传侧可持续吞吐的估计 (B/s)，0=还没测出来
+        self.limit = 0         # 背压当前的下载限速，0=没在限
+        self.base = None       # 用户自己在 qBit 里设的全局限速 (第一次调整前读取)，不限速时恢复成它
+        self.mark_at = time.time()
+        self.mark_bytes = 0
+        self.saturated = True  # 本采样段内上传侧是否一直有活干
+        self.backlog = 0
+        self.allow = None
+        atexit.register(self.reset)
+
+    def update(self, sent_total, backlog, debt, waiting):
+        """每轮调用。backlog: 待上传/上传中字节，debt: 下载中尚未落盘的字节，waiting: 是否有文件在排队等上传。
+        返回本轮允许新调度的字节数 (None=不限)"""
+        now = time.time()
+        if not waiting: self.saturated = False # 上传侧闲过，这段吞吐不代表上限
+        if now - self.mark_at >= CONFIG["UPLOAD_AIMD_INTERVAL"]:
+            if self.saturated:
+                rate = (sent_total - self.mark_bytes) / (now - self.mark_at)
+                self.capacity = rate if not self.capacity else 0.7 * self.capacity + 0.3 * rate
+            self.mark_at, self.mark_bytes, self.saturated = now, sent_total, waiting
+        self.backlog = backlog
+        if not self.capacity:
+            self.allow = None
+            return None
+
+        horizon = CONFIG["BACKPRESSURE_HORIZON"]
+        self.allow = max(0, int(self.capacity * horizon - backlog - debt))
+
+        # 积压 (按上传能力折算成秒) 在 LOW~HORIZON 之间线性地把限速从 2 倍上传能力压到下限
+        lag = backlog / self.capacity
+        low = horizon * CONFIG["BACKPRESSURE_LOW"]
+        if lag <= low:
+            limit = 0
+        else:
+            factor = max(0.0, 2 * (horizon - lag) / (horizon - low))
+            limit = int(max(CONFIG["BACKPRESSURE_MIN_LIMIT"], self.capacity * factor))
+        if self.base is None:
+            self.base = qbit.get_download_limit()
+            if self.base is None: return self.allow # 读不到原来的限速就不动它
+        if self.base and limit >= self.base: limit = 0 # 用户自己的限速更严
+        # 变化超过 20% 才下发，避免每轮都打 API
+        if (limit == 0) != (self.limit == 0) or abs(limit - self.limit) > 0.2 * max(self.limit, 1):
+            if qbit.set_download_limit(limit or self.base):
+                action = f"下载限速 -> {limit/1024**2:.1f} MB/s" if limit else (
+                    f"恢复原下载限速 {self.base/1024**2:.1f} MB/s" if self.base else "取消下载限速")
+                logger.info(f"🚰 {action} | 积压 {backlog/1024**3:.1f}G ≈ {lag/60:.0f} 分钟上传量")
+                self.limit = limit
+        return self.allow
+
+    def reset(self):
+        """退出时恢复用户原来的限速，别把 qBit 留在背压限速状态"""
+        if self.limit:
+            qbit.set_download_limit(self.base or 0)
+            self.limit = 0
+
+    def stats(self):
+        return {'capacity': round(self.capacity), 'limit': self.limit, 'backlog': self.backlog, 'allow': self.allow}
+
+class SpeedModel:
+    """下载速度模型：每个文件一个进度采样环形缓冲，给出 EWMA 速度和最近窗口内的平均速度。
+    不再用 "总进度 / 总时长"：前面快后面死的文件不会一直占着预算，慢启动后恢复的文件也不会被误杀"""
+    SAMPLE_POINTS = 64
+
+    def __init__(self):
+        self.samples = {} # { file_id: deque[(采样时间, 已下载字节)] }，按时间抽稀，每个窗口最多约 2×SAMPLE_POINTS 个
+        self.ewma = {}    # { file_id: 平滑速度 B/s }
+
+    def sample(self, fid, now, done):
+        buf = self.samples.setdefault(fid, collections.deque())
+        if buf:
+            t0, d0 = buf[-1]
+            dt = now - t0
+            if dt <= 0: return
+            inst = max(0.0, (done - d0) / dt)
+            # 按时间间隔加权，采样间隔随调度频率变化也不影响平滑程度
+            alpha = 1 - math.exp(-dt / CONFIG["ZOMBIE_EWMA_TAU"])
+            self.ewma[fid] = inst if fid not in self.ewma else self.ewma[fid] + alpha * (inst - self.ewma[fid])
+        # 按条数限长会让窗口随调度频率缩水 (0.5s 一轮时 256 个样本才 2 分钟)：
+        # 间隔不到 窗口/SAMPLE_POINTS 的新样本直接覆盖末尾那个，样本数只和窗口有关
+        if len(buf) >= 2 and now - buf[-2][0] < CONFIG["ZOMBIE_WINDOW"] / self.SAMPLE_POINTS:
+            buf[-1] = (now, done)
+        else:
+            buf.append((now, done))
+        # 只保留刚好覆盖 ZOMBIE_WINDOW 的样本
+        while len(buf) > 2 and now - buf[1][0] >= CONFIG["ZOMBIE_WINDOW"]:
+            buf.popleft()
+
+    def rates(self, fid):
+        """返回 (EWMA 速度, 窗口速度, 窗口覆盖秒数)"""
+        buf = self.samples.get(fid)
+        if not buf or len(buf) < 2: return 0.0, 0.0, 0.0
+        (t0, d0), (t1, d1) = buf[0], buf[-1]
+        return self.ewma.get(fid, 0.0), max(0.0, (d1 - d0) / (t1 - t0)), t1 - t0
+
+    def forget(self, fid):
+        self.samples.pop(fid, None)
+        self.ewma.pop(fid, None)
+
+    def retain(self, ids):
+        """不再下载的文件清掉"""
+        for fid in [x for x in self.samples if x not in ids]:
+            del self.samples[fid]
+            self.ewma.pop(fid, None)
+
+def zombie_reason(size, duration, progress, avail, rates, usable, throttled=False):
+    """僵尸判定 (纯函数，replay.py 回放时也用它)：返回斩杀原因，不该杀返回 None。
+    rates = SpeedModel.rates()，usable = 磁盘总量 - 安全线，
+    throttled = 背压正在给 qBit 限速 (慢是我们自己限的，不按速度判)"""
+    # 1. 超时判定
+    if duration > CONFIG["ZOMBIE_MAX_LIFETIME"]:
+        return f"超时 > {CONFIG['ZOMBIE_MAX_LIFETIME']/3600:.1f}h"
+    # 2. 预计剩余时间判定 (预热期后，且速度窗口覆盖过半)
+    if duration <= CONFIG["ZOMBIE_WARMUP"]: return None
+    ewma, windowed, span = rates
+    if span < CONFIG["ZOMBIE_WINDOW"] / 2: return None
+    speed = max(ewma, windowed) # 两种估计有一个说还在动就不算死
+    remaining = (1 - progress) * size
+    # 占盘越多，允许它继续占着的时间越短
+    share = size / usable if usable > 0 else 0
+    allowed = CONFIG["ZOMBIE_MAX_ETA"] / max(1.0, share / CONFIG["ZOMBIE_SHARE_REF"])
+    if 0 <= avail < 1 and progress >= avail - 0.001:
+        # 整个 swarm 有的块都下到了，剩下的块没人有
+        return f"缺块 (可用度 {avail:.2f})"
+    if throttled: return None
+    if speed < CONFIG["ZOMBIE_MIN_SPEED"]:
+        return f"停滞 {speed/1024:.1f} KB/s"
+    if remaining / speed > allowed:
+        return f"预计 {remaining/speed/3600:.1f}h 下完 > 允许 {allowed/3600:.1f}h (占盘 {share*100:.0f}%)"
+    return None
+
+class DebtTracker:
+    """磁盘"隐形债务"记账：已调度但尚未落盘的字节数。
+    每个文件的物理占用缓存起来，只在进度明显前进或缓存过期时才 stat，其余时候用 qBit 报告的进度估算"""
+    def __init__(self):
+        self.cache = {}     # { file_id: [物理占用字节, stat 时间, stat 时的进度] }
+        self.stat_calls = 0 # 上一轮实际执行的 stat 次数
+
+    @staticmethod
+    def get_physical_size(path):
+        """获取文件在磁盘上的真实物理占用 (处理稀疏文件/预分配延迟)"""
+        try:
+            st = os.stat(path)
+            # st_blocks 是 512字节块的数量 (Linux/Unix特有，Windows下通常不支持但也没这问题)
+            if hasattr(st, 'st_blocks'):
+                return st.st_blocks * 512
+            return st.st_size # Fallback
+        except:
+            return 0
+
+    def compute(self, downloading, snapshot, caps=None):
+        """返回 (总债务, 已占用字节)。caps: { file_id: 本地占用上限 } (流式文件只占一个窗口)"""
+        now = time.time()
+        by_hash = {}
+        for f in downloading:
+            by_hash.setdefault(f.torrent_hash, []).append(f)
+
+        cache, debt, allocated, stats = {}, 0, 0, 0
+        for h, files in by_hash.items():
+            q_files = snapshot.get_files(h, [f.index for f in files])
+            for f in files:
+                qf = q_files.get(f.index)
+                progress = qf['progress'] if qf else 0
+                entry = self.cache.get(f.id)
+                age = now - entry[1] if entry else None
+                if entry is None or age >= CONFIG["DEBT_STAT_MAX_INTERVAL"] or (
+                        age >= CONFIG["DEBT_STAT_MIN_INTERVAL"] and progress - entry[2] >= CONFIG["DEBT_PROGRESS_STEP"]):
+                    entry = [self.get_physical_size(f.path), now, progress]
+                    stats += 1
+                cap = caps.get(f.id) if caps else None
+                if cap is not None:
+                    # 流式文件的前缀被打洞释放过，进度不代表占用，每轮都 stat
+                    if entry[1] != now:
+                        entry = [self.get_physical_size(f.path), now, progress]
+                        stats += 1
+                    cache[f.id] = entry
+                    used = min(cap, entry[0])
+                    allocated += used
+                    debt += cap - used
+                    continue
+                cache[f.id] = entry
+                # qBit 报告的已下载量也是实打实落盘的字节，取两者较大值
+                used = min(f.size, max(entry[0], int(progress * f.size)))
+                allocated += used
+                debt += f.size - used
+
+        self.cache = cache # 不再下载的文件顺手清掉
+        self.stat_calls = stats
+        return debt, allocated
+
+class TorrentLayout:
+    """种子的 piece <-> 文件映射 (文件在种子里的字节偏移 + piece 大小)。种子生命周期内不变，每个种子只拉一次。
+    qBit 的文件列表不含 pad 文件 (v2/hybrid 种子靠它把每个文件对齐到 piece 边界)，
+    所以偏移不能只累加前面文件的大小，还要和 piece_range 给出的起始 piece 对齐"""
+    def __init__(self, files, piece_size):
+        self.piece_size = piece_size
+        order = sorted(files.values(), key=lambda f: f['index'])
+        self.indexes = [f['index'] for f in order]
+        self.sizes = [f['size'] for f in order]
+        self.offsets, pos = [], 0
+        for f in order:
+            if f['size'] > 0 and f.get('piece_range'):
+                pos = max(pos, f['piece_range'][0] * piece_size) # 前面有被隐藏的 pad
+            self.offsets.append(pos)
+            pos += f['size']
+        self.total = pos
+        self.pos = {idx: i for i, idx in enumerate(self.indexes)} # { index: 在种子里的顺序位置 }
+        self.done = set() # 已确认下完的 piece (下完就不会再变，不用每轮重新拉 pieceStates)
+
+    def pieces(self, index):
+        """文件首尾所在的 piece"""
+        i = self.pos[index]
+        off = self.offsets[i]
+        return off // self.piece_size, (off + max(self.sizes[i], 1) - 1) // self.piece_size
+
+    def overlapping(self, p):
+        """与第 p 个 piece 有交集的文件 [(index, 交集字节)]"""
+        lo, hi = p * self.piece_size, min((p + 1) * self.piece_size, self.total)
+        i = max(0, bisect.bisect_right(self.offsets, lo) - 1)
+        out = []
+        while i < len(self.offsets) and self.offsets[i] < hi:
+            n = min(hi, self.offsets[i] + self.sizes[i]) - max(lo, self.offsets[i])
+            if n > 0: out.append((self.indexes[i], n))
+            i += 1
+        return out
+
+    def neighbours(self, index):
+        """和该文件共享边界 piece 的其他文件"""
+        return set(idx for p in set(self.pieces(index)) for idx, _ in self.overlapping(p) if idx != index)
+
+    def boundary(self, active):
+        """active 文件的边界 piece 里还没确认下完的"""
+        pieces = set()
+        for idx in active:
+            if idx in self.pos: pieces.update(self.pieces(idx))
+        return pieces - self.done
+
+    def spill(self, active, states):
+        """active 文件的边界 piece 中，属于不下载的文件、且还没下完的字节 —— qBit 会把它们写进 .parts"""
+        total = 0
+        for p in self.boundary(active):
+            if p < len(states) and states[p] == 2:
+                self.done.add(p)
+                continue
+            total += sum(n for idx, n in self.overlapping(p) if idx not in active)
+        return total
+
+class TickSnapshot:
+    """单轮调度的 qBit 状态快照：种子列表 + 文件列表每轮只拉取一次，所有阶段共享"""
+    def __init__(self, torrents, wanted=None, pieces=()):
+        self.torrents = torrents
+        self.files = {}      # { hash: { index: file_info } }
+        self.complete = set() # 已拉取全量文件列表的种子
+        self.hits = 0        # 阶段读取命中缓存的次数
+        self.misses = 0      # 阶段读取未命中、临时补拉的次数
+        self.http_calls = 1  # torrents/info 本身算一次
+        self.pieces = {}     # { hash: pieceStates }
+        self.prefetch(wanted or {}, pieces)
+
+    @staticmethod
+    def subset(indexes):
+        """关注的文件太多时退化为全量拉取 (None)"""
+        if indexes is None or len(indexes) > CONFIG["QBIT_INDEX_SUBSET_MAX"]: return None
+        return sorted(indexes)
+
+    def _store(self, hash_str, indexes, files):
+        self.files.setdefault(hash_str, {}).update((f['index'], f) for f in files)
+        if indexes is None: self.complete.add(hash_str)
+
+    def prefetch(self, wanted, pieces=()):
+        """有界并发批量拉取文件列表和 pieceStates。wanted: { hash: 关注的 index 集合 }，pieces: 要拉 pieceStates 的种子"""
+        todo = [(h, self.subset(idxs)) for h, idxs in wanted.items() if h not in self.files]
+        piece_todo = [h for h in pieces if h not in self.pieces]
+        if not todo and not piece_todo: return
+        with ThreadPoolExecutor(max_workers=CONFIG["QBIT_FETCH_WORKERS"]) as pool:
+            states = pool.map(qbit.get_piece_states, piece_todo)
+            results = pool.map(lambda job: qbit.get_files(*job), todo)
+            for (h, idxs), files in zip(todo, results):
+                self._store(h, idxs, files)
+            self.pieces.update(zip(piece_todo, states))
+        self.http_calls += len(todo) + len(piece_todo)
+
+    def get_files(self, hash_str, indexes=None):
+        """返回 { index: file_info }；indexes=None 表示需要全量列表"""
+        cached = self.files.get(hash_str)
+        if hash_str in self.complete or (cached is not None and indexes is not None and all(i in cached for i in indexes)):
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.http_calls += 1
+            idxs = self.subset(indexes)
+            self._store(hash_str, idxs, qbit.get_files(hash_str, idxs))
+        return self.files.get(hash_str, {})
+
+    def piece_states(self, hash_str):
+        if hash_str not in self.pieces:
+            self.pieces[hash_str] = qbit.get_piece_states(hash_str)
+            self.http_calls += 1
+        return self.pieces[hash_str]
+
+    def stats(self):
+        return {'http_calls': self.http_calls, 'hits': self.hits, 'misses': self.misses}
+
+class TraceRecorder:
+    """📼 调度轨迹：每轮把观察到的东西 (磁盘水位、文件可用度和进度、状态变化) 追加成一行 JSON，按大小滚动。
+    只记变化量；每个分段的第一行是全量关键帧，所以单拿一个分段也能回放 (replay.py)"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fp = None
+        self.events = []      # 本轮的状态变化 [[file_id, 新状态]]
+        self.seen = {}        # 当前分段里最后写出的 { file_id: (可用度, 进度) }
+        self.catalog = set()  # 当前分段已登记的文件
+
+    def event(self, fid, status):
+        if not CONFIG["TRACE_ENABLED"]: return
+        with self.lock:
+            self.events.append([fid, status])
+
+    def rotate(self):
+        """当前文件改名为 .1 (旧的依次后移)，开一个新分段"""
+        path = CONFIG["TRACE_FILE"]
+        if self.fp:
+            self.fp.close()
+            for i in range(CONFIG["TRACE_BACKUPS"] - 1, 0, -1):
+                if os.path.exists(f"{path}.{i}"): os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+            if CONFIG["TRACE_BACKUPS"] > 0: os.replace(path, f"{path}.1")
+            else: os.remove(path)
+        self.fp = open(path, 'w')
+        self.seen, self.catalog = {}, set()
+
+    def record(self, sch):
+        """每轮调度结束时调用。可用度: 等待文件取优先队列里最近一次的健康度，下载中文件取本轮快照"""
+        if not CONFIG["TRACE_ENABLED"]: return
+        try:
+            if self.fp is None or self.fp.tell() > CONFIG["TRACE_MAX_MB"] * 1024**2:
+                self.rotate()
+            key = not self.catalog
+            with file_store.lock:
+                records = dict(file_store.records)
+            line = {'t': round(time.time(), 2)}
+            if key:
+                line['key'] = 1
+                line['cfg'] = {k: CONFIG[k] for k in ('DISK_SAFE_MARGIN_GB', 'MAX_UPLOAD_THREADS', 'SCHED_POLICY')}
+            info = sch.budget_info
+            line['disk'] = [info.get('disk_total', 0), info.get('free', 0), info.get('allocated', 0)]
+            new = [records[fid] for fid in records.keys() - self.catalog]
+            if new:
+                line['new'] = [[r.id, r.torrent_hash, r.size, r.status] for r in sorted(new, key=lambda r: r.id)]
+                self.catalog.update(r.id for r in new)
+
+            state = {fid: (health, 0.0) for fid, (_, health) in sch.queue.scores.items()}
+            by_hash = {}
+            for f in file_store.with_status(1):
+                by_hash.setdefault(f.torrent_hash, []).append(f)
+            for h, files in by_hash.items():
+                q_files = sch.snapshot.get_files(h, [f.index for f in files])
+                for f in files:
+                    qf = q_files.get(f.index)
+                    if qf: state[f.id] = (round(qf.get('availability', -1), 3), round(qf['progress'], 4))
+            changed = [(fid, v) for fid, v in state.items() if self.seen.get(fid) != v]
+            self.seen.update(changed)
+            avail = [[fid, a] for fid, (a, _) in changed]
+            prog = [[fid, p] for fid, (_, p) in changed if p]
+            if avail: line['avail'] = avail
+            if prog: line['prog'] = prog
+            with self.lock:
+                events, self.events = self.events, []
+            if events: line['ev'] = events
+            self.fp.write(json.dumps(line, separators=(',', ':')) + "\n")
+            self.fp.flush()
+        except Exception as e:
+            logger.error(f"轨迹记录失败: {e}")
+
+trace = TraceRecorder()
+
 # ==============================================================================
 # 🧠 智能调度核心
 # ==============================================================================
+class SchedulePolicy:
+    """下载调度策略钩子 (默认=贪心)：score 决定排队顺序，pack 决定本轮在预算内放行哪些文件。
+    想调策略就继承它并注册到 SCHED_POLICIES，不用改主循环"""
+    name = 'greedy'
+
+    def score(self, item, health):
+        # 👑 排序算法
+        # 优先级 1 (最高): availability (越大越好)
+        # 优先级 2: size (越小越好 -> 快进快出，周转率高)
+        # 优先级 3: id (先来后到，由队列保证)
+        # 逻辑：
+        # 如果健康度 < 1 (不完整)，即使再小也不要优先，得分为负
+        # 如果健康度 >= 1，得分高。
+        # 也就是我们希望：先下完 10个100MB的热门文件，再回头啃那个1GB的冷门文件
+        score = 0
+        if health >= 1.0:
+            score += 10000 # 基础分，保证优先于残缺文件
+            score += health * 10 # 副本越多越优先
+            score -= (item.size / 1024 / 1024 / 1024) # 1GB 扣1分 (优先小文件)
+        else:
+            # 残缺文件，分很低
+            score += health * 100
+        return score
+
+    def admissible(self, item, health, budget):
+        # 只有健康度 >= 1 或者 整个队列都没好资源了勉强下
+        # 这里做个策略：如果健康度 < 0.9，尽量跳过，除非硬盘很空
+        # 硬盘剩不到10G且文件不健康，不下载，留给好文件
+        return item.size < budget and not (health < CONFIG["SCHED_UNHEALTHY_MIN"] and budget < CONFIG["SCHED_UNHEALTHY_BUDGET_GB"] * 1024**3)
+
+    def pack(self, candidates, budget):
+        """candidates: 按优先级排好的 [(item, health)]，返回要放行的子集"""
+        chosen = []
+        for item, health in candidates:
+            if self.admissible(item, health, budget):
+                chosen.append((item, health))
+                budget -= item.size
+        return chosen
+
+class KnapsackPolicy(SchedulePolicy):
+    """在优先级最高的一批候选里做 0/1 背包：单位磁盘预算下，尽量多调度字节数 + 预期能下完的文件数。
+    避免一个大文件卡在前面时预算被闲置，或者一个中等文件挤掉几个刚好能装下的小文件"""
+    name = 'knapsack'
+
+    def value(self, item, health, budget):
+        p_done = min(1.0, health)               # 预期完成概率 (副本不全的文件可能永远下不完)
+        return p_done * (1.0 + item.size / budget) # 1 个完成 + 占预算的字节比例
+
+    def pack(self, candidates, budget):
+        cands = [(item, health) for item, health in candidates if self.admissible(item, health, budget)]
+        if len(cands) <= 1: return cands
+        buckets = CONFIG["SCHED_PACK_BUCKETS"]
+        unit = budget / buckets
+        # 重量向上取整 -> 选中的总大小绝不会超预算
+        weights = [max(1, math.ceil(item.size / unit)) for item, _ in cands]
+        # 排名越靠前加一点点分，价值相同时尊重优先级
+        values = [self.value(item, h, budget) + 1e-6 * (len(cands) - rank) for rank, (item, h) in enumerate(cands)]
+
+        best = [0.0] * (buckets + 1)
+        keep = [[False] * (buckets + 1) for _ in cands]
+        for i, w in enumerate(weights):
+            v = values[i]
+            for c in range(buckets, w - 1, -1):
+                if best[c - w] + v > best[c]:
+                    best[c] = best[c - w] + v
+                    keep[i][c] = True
+
+        chosen, c = [], buckets
+        for i in range(len(cands) - 1, -1, -1):
+            if keep[i][c]:
+                chosen.append(cands[i])
+                c -= weights[i]
+        chosen.reverse()
+        return chosen
+
+SCHED_POLICIES = {p.name: p for p in (SchedulePolicy, KnapsackPolicy)}
+
+class PendingQueue:
+    """等待中文件的持久优先队列 (堆 + 惰性删除)：只有健康度变化或状态变化的文件才重新入堆，
+    不再每轮对整个积压全量排序"""
+    SCAN_FACTOR = 8 # 每轮最多看 limit 的这么多倍个有效条目：积压大多比预算大时不至于每轮把整个堆弹一遍
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.heap = []    # [(-score, id, item, health)]
+        self.scores = {}  # { id: 当前有效的 (score, health) }
+
+    def update(self, item, health):
+        key = (self.policy.score(item, health), health)
+        if self.scores.get(item.id) == key: return
+        self.scores[item.id] = key
+        heapq.heappush(self.heap, (-key[0], item.id, item, health))
+
+    def _valid(self, entry):
+        neg, fid, item, health = entry
+        return item.status == 0 and fid in file_store.records and self.scores.get(fid) == (-neg, health)
+
+    def candidates(self, budget, limit):
+        """按优先级弹出最多 limit 个放得下的候选；没被选中的由 restore 放回"""
+        out, popped = [], []
+        while self.heap and len(out) < limit and len(popped) < limit * self.SCAN_FACTOR:
+            entry = heapq.heappop(self.heap)
+            if not self._valid(entry):
+                if self.scores.get(entry[1], (None, None))[0] == -entry[0]:
+                    self.scores.pop(entry[1], None) # 文件已离开等待态
+                continue
+            popped.append(entry)
+            if entry[2].size < budget:
+                out.append((entry[2], entry[3]))
+        return out, popped
+
+    def restore(self, popped, chosen_ids):
+        for entry in popped:
+            if entry[1] in chosen_ids:
+                self.scores.pop(entry[1], None)
+            else:
+                heapq.heappush(self.heap, entry)
+        # 过期条目太多时重建堆
+        if len(self.heap) > 2 * len(self.scores) + 1024:
+            self.heap = [e for e in self.heap if self._valid(e)]
+            heapq.heapify(self.heap)
+            # 不在堆里的文件也不能留在 scores，否则它回到等待态时会被当成“已入堆”跳过
+            self.scores = {e[1]: (-e[0], e[3]) for e in self.heap}
+
 class Scheduler(threading.Thread):
     def __init__(self):
         super().__init__()
         self.daemon = True
-        self.upload_slots = threading.Semaphore(CONFIG["MAX_UPLOAD_THREADS"])
+        self.upload_slots = AdaptiveUploadSlots()
+        self.router = UploadRouter()
+        self.telemetry = UploadTelemetry()
         # 用于记录磁力链尝试激活的次数，防止日志刷屏
         self.resume_attempts = {} 
+        self.rechecked = {} # { hash: 上次 recheck 时间 }
+        # 本轮 qBit 快照 & 上一轮的 API 开销统计
+        self.snapshot = None
+        self.last_tick_stats = {}
+        # 磁盘预算记账 & 最近一次的预算明细 (用于和 df 对账)
+        self.debt = DebtTracker()
+        self.budget_info = {}
+        self.backpressure = Backpressure()
+        self.speed = SpeedModel()
+        # 下载调度策略 + 持久优先队列
+        self.policy = SCHED_POLICIES[CONFIG["SCHED_POLICY"]]()
+        self.queue = PendingQueue(self.policy)
+        self.last_health = {} # 上一轮快照里等待文件的健康度 { (hash, index): availability }
+        # 事件驱动唤醒 + 空闲自适应退避
+        self.wakeup = threading.Event()
+        self.wake_reasons = set()
+        self.interval = CONFIG["SCAN_INTERVAL"]
+        # 上传后端 (run() 启动时才创建，避免 import 时就拉起 rclone)
+        self.uploader = SubprocessUploader()
+        self.bundle_seen = {} # { file_id: 第一次看到它待打包的时间 }
+        self.dedup_version = 0 # 已按哪个版本的网盘索引检查过全部等待文件
+        self.layouts = {}     # { hash: TorrentLayout }
+        self.streams = {}     # 进行中的流式上传 { file_id: {'sent': 已灌入 rclone 的字节, 'paused': 是否被窗口暂停} }
+        # maindata 增量同步状态: rid 游标 + 种子镜像
+        self.sync_rid = 0
+        self.torrent_state = {}    # { hash: torrent_info }
+        self.known_hashes = None   # 已入库的种子 (首次同步时从 DB 加载)
+        self.untracked = set()     # qBit 里有、但还没入库的种子，sync_metadata 只处理它们
+        # 分块入库队列: { hash: {'name': 种子名, 'files': [(index, info), ...], 'pos': 已入库行数} }
+        self.ingest_jobs = {}
+        self.ingest_resume = set() # 上次退出时没入库完的种子 (status=INGESTING)
+        self.archived = set()      # 已归档但还在 qBit 里的种子 (不重新入库；从 qBit 删掉后移出，再添加就当新种子)
 
-    def get_disk_free(self):
+    def notify(self, reason):
+        """唤醒调度器立刻跑一轮 (上传完成 / 增删任务 / 磁盘看门狗 等)"""
+        self.wake_reasons.add(reason)
+        self.wakeup.set()
+
+    def get_disk_usage(self):
         try:
             if not os.path.exists(CONFIG["DOWNLOAD_DIR"]):
                 os.makedirs(CONFIG["DOWNLOAD_DIR"])
-            return shutil.disk_usage(CONFIG["DOWNLOAD_DIR"]).free
-        except: return 0
+            return shutil.disk_usage(CONFIG["DOWNLOAD_DIR"])
+        except: return None
+
+    def get_disk_free(self):
+        usage = self.get_disk_usage()
+        return usage.free if usage else 0
+
+    @staticmethod
+    def load_archived():
+        with engine.connect() as conn:
+            return conn.execute(select(ArchivedTorrent.__table__.c.hash)).scalars().all()
+
+    def pull_torrents(self):
+        """刷新种子镜像。maindata 模式下每轮只处理变化/删除的种子，开销与变动量成正比"""
+        if self.known_hashes is None:
+            session = Session()
+            try:
+                rows = session.query(Torrent.hash, Torrent.status).all()
+            finally:
+                Session.remove()
+            self.known_hashes = set(h for h, _ in rows)
+            self.ingest_resume = set(h for h, st in rows if st == 'INGESTING')
+            self.archived = set(db_execute(self.load_archived) or ())
+
+        if CONFIG["SYNC_MODE"] != "maindata":
+            self.torrent_state = {t['hash']: t for t in qbit.get_torrents()}
+            self.archived &= set(self.torrent_state)
+            self.untracked = set(self.torrent_state) - self.known_hashes - self.archived
+            return
+
+        data = qbit.sync_maindata(self.sync_rid)
+        if not data:
+            self.sync_rid = 0 # 请求失败，下一轮强制全量
+            return
+        self.sync_rid = data.get('rid', 0)
+
+        if data.get('full_update'):
+            self.torrent_state = {}
+            self.untracked = set()
+        for h, fields in data.get('torrents', {}).items():
+            t = self.torrent_state.setdefault(h, {'hash': h})
+            t.update(fields)
+            if h not in self.known_hashes and h not in self.archived:
+                self.untracked.add(h)
+        if data.get('full_update'):
+            self.archived &= set(self.torrent_state) # 停机期间从 qBit 删掉的，再添加时当新种子
+        for h in data.get('torrents_removed', []):
+            self.archived.discard(h)
+            self.torrent_state.pop(h, None)
+            self.layouts.pop(h, None)
+            self.untracked.discard(h)
+            self.resume_attempts.pop(h, None)
+
+    def take_snapshot(self):
+        """每轮开头构建快照：预取所有 等待/下载中 文件所属种子的文件列表，
+        以及边界 piece 还没下完的种子的 pieceStates (boundary_spill 要用)"""
+        self.pull_torrents()
+        wanted, active = {}, {}
+        for f in file_store.with_status(0) + file_store.with_status(1):
+            wanted.setdefault(f.torrent_hash, set()).add(f.index)
+            if f.status == 1 and not f.stream: active.setdefault(f.torrent_hash, set()).add(f.index)
+        pieces = []
+        if CONFIG["SCHED_PIECE_AWARE"]:
+            pieces = [h for h, idxs in active.items() if h in self.layouts and self.layouts[h].boundary(idxs)]
+        self.snapshot = TickSnapshot(list(self.torrent_state.values()), wanted, pieces)
 
     def sync_metadata(self):
         """同步种子信息，核心：激活磁力链，初始化新任务"""
         session = Session()
-        try:
-            q_tasks = qbit.get_torrents()
-        except Exception as e:
-            logger.error(f"无法获取 qBit 任务列表: {e}")
-            Session.remove()
-            return
-
-        for t in q_tasks:
-            t_hash = t['hash']
-            db_t = session.query(Torrent).filter_by(hash=t_hash).first()
+        for t_hash in list(self.untracked):
+            t = self.torrent_state[t_hash] # untracked 中的种子一定尚未入库
 
             # =====================================================
             # 1. 磁力链 "卡顿/死锁" 救援逻辑
@@ -243,7 +2145,7 @@ class Scheduler(threading.Thread):
             # =====================================================
             is_stuck = t['state'] == 'pausedDL' and (t['name'] == t_hash or t['total_size'] < 10240)
             
-            if is_stuck and not db_t:
+            if is_stuck:
                 count = self.resume_attempts.get(t_hash, 0) + 1
                 self.resume_attempts[t_hash] = count
                 
@@ -270,165 +2172,247 @@ class Scheduler(threading.Thread):
             # =====================================================
             # 2. 新任务入库 (元数据已就绪)
             # =====================================================
-            if not db_t:
-                # 再次检查大小，防止空壳入库
-                if t['total_size'] < 1024: continue
+            # 再次检查大小，防止空壳入库
+            if t['total_size'] < 1024: continue
 
-                files = qbit.get_files(t_hash)
-                if not files: continue # 文件列表为空，继续等
+            files = self.snapshot.get_files(t_hash)
+            if not files: continue # 文件列表为空，继续等
 
-                logger.info(f"📦 捕获新任务: {t['name']} | 文件数: {len(files)}")
-                
-                # 1. 先存主表
-                db_t = Torrent(hash=t_hash, name=t['name'], status='PROCESSING', total_size=t['total_size'])
-                session.add(db_t)
-                
-                # 2. 存文件表
-                all_ids = []
-                valid_count = 0
-                for i, f in enumerate(files):
-                    all_ids.append(i)
-                    # 过滤垃圾文件
-                    if f['size'] < 10 * 1024: continue 
-                    
-                    abs_path = os.path.join(CONFIG["DOWNLOAD_DIR"], f['name'])
-                    item = FileItem(
-                        torrent_hash=t_hash, index=i,
-                        path=abs_path, rel_path=f['name'],
-                        size=f['size'], status=0
-                    )
-                    session.add(item)
-                    valid_count += 1
-                
-                session.commit()
-                
-                # 3. 🚨 关键操作: 
-                # 立刻将 qBit 中所有文件设为“不下载”(0)，
-                # 然后 Resume 任务。这样任务是 Active 的，但不会跑流量，直到调度器分配。
-                qbit.set_priority(t_hash, all_ids, 0)
-                qbit.resume(t_hash)
-                
-                if t_hash in self.resume_attempts: del self.resume_attempts[t_hash]
+            logger.info(f"📦 捕获新任务: {t['name']} | 文件数: {len(files)}")
+            
+            # 1. 先存主表 (INGESTING: 文件表分块入库中)
+            db_t = Torrent(hash=t_hash, name=t['name'], status='INGESTING', total_size=t['total_size'])
+            session.add(db_t)
+            session.commit()
+            
+            # 2. 🚨 关键操作: 
+            # 立刻将 qBit 中所有文件设为“不下载”(0)，
+            # 然后 Resume 任务。这样任务是 Active 的，但不会跑流量，直到调度器分配。
+            self.start_ingest(t_hash, t['name'], files)
+            
+            if t_hash in self.resume_attempts: del self.resume_attempts[t_hash]
+            self.known_hashes.add(t_hash)
+            self.untracked.discard(t_hash)
 
         Session.remove()
 
+        # 上次没入库完的种子，重新拉文件列表续上 (INSERT OR IGNORE 跳过已入库的行)
+        for t_hash in list(self.ingest_resume):
+            if t_hash not in self.torrent_state: continue
+            files = self.snapshot.get_files(t_hash)
+            if not files: continue
+            self.ingest_resume.discard(t_hash)
+            self.start_ingest(t_hash, self.torrent_state[t_hash].get('name', t_hash), files)
+
+        self.ingest_step()
+
+    def start_ingest(self, t_hash, name, files):
+        """全部文件设为不下载 (分块请求) 后开始下载，文件行交给 ingest_step 分轮入库。
+        重启后续入库时，之前分块里已经在下/下完的文件 (状态 1~3) 不动，否则会被停掉又留在"下载中"，最后被当僵尸杀掉"""
+        active = {rec.index for rec in file_store.of_torrent(t_hash) if rec.status in (1, 2, 3)}
+        qbit.set_priority(t_hash, [i for i in files if i not in active], 0)
+        qbit.resume(t_hash)
+        # 过滤垃圾文件
+        valid = [(i, f) for i, f in files.items() if f['size'] >= 10 * 1024]
+        self.ingest_jobs[t_hash] = {'name': name, 'files': valid, 'pos': 0}
+
+    def forget(self, hash_str):
+        """种子被删除/归档后，清掉调度器里跟它有关的状态"""
+        self.ingest_jobs.pop(hash_str, None)
+        self.ingest_resume.discard(hash_str)
+        self.layouts.pop(hash_str, None)
+        if self.known_hashes is not None: self.known_hashes.discard(hash_str)
+
+    def ingest_step(self):
+        """每轮最多入库 INGEST_CHUNK 行 (Core executemany)，入库即可被调度，大种子不会卡住主循环"""
+        quota = CONFIG["INGEST_CHUNK"]
+        table = FileItem.__table__
+        for t_hash, job in list(self.ingest_jobs.items()):
+            if quota <= 0: break
+            chunk = job['files'][job['pos']:job['pos'] + quota]
+            if chunk:
+                rows = [{
+                    'torrent_hash': t_hash, 'index': i,
+                    'path': os.path.join(CONFIG["DOWNLOAD_DIR"], f['name']), 'rel_path': f['name'],
+                    'size': f['size'], 'status': 0, 'started_at': 0, 'failed_reason': "",
+                } for i, f in chunk]
+                lo, hi = chunk[0][0], chunk[-1][0]
+                def write():
+                    with engine.begin() as conn:
+                        # 入库途中种子被删了：OR IGNORE 不管外键，不先查会一直报错卡住主循环
+                        if conn.execute(select(Torrent.__table__.c.id).where(Torrent.__table__.c.hash == t_hash)).first() is None:
+                            return False
+                        conn.execute(insert(table).prefix_with('OR IGNORE'), rows)
+                        # 续入库时这段里可能有已经完成/放弃的行，不再登记进内存 (写回时只会淘汰脏记录，它们会一直留着)
+                        return conn.execute(select(table).where(
+                            table.c.torrent_hash == t_hash, table.c.index.between(lo, hi), table.c.status < 4)).all()
+                inserted = db_execute(write)
+                if inserted is False:
+                    self.ingest_jobs.pop(t_hash, None)
+                    logger.info(f"📥 种子已删除，放弃入库: {job['name']}")
+                    continue
+                if inserted is None: break # 数据库忙，下一轮再来
+                recs = [FileRecord.from_row(r) for r in inserted]
+                file_store.add(recs)
+                panel.refresh(t_hash)
+                self.dedup(recs)
+                job['pos'] += len(chunk)
+                quota -= len(chunk)
+
+            if job['pos'] >= len(job['files']):
+                def finish():
+                    with engine.begin() as conn:
+                        conn.execute(update(Torrent.__table__).where(Torrent.__table__.c.hash == t_hash).values(status='PROCESSING'))
+                    return True
+                if db_execute(finish):
+                    self.ingest_jobs.pop(t_hash, None)
+                    logger.info(f"📥 入库完成: {job['name']} | 有效文件: {len(job['files'])}")
+            else:
+                logger.info(f"📥 分块入库中: {job['name']} | {job['pos']}/{len(job['files'])}")
+
+    def dedup(self, recs):
+        """☁️ 网盘上已有 (同路径同大小) 的等待文件直接标记完成，不占磁盘预算也不走流量"""
+        skipped = {}
+        for f in recs:
+            if f.status == 0 and remote_index.has(f.rel_path, f.size) and file_store.transition(f, 4):
+                skipped[f.torrent_hash] = skipped.get(f.torrent_hash, 0) + 1
+        for h, n in skipped.items():
+            logger.info(f"☁️ 网盘已存在 {n} 个文件，跳过下载: {self.torrent_state.get(h, {}).get('name', h[:6])}")
+
     def monitor_zombies(self):
-        """🧟 批量化 僵尸文件查杀"""
-        session = Session()
-        downloading = session.query(FileItem).filter_by(status=1).all()
-        if not downloading:
-            Session.remove()
-            return
+        """🧟 批量化 僵尸文件查杀：按近期速度预测剩余时间，和它占着的磁盘预算比较"""
+        downloading = file_store.with_status(1)
+        self.speed.retain(set(f.id for f in downloading))
+        if not downloading: return
 
         now = time.time()
+        margin = CONFIG["DISK_SAFE_MARGIN_GB"] * 1024**3
+        usable = self.budget_info.get('disk_total', 0) - margin
         # 按 Hash 分组，减少 API 调用 (100个文件只调1次API)
-        active_hashes = set(f.torrent_hash for f in downloading)
+        by_hash = {}
+        for f in downloading:
+            by_hash.setdefault(f.torrent_hash, []).append(f)
+        # 我们自己暂停的种子 (看门狗 / 流式窗口) 不判；恢复后样本从头攒，暂停那段不算进速度
+        held = set(disk_guard.paused) | {s['hash'] for s in self.streams.values() if s['paused']}
+        throttled = self.backpressure.limit > 0
         
-        for h in active_hashes:
-            try:
-                q_files = qbit.get_files(h) # 获取该种子所有文件实时状态
-            except: continue
-
-            # 筛选出属于该种子的 DB 任务
-            tasks = [f for f in downloading if f.torrent_hash == h]
+        for h, tasks in by_hash.items():
+            if h in held:
+                for f in tasks:
+                    if not f.stream: self.speed.forget(f.id)
+                continue
+            q_files = self.snapshot.get_files(h, [f.index for f in tasks]) # 只取关注的文件实时状态 (快照)
             
             for f in tasks:
-                if f.index >= len(q_files): continue
-                qf = q_files[f.index]
+                if f.stream:
+                    # 流式文件由自己的线程判断卡死；线程不在了 (程序重启) 说明流已中断，本地前缀也没了，只能重来
+                    if f.id in self.streams or f.status != 1: continue
+                    self.kill(f, "流式上传中断 (本地前缀已释放)")
+                    continue
+
+                qf = q_files.get(f.index)
+                if not qf: continue
                 
                 if f.started_at == 0:
-                    f.started_at = now
-                    session.commit()
+                    file_store.update(f, started_at=now)
                     continue
                 
-                duration = now - f.started_at
-                reason = None
-                
-                # 1. 超时判定
-                if duration > CONFIG["ZOMBIE_MAX_LIFETIME"]:
-                    reason = f"超时 > {CONFIG['ZOMBIE_MAX_LIFETIME']/3600:.1f}h"
-                # 2. 龟速判定 (预热期后)
-                elif duration > CONFIG["ZOMBIE_WARMUP"]:
-                    done = qf['progress'] * f.size
-                    speed = done / duration if duration > 0 else 0
-                    if speed < CONFIG["ZOMBIE_MIN_SPEED"]:
-                        reason = f"龟速 {speed/1024:.1f} KB/s"
-                
+                self.speed.sample(f.id, now, qf['progress'] * f.size)
+                reason = zombie_reason(f.size, now - f.started_at, qf['progress'], qf.get('availability', -1),
+                                       self.speed.rates(f.id), usable, throttled)
                 if reason:
-                    logger.warning(f"🔪 斩杀: {f.rel_path} | {reason}")
-                    f.status = 5 # Killed
-                    f.failed_reason = reason
-                    
-                    # 停止下载
-                    qbit.set_priority(h, [f.index], 0)
-                    
-                    # 清理本地残留
-                    if os.path.exists(f.path):
-                        try: os.remove(f.path)
-                        except: pass
-                    parts = f.path + ".parts"
-                    if os.path.exists(parts):
-                        try: os.remove(parts)
-                        except: pass
-        
-        session.commit()
-        Session.remove()
+                    self.kill(f, reason)
 
-    # 添加到 Scheduler 类中
-    def get_physical_size(self, path):
-        """获取文件在磁盘上的真实物理占用 (处理稀疏文件/预分配延迟)"""
-        try:
-            st = os.stat(path)
-            # st_blocks 是 512字节块的数量 (Linux/Unix特有，Windows下通常不支持但也没这问题)
-            if hasattr(st, 'st_blocks'):
-                return st.st_blocks * 512
-            return st.st_size # Fallback
-        except:
-            return 0
+    def kill(self, f, reason):
+        """🔪 停止下载并清掉本地残留；还有重排次数就退回等待队列，否则判死"""
+        requeue = f.requeues < CONFIG["ZOMBIE_REQUEUE"]
+        if requeue:
+            ok = file_store.transition(f, 0, started_at=0, failed_reason=reason, requeues=f.requeues + 1, stream=0)
+        else:
+            ok = file_store.transition(f, 5, failed_reason=reason) # Killed
+        if not ok: return
+        self.speed.forget(f.id)
+        logger.warning(f"🔪 斩杀: {f.rel_path} | {reason}" + (f" -> 重新排队 ({f.requeues}/{CONFIG['ZOMBIE_REQUEUE']})" if requeue else ""))
+        
+        # 停止下载
+        qbit.set_priority(f.torrent_hash, [f.index], 0)
+        
+        # 清理本地残留
+        if os.path.exists(f.path):
+            try: os.remove(f.path)
+            except: pass
+        parts = f.path + ".parts"
+        if os.path.exists(parts):
+            try: os.remove(parts)
+            except: pass
 
     def schedule_downloads(self):
-        session = Session()
-        
         # 1. 获取物理剩余空间
-        free_space = self.get_disk_free()
+        usage = self.get_disk_usage()
+        free_space = usage.free if usage else 0
         
-        # 2. 计算“隐形债务”
-        downloading_files = session.query(FileItem).filter_by(status=1).all()
-        pending_debt = 0
-        for f in downloading_files:
-            if os.path.exists(f.path):
-                physical = self.get_physical_size(f.path)
-                if physical < f.size:
-                    pending_debt += (f.size - physical)
-            else:
-                pending_debt += f.size
+        # 2. 计算“隐形债务” (缓存 + 限频 stat，见 DebtTracker)
+        downloading_files = file_store.with_status(1)
+        window = int(CONFIG["STREAM_WINDOW_GB"] * 1024**3)
+        pending_debt, allocated = self.debt.compute(downloading_files, self.snapshot, {fid: window for fid in self.streams})
+        # 🧩 边界 piece 里不下载的邻居字节也会落盘 (.parts)，同样记为债务
+        spill = self.boundary_spill(downloading_files) if CONFIG["SCHED_PIECE_AWARE"] else 0
+        pending_debt += spill
 
         # 3. 计算预算
-        budget = free_space - (CONFIG["DISK_SAFE_MARGIN_GB"] * 1024**3) - pending_debt
+        margin = CONFIG["DISK_SAFE_MARGIN_GB"] * 1024**3
+        budget = free_space - margin - pending_debt
+        # 🌊 永远装不下的超大文件改走流式上传，只从预算里扣一个窗口
+        if CONFIG["STREAM_ENABLED"] and usage:
+            budget -= self.schedule_streams(usage.total - margin, budget)
+        # 🚰 上传跟不上时限制新调度量 (磁盘预算之外的第二道闸)
+        if CONFIG["BACKPRESSURE_ENABLED"]:
+            backlog = sum(f.size for f in file_store.with_status(2) + file_store.with_status(3))
+            allow = self.backpressure.update(self.upload_slots.sent_total, backlog, pending_debt, file_store.count(2) > 0)
+            if allow is not None: budget = min(budget, allow)
+        self.budget_info = {
+            'disk_total': usage.total if usage else 0,
+            'disk_used': usage.used if usage else 0,
+            'free': free_space,
+            'margin': int(margin),
+            'debt': pending_debt,
+            'allocated': allocated,         # 下载中文件已落盘的字节 (应 <= disk_used)
+            'budget': int(budget),
+            'downloading': len(downloading_files),
+            'stat_calls': self.debt.stat_calls,
+            'spill': spill,                 # 其中边界 piece 溢出到 .parts 的部分
+            'streams': len(self.streams),
+            'backpressure': self.backpressure.stats(),
+        }
         
+        # 网盘索引 (重新) 建好后，把积压的等待文件整体查一遍
+        if remote_index.version != self.dedup_version:
+            self.dedup_version = remote_index.version
+            self.dedup(file_store.with_status(0))
+
         # 只有当预算充足时才进行复杂的调度计算
         if budget > 0:
             # 获取所有等待中的任务
-            pending = session.query(FileItem).filter_by(status=0).all()
-            if not pending:
-                Session.remove()
-                return
+            pending = file_store.with_status(0)
+            if not pending: return
 
             # === 🧠 智能调度核心：获取实时可用性 ===
             # 我们需要知道哪些文件“好下”，这需要实时问 qBit
             
-            # 1. 提取涉及的种子 Hash
-            active_hashes = set(f.torrent_hash for f in pending)
+            # 1. 提取涉及的种子 Hash 及其待调度文件
+            pending_by_hash = {}
+            for f in pending:
+                pending_by_hash.setdefault(f.torrent_hash, []).append(f.index)
             
             # 2. 批量获取这些种子的文件详情 (缓存起来)
             # 格式: { (hash, index): availability_score }
             health_map = {}
             
-            for h in active_hashes:
+            for h, idxs in pending_by_hash.items():
                 try:
-                    # 获取该种子所有文件的实时信息
-                    q_files_info = qbit.get_files(h) 
-                    for idx, info in enumerate(q_files_info):
+                    # 获取该种子待调度文件的实时信息 (快照)
+                    q_files_info = self.snapshot.get_files(h, idxs)
+                    for idx, info in q_files_info.items():
                         # availability: 0~1表示完成度，>1表示副本数(种子多)
                         # 有些版本可能返回 -1 表示未知，归一化为 0
                         avail = info.get('availability', 0)
@@ -437,171 +2421,553 @@ class Scheduler(threading.Thread):
                 except:
                     pass
 
-            # 3. 👑 排序算法
-            # 优先级 1 (最高): availability (越大越好)
-            # 优先级 2: size (越小越好 -> 快进快出，周转率高)
-            # 优先级 3: id (先来后到)
-            def priority_score(item):
-                # 获取该文件的实时健康度
-                health = health_map.get((item.torrent_hash, item.index), 0)
-                
-                # 逻辑：
-                # 如果健康度 < 1 (不完整)，即使再小也不要优先，得分为负
-                # 如果健康度 >= 1，得分高。
-                # 也就是我们希望：先下完 10个100MB的热门文件，再回头啃那个1GB的冷门文件
-                
-                score = 0
-                if health >= 1.0:
-                    score += 10000 # 基础分，保证优先于残缺文件
-                    score += health * 10 # 副本越多越优先
-                    score -= (item.size / 1024 / 1024 / 1024) # 1GB 扣1分 (优先小文件)
-                else:
-                    # 残缺文件，分很低
-                    score += health * 100
-                
-                return score
-
-            # 执行排序
-            pending.sort(key=priority_score, reverse=True)
+            # 3. 👑 跟上一轮快照对比，只有健康度变了或新进等待态 (新种子/重排) 的文件才重新入堆，再按策略在预算内装箱
+            prev, self.last_health = self.last_health, health_map
+            for f in pending:
+                key = (f.torrent_hash, f.index)
+                health = health_map.get(key, 0)
+                if f.id in self.queue.scores and prev.get(key, 0) == health: continue
+                self.queue.update(f, health)
+            candidates, popped = self.queue.candidates(budget, CONFIG["SCHED_PACK_WINDOW"])
+            now = time.time()
+            # 需要 recheck、但种子刚 recheck 过 (可能还在校验) 的重排文件这轮先不放行，留在队列里
+            stale = {f.id for f, _ in candidates if self.needs_recheck(f)}
+            held = lambda f: f.id in stale and now - self.rechecked.get(f.torrent_hash, 0) < CONFIG["RECHECK_MIN_INTERVAL"]
+            chosen = self.policy.pack([c for c in candidates if not held(c[0])], budget)
+            self.queue.restore(popped, set(f.id for f, _ in chosen))
+            if CONFIG["SCHED_PIECE_AWARE"]:
+                chosen = self.add_companions(chosen, pending, health_map, budget)
 
-            # === 4. 按顺序填充预算 ===
+            # === 4. 放行选中的文件 ===
             batch_actions = {}
+            recheck = set()
             
-            for f in pending:
-                # 获取健康度用于日志
-                h_val = health_map.get((f.torrent_hash, f.index), 0)
-                
-                if f.size < budget:
-                    # 只有健康度 >= 1 或者 整个队列都没好资源了勉强下
-                    # 这里做个策略：如果健康度 < 0.9，尽量跳过，除非硬盘很空
-                    if h_val < 0.9 and budget < 10 * 1024**3:
-                        # 硬盘剩不到10G且文件不健康，不下载，留给好文件
-                        continue
-
-                    f.status = 1 # Downloading
-                    f.started_at = time.time()
-                    budget -= f.size
-                    
-                    if f.torrent_hash not in batch_actions:
-                        batch_actions[f.torrent_hash] = []
-                    batch_actions[f.torrent_hash].append(f.index)
-                    
-                    logger.info(f"✅ 调度: {f.rel_path.split('/')[-1]} | Size: {f.size/1024/1024:.1f}M | 🔋健康度: {h_val:.2f}")
-                else:
-                    pass
-            
-            session.commit()
+            for f, h_val in chosen:
+                if f.id not in stale and self.needs_recheck(f): stale.add(f.id) # 连带放行的邻居
+                if held(f): continue
+                if not file_store.transition(f, 1, started_at=now): continue # Downloading
+                if f.id in stale: recheck.add(f.torrent_hash) # 被杀时本地数据删了，qBit 还记着这些块已完成
+                budget -= f.size
+                batch_actions.setdefault(f.torrent_hash, []).append(f.index)
+                logger.info(f"✅ 调度: {f.rel_path.split('/')[-1]} | Size: {f.size/1024/1024:.1f}M | 🔋健康度: {h_val:.2f}")
             
             for h, idxs in batch_actions.items():
                 qbit.set_priority(h, idxs, 1)
-                qbit.resume(h)
-        
-        Session.remove()
+                if h in recheck:
+                    qbit.recheck(h)
+                    self.rechecked[h] = now
+                if not disk_guard.is_paused(h): # 看门狗暂停的种子由它自己负责恢复
+                    qbit.resume(h)
+
+    def needs_recheck(self, f):
+        """重排的文件本地数据被删/打洞过，qBit 却还报告有进度 —— 只有这种才需要 recheck (整个种子重新校验，代价大)"""
+        if not f.requeues: return False
+        qf = self.snapshot.get_files(f.torrent_hash, [f.index]).get(f.index)
+        progress = qf['progress'] if qf else 0
+        if progress <= 0: return False
+        return DebtTracker.get_physical_size(f.path) < progress * f.size * 0.99
+
+    def schedule_streams(self, limit, budget):
+        """给大于 limit (整块盘的可用容量) 的等待文件开流式上传，返回占用的预算"""
+        window = int(CONFIG["STREAM_WINDOW_GB"] * 1024**3)
+        used = 0
+        for f in file_store.with_status(0):
+            if len(self.streams) >= CONFIG["STREAM_MAX_ACTIVE"] or budget - used < window: break
+            if f.size <= limit: continue
+            if _libc is None:
+                logger.warning("⚠️ 当前系统不支持打洞 (fallocate PUNCH_HOLE)，无法流式上传")
+                CONFIG["STREAM_ENABLED"] = False
+                break
+            if not self.upload_slots.acquire(blocking=False): break
+            target = self.router.pick(f.size)
+            if target is None:
+                self.upload_slots.release()
+                break
+            if not file_store.transition(f, 1, started_at=time.time(), stream=1):
+                self.router.release(target, f.size, False)
+                self.upload_slots.release()
+                continue
+            self.streams[f.id] = {'sent': 0, 'paused': False, 'hash': f.torrent_hash}
+            used += window
+            threading.Thread(target=self.run_stream, args=(f, target)).start()
+        return used
+
+    def layout(self, hash_str):
+        lay = self.layouts.get(hash_str)
+        if lay is None:
+            files = self.snapshot.get_files(hash_str)
+            piece_size = qbit.get_properties(hash_str).get('piece_size')
+            if not files or not piece_size: return None
+            lay = self.layouts[hash_str] = TorrentLayout(files, piece_size)
+        return lay
+
+    def boundary_spill(self, downloading):
+        """下载中文件的边界 piece 会顺带写入的邻居字节 (还没下完的部分)"""
+        by_hash = {}
+        for f in downloading:
+            if not f.stream: by_hash.setdefault(f.torrent_hash, set()).add(f.index)
+        total = 0
+        for h, active in by_hash.items():
+            lay = self.layout(h)
+            # 边界 piece 全都确认下完了就不用再拉 pieceStates
+            if lay and lay.boundary(active): total += lay.spill(active, self.snapshot.piece_states(h))
+        return total
+
+    def add_companions(self, chosen, pending, health_map, budget):
+        """把和 本轮选中/下载中 文件共享边界 piece 的等待邻居一起放行 (预算内、健康度合格)：
+        共享块只下一次，邻居那部分直接落进自己的文件而不是 .parts"""
+        waiting = {(f.torrent_hash, f.index): f for f in pending}
+        picked = set(f.id for f, _ in chosen)
+        left = budget - sum(f.size for f, _ in chosen)
+        out = list(chosen)
+        for a in [f for f, _ in chosen] + file_store.with_status(1):
+            lay = self.layout(a.torrent_hash)
+            if lay is None or a.index not in lay.pos: continue
+            for idx in lay.neighbours(a.index):
+                nb = waiting.get((a.torrent_hash, idx))
+                if nb is None or nb.id in picked: continue
+                health = health_map.get((nb.torrent_hash, idx), 0)
+                if not self.policy.admissible(nb, health, left): continue
+                out.append((nb, health))
+                picked.add(nb.id)
+                left -= nb.size
+        return out
+
     def check_completion(self):
-        session = Session()
-        downloading = session.query(FileItem).filter_by(status=1).all()
-        if not downloading: 
-            Session.remove()
-            return
+        downloading = file_store.with_status(1)
+        if not downloading: return
 
         # 按 Hash 分组检查，极大提升性能
-        active_hashes = set(f.torrent_hash for f in downloading)
+        by_hash = {}
+        for f in downloading:
+            by_hash.setdefault(f.torrent_hash, []).append(f)
         
-        for h in active_hashes:
-            try:
-                files_stats = qbit.get_files(h)
-            except: continue
-
-            tasks = [f for f in downloading if f.torrent_hash == h]
+        for h, tasks in by_hash.items():
+            files_stats = self.snapshot.get_files(h, [t.index for t in tasks])
             
             for t in tasks:
-                if t.index < len(files_stats):
-                    qs = files_stats[t.index]
+                if t.stream: continue # 流式文件由上传线程直接完成
+                qs = files_stats.get(t.index)
+                if qs:
                     # 进度 >= 1.0 (或 100%)
                     if qs['progress'] >= 0.9999:
                         logger.info(f"✅ 下载完成: {t.rel_path}")
-                        t.status = 2 # Ready to upload
+                        file_store.transition(t, 2) # Ready to upload
                         # 注意：这里不设 priority=0，防止 qBit 在做种/检查时出错
                         # 等上传完再设为 0
-        
-        session.commit()
-        Session.remove()
 
     def schedule_uploads(self):
-        session = Session()
         # 查找状态为 2 (Ready) 的文件
-        ready = session.query(FileItem).filter_by(status=2).all()
+        ready = file_store.with_status(2)
+        if CONFIG["BUNDLE_ENABLED"]:
+            ready = self.schedule_bundles(ready)
         
         for f in ready:
             if self.upload_slots.acquire(blocking=False):
-                f.status = 3 # Uploading
-                session.commit()
+                target = self.router.pick(f.size) # 🔀 选预计最快传完的网盘
+                if target is None:
+                    self.upload_slots.release()
+                    continue
+                if not file_store.transition(f, 3): # Uploading
+                    self.router.release(target, f.size, False)
+                    self.upload_slots.release()
+                    continue
                 # 启动线程
-                threading.Thread(
-                    target=self.run_rclone, 
-                    args=(f.id, f.path, f.rel_path, f.torrent_hash, f.index)
-                ).start()
-        
-        Session.remove()
+                threading.Thread(target=self.run_rclone, args=(f, target)).start()
 
-    def run_rclone(self, fid, local, rel, th, idx):
-        """Rclone 上传线程 (修复死锁版)"""
-        remote_sub = os.path.dirname(rel)
-        remote_path = f"{CONFIG['RCLONE_REMOTE']}{CONFIG['RCLONE_DEST_PATH']}/{remote_sub}"
-        
-        cmd = ["rclone", "move", local, remote_path] + RCLONE_FLAGS
-        
-        logger.info(f"🚀 开始上传: {os.path.basename(local)}")
+    def schedule_bundles(self, ready):
+        """把同一种子同一目录下已下完的小文件按大小上限分包，每个包占一个上传槽位。
+        返回仍需逐个上传的文件 (大文件 + 凑不成包的小文件)"""
+        limit = CONFIG["BUNDLE_MAX_FILE_MB"] * 1024**2
+        target = CONFIG["BUNDLE_TARGET_MB"] * 1024**2
+        now = time.time()
+        groups, singles = {}, []
+        for f in ready:
+            if f.size < limit:
+                groups.setdefault((f.torrent_hash, os.path.dirname(f.rel_path)), []).append(f)
+            else:
+                singles.append(f)
+        self.bundle_seen = {f.id: self.bundle_seen.get(f.id, now) for fs in groups.values() for f in fs}
+        # 各目录里还在排队/下载的小文件数
+        waiting = {}
+        for h in set(h for h, _ in groups):
+            for x in file_store.of_torrent(h):
+                if x.status in (0, 1) and x.size < limit:
+                    key = (h, os.path.dirname(x.rel_path))
+                    waiting[key] = waiting.get(key, 0) + 1
+
+        for (h, d), files in groups.items():
+            # 同目录还有小文件在排队/下载，先等一等，凑齐了再打包 (最多等 BUNDLE_MAX_WAIT)
+            total = sum(f.size for f in files)
+            oldest = min(self.bundle_seen[f.id] for f in files)
+            if waiting.get((h, d)) and total < target and now - oldest < CONFIG["BUNDLE_MAX_WAIT"]:
+                continue
+            if len(files) < CONFIG["BUNDLE_MIN_FILES"]:
+                singles.extend(files)
+                continue
+
+            batch, size = [], 0
+            for f in sorted(files, key=lambda x: x.index) + [None]:
+                if f is not None and (not batch or size + f.size <= target):
+                    batch.append(f)
+                    size += f.size
+                    continue
+                dest = None
+                if len(batch) >= CONFIG["BUNDLE_MIN_FILES"] and self.upload_slots.acquire(blocking=False):
+                    dest = self.router.pick(size)
+                    if dest is None: self.upload_slots.release()
+                if dest is not None:
+                    moved = [x for x in batch if file_store.transition(x, 3)]
+                    if moved:
+                        threading.Thread(target=self.run_bundle, args=(moved, d, dest, size)).start()
+                    else:
+                        self.router.release(dest, size, False)
+                        self.upload_slots.release()
+                elif len(batch) < CONFIG["BUNDLE_MIN_FILES"]:
+                    singles.extend(batch) # 分包剩下的零头
+                batch, size = ([f], f.size) if f is not None else ([], 0)
+        return singles
+
+    def track_upload(self, recs, target):
+        """登记遥测并返回进度回调；新增字节同时喂给并发控制器和分流器，吞吐不必等文件传完才统计"""
+        key = recs[0].id
+        self.telemetry.start([r.id for r in recs], sum(r.size for r in recs))
+        def progress(nbytes, speed, eta):
+            delta = self.telemetry.update(key, nbytes, speed, eta)
+            if delta > 0:
+                self.upload_slots.record(delta)
+                self.router.record(target, delta)
+        return progress
+
+    def finish_upload(self, target, size, sent, success, kind, started):
+        """上传线程收尾：补记进度回调没报到的尾巴，释放分流器占位，记指标"""
+        if success:
+            self.upload_slots.record(max(0, size - sent))
+            self.router.record(target, max(0, size - sent))
+            metrics.inc('qflow_upload_bytes_total', size, remote=target.remote, kind=kind)
+        self.router.release(target, size, success)
+        metrics.inc('qflow_uploads_total', remote=target.remote, kind=kind, result='ok' if success else 'failed')
+        metrics.observe('qflow_upload_seconds', time.time() - started, remote=target.remote, kind=kind)
+
+    def run_bundle(self, recs, rel_dir, target, reserved):
+        """打包上传线程：tar 直接流式写进 rclone rcat 的 stdin，不在本地落临时文件"""
+        h = recs[0].torrent_hash
+        name = f"_qflow_bundle_{h[:8]}_{recs[0].index}.tar"
+        rel = f"{rel_dir}/{name}" if rel_dir else name
+        remote_path = f"{target.base}/{rel}"
+        logger.info(f"📦 开始打包上传: {name} -> {target.remote} | {len(recs)} 个文件")
+        started = time.time()
+        progress = self.track_upload(recs, target)
+
+        err = "Unknown"
         try:
-            res = subprocess.run(cmd, capture_output=True, text=True)
-            success = (res.returncode == 0)
+            proc = subprocess.Popen(["rclone", "rcat", remote_path] + RCLONE_FLAGS + RCLONE_LOG_FLAGS,
+                                    stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            # stderr 单独线程逐行解析进度，同时防止管道写满把 rclone 卡住
+            tail = []
+            reader = threading.Thread(target=lambda: tail.append(follow_rclone_log(proc.stderr, progress)))
+            reader.start()
+            try:
+                with tarfile.open(fileobj=proc.stdin, mode='w|') as tar:
+                    for r in recs:
+                        tar.add(r.path, arcname=os.path.basename(r.rel_path), recursive=False)
+            finally:
+                proc.stdin.close()
+            success = proc.wait() == 0
+            reader.join()
+            if tail: err = tail[0]
         except Exception as e:
-            logger.error(f"Rclone 调用异常: {e}")
-            success = False
+            logger.error(f"打包上传异常: {e}")
+            success, err = False, str(e)
+        sent = self.telemetry.finish([r.id for r in recs])
+
+        try:
+            if success:
+                manifest = [{'index': r.index, 'name': os.path.basename(r.rel_path), 'rel_path': r.rel_path, 'size': r.size} for r in recs]
+                def record():
+                    with engine.begin() as conn:
+                        return conn.execute(insert(Bundle.__table__).values(
+                            torrent_hash=h, remote_path=rel, size=sum(r.size for r in recs), file_count=len(recs),
+                            manifest=json.dumps(manifest, ensure_ascii=False), created_at=time.time(),
+                            remote=target.remote)).inserted_primary_key[0]
+                try: bundle_id = db_execute(record)
+                except Exception: bundle_id = None # db_execute 已记录日志
+            if success and not bundle_id:
+                # 清单没记下来就不能算完成 (否则网盘上的 tar 再也对不上文件)：本地文件留着，回退重传
+                for r in recs:
+                    file_store.transition(r, 2)
+                logger.error(f"❌ 打包清单写入失败，回退重传 (网盘上的 {rel} 成了孤儿)")
+            elif success:
+                for r in recs:
+                    file_store.transition(r, 4, bundle_id=bundle_id, remote=target.remote) # Done
+                file_store.flush() # 先落库再删本地文件
+                for r in recs:
+                    if os.path.exists(r.path): os.remove(r.path)
+                qbit.set_priority(h, [r.index for r in recs], 0)
+                logger.info(f"🎉 打包上传成功: {name}")
+            else:
+                for r in recs:
+                    file_store.transition(r, 2) # 失败回退
+                self.upload_slots.record(err=err)
+                logger.error(f"❌ 打包上传失败: {err}")
+        finally:
+            self.finish_upload(target, reserved, sent, success, 'bundle', started)
+            self.upload_slots.release()
+            self.notify('upload')
+
+    def run_stream(self, rec, target):
+        """🌊 流式上传线程：顺序下载，把已完成的连续前缀 (按 pieceStates 判断) 灌进 rclone rcat，
+        灌过的部分打洞释放；本地积压超过窗口就暂停种子，等上传追上再恢复"""
+        h, name = rec.torrent_hash, os.path.basename(rec.rel_path)
+        state = self.streams[rec.id]
+        window = CONFIG["STREAM_WINDOW_GB"] * 1024**3
+        step = CONFIG["STREAM_PUNCH_MB"] * 1024**2
+        remote_path = f"{target.base}/{rec.rel_path}"
+        seq_was = self.torrent_state.get(h, {}).get('seq_dl', False)
+        logger.info(f"🌊 开始流式上传: {name} -> {target.remote} | {rec.size/1024**3:.1f}G")
+        started = time.time()
+        progress = self.track_upload([rec], target)
+
+        def throttle(backlog):
+            # backlog=True: 有已下完但还没灌给 rclone 的数据 (上传是瓶颈)，才允许为窗口暂停
+            used = DebtTracker.get_physical_size(rec.path)
+            if not state['paused'] and backlog and used > window:
+                state['paused'] = True
+                qbit.pause(h)
+                logger.info(f"🌊 本地积压 {used/1024**3:.1f}G 超过窗口，暂停下载: {name}")
+            elif state['paused'] and (not backlog or used < window / 2):
+                state['paused'] = False
+                if not disk_guard.is_paused(h): qbit.resume(h)
+
+        success, err, fd, proc = False, "Unknown", None, None
+        try:
+            # 文件在种子里的字节偏移 + piece 大小 -> 文件前缀对应哪些 piece
+            files = {x['index']: x for x in qbit.get_files(h)}
+            first, last = files[rec.index]['piece_range']
+            piece_size = qbit.get_properties(h).get('piece_size')
+            if not piece_size: raise RuntimeError("无法获取 piece 大小")
+            lay = TorrentLayout(files, piece_size) # 偏移要考虑隐藏的 pad 文件
+            offset = lay.offsets[lay.pos[rec.index]]
+            qbit.set_sequential(h, True, seq_was)
+            qbit.set_priority(h, [rec.index], 1)
+            if not disk_guard.is_paused(h): qbit.resume(h)
+
+            proc = subprocess.Popen(["rclone", "rcat", remote_path, f"--size={rec.size}"] + RCLONE_FLAGS + RCLONE_LOG_FLAGS,
+                                    stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            tail = []
+            reader = threading.Thread(target=lambda: tail.append(follow_rclone_log(proc.stderr, progress)))
+            reader.start()
+
+            sent = punched = 0
+            moved_at = time.time()
+            while sent < rec.size:
+                if rec.id not in file_store.records: raise RuntimeError("任务已删除")
+                states = qbit.get_piece_states(h)
+                k = first
+                while k <= last and k < len(states) and states[k] == 2: k += 1
+                ready = max(0, min(rec.size, k * piece_size - offset))
+                if ready > sent and fd is None:
+                    fd = os.open(rec.path, os.O_RDWR)
+                while sent < ready:
+                    chunk = os.pread(fd, min(8 * 1024**2, ready - sent), sent)
+                    if not chunk: raise RuntimeError("读取本地文件失败")
+                    proc.stdin.write(chunk)
+                    sent += len(chunk)
+                    state['sent'] = sent
+                    moved_at = time.time()
+                    # 已经交给 rclone 的前缀打洞释放 (按 STREAM_PUNCH_MB 对齐)
+                    edge = sent if sent >= rec.size else sent - sent % step
+                    if edge - punched >= step or (edge == rec.size and edge > punched):
+                        if not punch_hole(fd, punched, edge - punched): raise RuntimeError("打洞失败 (文件系统不支持?)")
+                        punched = edge
+                    throttle(True)
+                if sent >= rec.size: break
+                throttle(False)
+                if time.time() - moved_at > CONFIG["STREAM_STALL_TIMEOUT"]:
+                    raise RuntimeError(f"前缀 {CONFIG['STREAM_STALL_TIMEOUT']/60:.0f} 分钟没有推进")
+                time.sleep(CONFIG["STREAM_POLL"])
+
+            proc.stdin.close()
+            success = proc.wait() == 0
+            reader.join()
+            if tail: err = tail[0]
+        except Exception as e:
+            logger.error(f"流式上传异常: {name} | {e}")
+            err = str(e)
+            if proc is not None: proc.kill()
+        finally:
+            if fd is not None: os.close(fd)
+        sent = self.telemetry.finish([rec.id])
+
+        try:
+            # 无论成败本地前缀都已释放，文件不能再按普通方式续传
+            qbit.set_priority(h, [rec.index], 0)
+            if os.path.exists(rec.path): os.remove(rec.path)
+            parts = rec.path + ".parts"
+            if os.path.exists(parts): os.remove(parts)
+            if success:
+                file_store.transition(rec, 4, remote=target.remote) # Done
+                remote_index.add(rec.rel_path, rec.size)
+                logger.info(f"🎉 流式上传成功: {name}")
+            else:
+                file_store.transition(rec, 5, failed_reason=f"流式上传失败: {err}")
+                self.upload_slots.record(err=err)
+                logger.error(f"❌ 流式上传失败: {name} | {err}")
+        finally:
+            self.streams.pop(rec.id, None)
+            if state['paused'] and not disk_guard.is_paused(h): qbit.resume(h)
+            if not any(file_store.records.get(fid) and file_store.records[fid].torrent_hash == h for fid in self.streams):
+                qbit.set_sequential(h, seq_was, True) # 恢复种子原来的顺序下载设置
+            self.finish_upload(target, rec.size, sent, success, 'stream', started)
+            self.upload_slots.release()
+            self.notify('upload')
+
+    def run_rclone(self, rec, target):
+        """Rclone 上传线程 (只改内存状态，由主循环统一写回数据库)"""
+        local, rel, th, idx = rec.path, rec.rel_path, rec.torrent_hash, rec.index
         
-        # --- 数据库更新操作 (包裹在重试逻辑中) ---
-        def update_status():
-            session = Session()
-            try:
-                # 使用 Session.get 替代 query.get (SQLAlchemy 2.0 写法，但也兼容旧版)
-                f = session.query(FileItem).filter_by(id=fid).first() 
-                if not f: return
+        logger.info(f"🚀 开始上传: {os.path.basename(local)} -> {target.remote}")
+        started = time.time()
+        success, err = self.uploader.upload(local, rel, self.track_upload([rec], target), target.base)
+        sent = self.telemetry.finish([rec.id])
+        
+        try:
+            if success:
+                file_store.transition(rec, 4, remote=target.remote) # Done
+                remote_index.add(rel, rec.size)
+                # rclone move 已经删了源文件：立刻写回，不等本轮结束，崩溃后库里不会留一个 "上传中" 的空文件
+                file_store.flush()
+                remote_index.flush()
+                logger.info(f"🎉 上传成功: {os.path.basename(local)}")
+                # 告诉 qBit 停止关注此文件
+                qbit.set_priority(th, [idx], 0)
                 
-                if success:
-                    f.status = 4 # Done
-                    logger.info(f"🎉 上传成功: {os.path.basename(local)}")
-                    # 告诉 qBit 停止关注此文件
-                    qbit.set_priority(th, [idx], 0)
-                    
-                    # 清理残留
-                    if os.path.exists(local): os.remove(local)
-                    parts = local + ".parts"
-                    if os.path.exists(parts): os.remove(parts)
-                else:
-                    f.status = 2 # 失败回退
-                    err = res.stderr.strip().split('\n')[-1] if res.stderr else "Unknown"
-                    logger.error(f"❌ 上传失败: {err}")
-                    
-                session.commit()
-            finally:
-                Session.remove()
+                # 清理残留
+                if os.path.exists(local): os.remove(local)
+                parts = local + ".parts"
+                if os.path.exists(parts): os.remove(parts)
+            else:
+                file_store.transition(rec, 2) # 失败回退
+                self.upload_slots.record(err=err)
+                logger.error(f"❌ 上传失败: {err}")
+        finally:
+            self.finish_upload(target, rec.size, sent, success, 'file', started)
+            self.upload_slots.release()
+            self.notify('upload') # 腾出了磁盘和上传槽位
+
+    def tick(self):
+        """跑一轮完整调度，结束时把内存状态批量写回数据库。返回本轮写回的文件数 (=状态变化量)"""
+        started = time.perf_counter()
+        try:
+            for phase in ('take_snapshot', 'sync_metadata', 'check_completion', 'monitor_zombies', 'schedule_downloads'):
+                with metrics.timer('qflow_phase_seconds', phase=phase):
+                    getattr(self, phase)()
+            self.upload_slots.adjust()
+            self.router.adjust()
+            with metrics.timer('qflow_phase_seconds', phase='schedule_uploads'):
+                self.schedule_uploads()
+            trace.record(self)
+            self.last_tick_stats = self.snapshot.stats()
+            logger.debug(f"📊 本轮 qBit 开销: {self.last_tick_stats}")
+        finally:
+            with metrics.timer('qflow_phase_seconds', phase='flush'):
+                changed = file_store.flush()
+                remote_index.flush()
+            with metrics.timer('qflow_phase_seconds', phase='history'):
+                history.maintain(self)
+            metrics.observe('qflow_tick_seconds', time.perf_counter() - started)
+        return changed
 
-        # 执行更新
-        db_execute(update_status)
-        self.upload_slots.release()
+    def next_interval(self, changed):
+        """有变化就回到基础频率；没变化则逐步退避，空闲时退得更远"""
+        if changed or self.untracked or self.ingest_jobs:
+            return CONFIG["SCAN_INTERVAL"]
+        busy = file_store.count(1) or file_store.count(3)
+        cap = CONFIG["SCAN_INTERVAL_MAX"] if busy else CONFIG["SCAN_INTERVAL_IDLE"]
+        return min(cap, self.interval * 1.5)
 
     def run(self):
         logger.info("🚀 QFlow 调度核心已启动")
+        remote_index.start() # file_store.load 要用网盘索引核对丢了本地文件的待上传记录
+        file_store.load()
+        self.uploader = make_uploader()
         while True:
+            started = time.time()
+            changed = 0
             try:
-                self.sync_metadata()
-                self.check_completion()
-                self.monitor_zombies()
-                self.schedule_downloads()
-                self.schedule_uploads()
+                changed = self.tick()
             except Exception as e:
                 logger.error(f"Loop Crash: {e}")
-            time.sleep(CONFIG["SCAN_INTERVAL"])
+            self.interval = self.next_interval(changed)
+            if self.wakeup.wait(self.interval):
+                # 被事件唤醒：稍等片刻合并同一时间的一串事件，然后立刻回到基础频率
+                time.sleep(max(0, CONFIG["SCAN_MIN_GAP"] - (time.time() - started)))
+                self.wakeup.clear()
+                logger.debug(f"⏰ 事件唤醒: {', '.join(sorted(self.wake_reasons))}")
+                self.wake_reasons.clear()
+                self.interval = CONFIG["SCAN_INTERVAL"]
+
+class DiskGuard(threading.Thread):
+    """🛡️ 磁盘水位看门狗：亚秒级采样剩余空间。
+    调度器按 SCAN_INTERVAL 记账，跨 piece 写入 / .parts / 其他进程造成的超支它看不到；
+    看门狗发现剩余空间跌破安全线就暂停剩余量最大的下载，空间回来后再按 剩余量从小到大 逐个恢复"""
+    def __init__(self):
+        super().__init__()
+        self.daemon = True
+        self.lock = threading.Lock()
+        self.paused = set() # 被看门狗暂停的种子
+        self.pause_free = None # 上次暂停时的剩余空间
+
+    def is_paused(self, hash_str):
+        return hash_str in self.paused
+
+    def remaining_by_torrent(self):
+        """下载中文件按种子汇总的剩余字节 (借用调度器的债务缓存，不额外 stat)"""
+        cache = scheduler.debt.cache
+        remaining = {}
+        for f in file_store.with_status(1):
+            entry = cache.get(f.id)
+            left = f.size - (entry[0] if entry else 0)
+            remaining[f.torrent_hash] = remaining.get(f.torrent_hash, 0) + max(0, left)
+        return remaining
+
+    def check(self):
+        free = scheduler.get_disk_free()
+        margin = CONFIG["DISK_SAFE_MARGIN_GB"] * 1024**3
+        # 空间持平 (上传正在追) 不再继续暂停，只有比上次暂停时又掉了一截才算还在往下掉
+        falling = self.pause_free is None or free < self.pause_free - CONFIG["DISK_GUARD_STEP_MB"] * 1024**2
+
+        with self.lock:
+            if free < margin and (falling or not self.paused):
+                # 空间还在往下掉：再暂停一个剩余量最大的种子
+                active = {h: r for h, r in self.remaining_by_torrent().items() if h not in self.paused}
+                if not active: return
+                h = max(active, key=active.get)
+                qbit.pause(h)
+                self.paused.add(h)
+                self.pause_free = free
+                scheduler.notify('disk')
+                logger.warning(f"🛡️ 磁盘告急 (剩余 {free/1024**3:.2f} GB)，暂停下载: {h[:6]}... | 剩余 {active[h]/1024**2:.0f}M")
+            elif self.paused and free > margin + CONFIG["DISK_GUARD_HYSTERESIS_GB"] * 1024**3:
+                # 上传腾出了空间：先恢复最快能下完的
+                remaining = self.remaining_by_torrent()
+                h = min(self.paused, key=lambda x: remaining.get(x, 0))
+                self.paused.discard(h)
+                if not self.paused: self.pause_free = None
+                qbit.resume(h)
+                scheduler.notify('disk')
+                logger.info(f"🛡️ 空间恢复 (剩余 {free/1024**3:.2f} GB)，恢复下载: {h[:6]}...")
+
+    def run(self):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"DiskGuard Crash: {e}")
+            time.sleep(CONFIG["DISK_GUARD_INTERVAL"])
+
+scheduler = Scheduler()
+disk_guard = DiskGuard()
 # ==============================================================================
 # 🖥️ Web UI (Flask)
 # ==============================================================================
@@ -629,6 +2995,7 @@ def idx():
             .status-5 { color: #dc3545; text-decoration: line-through; } /* Killed */
             @keyframes pulse { 0% {opacity: 1;} 50% {opacity: 0.6;} 100% {opacity: 1;} }
             .text-xs { font-size: 0.8em; }
+            .card-header { cursor: pointer; }
         </style>
     </head>
     <body class="bg-light">
@@ -636,6 +3003,13 @@ def idx():
             <header class="mb-4 d-flex justify-content-between align-items-center">
                 <h3 class="mb-0">🌊 QFlow <small class="text-muted text-xs">v2.1</small></h3>
                 <div>
+                    <span class="badge bg-info text-dark" :title="upload.reason">上传并发: {{ upload.active }} / {{ upload.target }}</span>
+                    <template v-if="upload.targets.length > 1">
+                        <span v-for="t in upload.targets" class="badge bg-secondary ms-1"
+                              :title="t.free == null ? '剩余空间未知' : '剩余 ' + (t.free / 1024**3).toFixed(0) + ' GB'">
+                            {{ t.remote }} {{ t.active }}/{{ t.cap }} · {{ (t.rate / 1024 / 1024).toFixed(1) }} MB/s
+                        </span>
+                    </template>
                     <span class="badge bg-success">Free: {{ free_gb }} GB</span>
                 </div>
             </header>
@@ -656,13 +3030,22 @@ def idx():
             </div>
 
             <div v-for="t in tasks" :key="t.hash" class="card mb-3 shadow-sm">
-                <div class="card-header d-flex justify-content-between align-items-center bg-white">
-                    <div class="text-truncate" style="max-width: 70%;">
-                        <strong>{{ t.name || '获取元数据中...' }}</strong>
+                <div class="card-header bg-white" @click="toggle(t.hash)">
+                    <div class="d-flex justify-content-between align-items-center">
+                        <div class="text-truncate" style="max-width: 70%;">
+                            <strong>{{ open[t.hash] ? '▾' : '▸' }} {{ t.name || '获取元数据中...' }}</strong>
+                        </div>
+                        <button @click.stop="del(t.hash)" class="btn btn-sm btn-outline-danger">删除</button>
+                    </div>
+                    <div class="text-xs mt-1">
+                        <template v-for="(n, st) in t.n">
+                            <span v-if="n > 0" :class="'me-2 status-' + st">{{ statusMap[st] }} {{ n }}</span>
+                        </template>
+                        <span class="text-muted">| {{ doneGB(t) }} / {{ totalGB(t) }} GB</span>
                     </div>
-                    <button @click="del(t.hash)" class="btn btn-sm btn-outline-danger">删除</button>
                 </div>
-                <div class="card-body p-0">
+                <div v-if="open[t.hash]" class="card-body p-0">
+                    <div v-if="!files[t.hash]" class="text-muted small p-3">加载中...</div>
                     <div class="table-responsive" style="max-height: 300px;">
                         <table class="table table-sm table-hover mb-0 small">
                             <thead class="table-light">
@@ -674,56 +3057,147 @@ def idx():
                                 </tr>
                             </thead>
                             <tbody>
-                                <tr v-for="f in t.files">
+                                <tr v-for="f in files[t.hash] || []" :key="f.id">
                                     <td class="ps-3 text-truncate" style="max-width: 300px;" :title="f.rel_path" :class="'status-'+f.status">
                                         {{ f.rel_path.split('/').pop() }}
                                     </td>
                                     <td style="width: 80px;">{{ (f.size/1024/1024).toFixed(1) }} MB</td>
                                     <td style="width: 80px;">{{ statusMap[f.status] }}</td>
-                                    <td class="text-danger text-xs">{{ f.failed_reason }}</td>
+                                    <td class="text-xs">
+                                        <span v-if="uploads[f.id]" class="text-success">{{ uploadInfo(uploads[f.id]) }}</span>
+                                        <span class="text-danger">{{ f.failed_reason }}</span>
+                                        <button v-if="f.status == 5" @click="requeue(f, t.hash)" class="btn btn-link btn-sm p-0 ms-1 text-xs">重新排队</button>
+                                    </td>
                                 </tr>
                             </tbody>
                         </table>
                     </div>
                 </div>
             </div>
+
+            <div class="card shadow-sm mt-4">
+                <div class="card-header bg-white" @click="toggleHistory">
+                    <strong>{{ history.open ? '▾' : '▸' }} 🗄️ 历史记录</strong>
+                    <span class="text-muted text-xs ms-2">已完成并归档的种子</span>
+                </div>
+                <div v-if="history.open" class="card-body p-0">
+                    <div class="input-group input-group-sm p-2">
+                        <input v-model="history.q" @keyup.enter="loadHistory(true)" class="form-control" placeholder="按名称搜索">
+                        <button @click="loadHistory(true)" class="btn btn-outline-secondary">搜索</button>
+                    </div>
+                    <table class="table table-sm mb-0 small">
+                        <tbody>
+                            <tr v-for="a in history.items" :key="a.id">
+                                <td class="ps-3 text-truncate" style="max-width: 300px;" :title="a.name">{{ a.name }}</td>
+                                <td><span class="status-4">完成 {{ a.files_done }}</span>
+                                    <span v-if="a.files_killed" class="status-5 ms-1">已跳过 {{ a.files_killed }}</span></td>
+                                <td>{{ (a.bytes_done / 1024**3).toFixed(1) }} GB</td>
+                                <td class="text-muted">{{ new Date(a.finished_at * 1000).toLocaleString() }}</td>
+                            </tr>
+                        </tbody>
+                    </table>
+                    <div class="text-center p-2">
+                        <button v-if="history.next" @click="loadHistory(false)" class="btn btn-link btn-sm">加载更多</button>
+                        <span v-else-if="!history.items.length" class="text-muted small">暂无记录</span>
+                    </div>
+                </div>
+            </div>
         </div>
 
         <script>
         new Vue({
             el: '#app',
             data: {
-                tasks: [],
+                torrents: {},   // { hash: {name, n: [各状态文件数], b: [各状态字节数]} }
+                files: {},      // 展开过的种子的文件列表 { hash: [...] }
+                open: {},
+                uploads: {},    // 上传中文件的实时进度 { id: {...} }
                 free_gb: 0,
+                upload: {active: 0, target: 0, targets: []},
+                history: {open: false, items: [], next: null, q: ''},
                 url: '',
                 loading: false,
                 statusMap: {
                     0: '等待', 1: '下载中', 2: '待上传', 3: '上传中', 4: '完成', 5: '已跳过'
                 }
             },
+            computed: {
+                tasks() {
+                    return Object.keys(this.torrents).map(h => Object.assign({hash: h}, this.torrents[h]));
+                }
+            },
             methods: {
-                load() {
-                    axios.get('/api/stats').then(res => {
-                        this.tasks = res.data.tasks;
-                        this.free_gb = res.data.free;
-                    }).catch(console.error);
+                uploadInfo(u) {
+                    const pct = u.total ? (u.bytes / u.total * 100).toFixed(1) : 0;
+                    const eta = u.eta == null ? '--' : Math.round(u.eta / 60) + 'min';
+                    return pct + '% | ' + (u.speed / 1024 / 1024).toFixed(1) + ' MB/s | ETA ' + eta;
+                },
+                totalGB(t) { return (t.b.reduce((a, x) => a + x, 0) / 1024**3).toFixed(1); },
+                doneGB(t) { return (t.b[4] / 1024**3).toFixed(1); },
+                // SSE：先收全量快照 (每个种子只有计数)，之后只收增量；断线后浏览器自动重连并重新拿快照
+                connect() {
+                    const es = new EventSource('/api/events');
+                    es.addEventListener('snapshot', e => {
+                        this.torrents = JSON.parse(e.data).torrents;
+                        Object.keys(this.open).forEach(h => { if (this.open[h]) this.loadFiles(h); });
+                    });
+                    es.addEventListener('delta', e => {
+                        const d = JSON.parse(e.data);
+                        Object.keys(d.torrents).forEach(h => {
+                            if (d.torrents[h] === null) { this.$delete(this.torrents, h); this.$delete(this.files, h); }
+                            else this.$set(this.torrents, h, d.torrents[h]);
+                        });
+                        Object.keys(d.files).forEach(id => {
+                            const [h, status, reason] = d.files[id];
+                            const f = (this.files[h] || []).find(x => x.id == id);
+                            if (f) { f.status = status; f.failed_reason = reason; }
+                        });
+                    });
+                    es.addEventListener('summary', e => {
+                        const d = JSON.parse(e.data);
+                        this.free_gb = d.free;
+                        this.upload = d.upload;
+                        this.uploads = d.uploads;
+                    });
+                },
+                loadFiles(h) {
+                    axios.get('/api/files', {params: {hash: h}}).then(res => this.$set(this.files, h, res.data.files));
+                },
+                toggle(h) {
+                    this.$set(this.open, h, !this.open[h]);
+                    if (this.open[h]) this.loadFiles(h);
+                },
+                toggleHistory() {
+                    this.history.open = !this.history.open;
+                    if (this.history.open) this.loadHistory(true);
+                },
+                // 按 id 倒序翻页：next 是下一页的游标
+                loadHistory(reset) {
+                    const params = {q: this.history.q};
+                    if (!reset) params.before = this.history.next;
+                    axios.get('/api/history', {params}).then(res => {
+                        this.history.items = (reset ? [] : this.history.items).concat(res.data.items);
+                        this.history.next = res.data.next;
+                    });
+                },
+                requeue(f, h) {
+                    axios.post('/api/requeue', {id: f.id}).then(() => this.loadFiles(h));
                 },
                 add() {
                     if(!this.url) return;
                     this.loading = true;
                     axios.post('/api/add', {url: this.url})
-                        .then(() => { this.url = ''; this.load(); })
+                        .then(() => { this.url = ''; })
                         .finally(() => { this.loading = false; });
                 },
                 del(h) {
                     if(confirm('确定要删除该任务吗？')) {
-                        axios.post('/api/del', {hash: h}).then(this.load);
+                        axios.post('/api/del', {hash: h});
                     }
                 }
             },
             mounted() {
-                this.load();
-                setInterval(this.load, 3000);
+                this.connect();
             }
         })
         </script>
@@ -734,38 +3208,154 @@ def idx():
 
 @app.route('/api/stats')
 def api_stats():
-    session = Session()
-    torrents = session.query(Torrent).all()
-    res = []
-    for t in torrents:
-        files = session.query(FileItem).filter_by(torrent_hash=t.hash).all()
-        file_list = []
-        for f in files:
-            file_list.append({
-                'rel_path': f.rel_path,
-                'size': f.size,
-                'status': f.status,
-                'failed_reason': f.failed_reason
-            })
-        res.append({
-            'hash': t.hash,
-            'name': t.name,
-            'files': file_list
+    """全量接口 (面板已改用 /api/events)：两条查询取出活跃种子和文件 (已归档的走 /api/history)"""
+    table = FileItem.__table__
+    def read():
+        with engine.connect() as conn:
+            torrents = conn.execute(select(Torrent.__table__.c.hash, Torrent.__table__.c.name).order_by(Torrent.__table__.c.id)).all()
+            files = conn.execute(select(table.c.id, table.c.torrent_hash, table.c.rel_path, table.c.size, table.c.status,
+                                        table.c.failed_reason, table.c.stream).order_by(table.c.id)).all()
+            return torrents, files
+    torrents, files = db_execute(read)
+    uploads = scheduler.telemetry.all()
+    by_hash = {h: [] for h, _ in torrents}
+    for f in files:
+        if f.torrent_hash not in by_hash: continue
+        by_hash[f.torrent_hash].append({
+            'id': f.id,
+            'rel_path': f.rel_path,
+            'size': f.size,
+            'status': f.status,
+            'failed_reason': f.failed_reason,
+            'upload': uploads.get(f.id) if f.status == 3 or f.stream else None
         })
-    
-    try:
-        if not os.path.exists(CONFIG["DOWNLOAD_DIR"]): os.makedirs(CONFIG["DOWNLOAD_DIR"])
-        free = shutil.disk_usage(CONFIG["DOWNLOAD_DIR"]).free
-    except: free = 0
-    
-    Session.remove()
-    return jsonify({'tasks': res, 'free': round(free/1024/1024/1024, 2)})
+    res = [{'hash': h, 'name': name, 'files': by_hash[h]} for h, name in torrents]
+    return jsonify(dict(panel_summary(), tasks=res))
+
+def panel_summary():
+    """面板顶部的统计 + 上传中文件的实时进度"""
+    return {'free': round(scheduler.get_disk_free()/1024/1024/1024, 2), 'tick': scheduler.last_tick_stats,
+            'budget': scheduler.budget_info, 'upload': dict(scheduler.upload_slots.stats(), targets=scheduler.router.stats()),
+            'uploads': scheduler.telemetry.all()}
+
+@app.route('/api/events')
+def api_events():
+    """SSE：先发全量快照 (按种子聚合的计数)，之后每 PANEL_PUSH_INTERVAL 秒推一次合并后的增量"""
+    def sse(kind, data):
+        return f"event: {kind}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+    def stream():
+        sub = object()
+        try:
+            yield sse('snapshot', panel.subscribe(sub))
+            last = 0
+            while True:
+                if time.time() - last >= CONFIG["PANEL_SUMMARY_INTERVAL"]:
+                    last = time.time()
+                    yield sse('summary', panel_summary())
+                time.sleep(CONFIG["PANEL_PUSH_INTERVAL"])
+                delta = panel.drain(sub)
+                if delta is None:
+                    yield sse('snapshot', panel.subscribe(sub))
+                elif delta:
+                    yield sse('delta', delta)
+        finally:
+            panel.unsubscribe(sub)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/files')
+def api_files():
+    """展开种子卡片时按需加载文件列表，状态以内存里 (可能还没写回) 的为准"""
+    h = request.args.get('hash', '')
+    table = FileItem.__table__
+    def read():
+        with engine.connect() as conn:
+            return conn.execute(select(table.c.id, table.c.rel_path, table.c.size, table.c.status, table.c.failed_reason)
+                                .where(table.c.torrent_hash == h).order_by(table.c.index)).all()
+    live = {rec.id: rec for rec in file_store.of_torrent(h)}
+    files = []
+    for f in db_execute(read):
+        rec = live.get(f.id)
+        files.append({'id': f.id, 'rel_path': f.rel_path, 'size': f.size,
+                      'status': rec.status if rec else f.status,
+                      'failed_reason': rec.failed_reason if rec else f.failed_reason})
+    return jsonify({'hash': h, 'files': files})
+
+@app.route('/api/history')
+def api_history():
+    """已归档种子，按 id 倒序游标分页：?before=<上一页最后的 id>&limit=&q=<名称子串>&killed=1&since=&until=<完成时间>"""
+    a = ArchivedTorrent.__table__
+    args = request.args
+    limit = max(1, min(args.get('limit', 50, type=int), 500))
+    query = select(a.c.id, a.c.hash, a.c.name, a.c.total_size, a.c.files_done, a.c.files_killed,
+                   a.c.bytes_done, a.c.finished_at, a.c.archived_at).order_by(a.c.id.desc()).limit(limit)
+    if args.get('before', type=int): query = query.where(a.c.id < args.get('before', type=int))
+    if args.get('q'): query = query.where(a.c.name.contains(args['q'], autoescape=True))
+    if args.get('killed'): query = query.where(a.c.files_killed > 0)
+    if args.get('since', type=float): query = query.where(a.c.finished_at >= args.get('since', type=float))
+    if args.get('until', type=float): query = query.where(a.c.finished_at < args.get('until', type=float))
+    def read():
+        with engine.connect() as conn:
+            return conn.execute(query).all()
+    rows = db_execute(read)
+    items = [dict(r._mapping) for r in rows]
+    return jsonify({'items': items, 'next': items[-1]['id'] if len(items) == limit else None})
+
+@app.route('/api/history/<int:aid>')
+def api_history_detail(aid):
+    """单个归档种子的文件和打包清单"""
+    a = ArchivedTorrent.__table__
+    def read():
+        with engine.connect() as conn:
+            return conn.execute(select(a).where(a.c.id == aid)).first()
+    row = db_execute(read)
+    if row is None: return jsonify({'status': 'not_found'}), 404
+    detail = json.loads(zlib.decompress(row.detail))
+    keys = ('index', 'rel_path', 'size', 'status', 'failed_reason', 'remote', 'bundle_id')
+    bundle_keys = ('id', 'remote_path', 'size', 'file_count', 'manifest', 'created_at', 'remote')
+    res = {k: v for k, v in row._mapping.items() if k != 'detail'}
+    res['files'] = [dict(zip(keys, x)) for x in detail['files']]
+    res['bundles'] = [dict(zip(bundle_keys, x)) for x in detail['bundles']]
+    return jsonify(res)
+
+@app.route('/metrics')
+def api_metrics():
+    """Prometheus 抓取入口：累计指标 + 抓取时现算的预算/状态/并发"""
+    def count_by_status():
+        with engine.connect() as conn:
+            return dict(conn.execute(select(FileItem.__table__.c.status, func.count()).group_by(FileItem.__table__.c.status)).all())
+    try: counts = db_execute(count_by_status) or {}
+    except Exception: counts = {}
+    budget = scheduler.budget_info
+    gauges = [
+        ('qflow_files', '各状态文件数 (0=等待 1=下载中 2=待上传 3=上传中 4=完成 5=放弃)',
+         [({'status': st}, counts.get(st, 0)) for st in range(6)]),
+        ('qflow_budget_bytes', '磁盘预算各组成部分 (最近一轮调度)',
+         [({'component': k}, budget[k]) for k in ('disk_total', 'disk_used', 'free', 'margin', 'debt', 'allocated', 'spill', 'budget') if k in budget]),
+        ('qflow_upload_slots', '上传并发 (实际 / AIMD 目标)',
+         [({'kind': 'active'}, scheduler.upload_slots.active), ({'kind': 'target'}, scheduler.upload_slots.target)]),
+        ('qflow_upload_rate_bytes', '上传吞吐 (B/s)',
+         [({'remote': t['remote']}, t['rate']) for t in scheduler.router.stats()] + [({'remote': '*'}, round(scheduler.upload_slots.rate))]),
+        ('qflow_download_limit_bytes', '背压设定的 qBit 全局下载限速 (0=不限)', [({}, scheduler.backpressure.limit)]),
+        ('qflow_scan_interval_seconds', '当前调度间隔', [({}, scheduler.interval)]),
+    ]
+    return metrics.render(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/api/requeue', methods=['POST'])
+def api_requeue():
+    """手动把被杀的文件放回等待队列"""
+    if file_store.revive(request.json.get('id')):
+        scheduler.notify('requeue')
+        return jsonify({'status': 'ok'})
+    return jsonify({'status': 'not_found'}), 404
 
 @app.route('/api/add', methods=['POST'])
 def api_add():
     url = request.json.get('url')
     if url:
         qbit.add_torrent(url)
+        scheduler.notify('add')
     return jsonify({'status': 'ok'})
 
 @app.route('/api/del', methods=['POST'])
@@ -778,12 +3368,17 @@ def api_del():
         session.query(FileItem).filter_by(torrent_hash=h).delete()
         session.commit()
         Session.remove()
+        file_store.drop_torrent(h)
+        panel.remove(h)
+        scheduler.forget(h)
+        scheduler.notify('del')
     return jsonify({'status': 'ok'})
 
 if __name__ == '__main__':
-    # 启动调度线程
-    scheduler = Scheduler()
+    qbit.connect()
+    # 启动调度线程 & 磁盘看门狗
     scheduler.start()
+    disk_guard.start()
     
     # 启动 Web 服务
     # host='0.0.0.0' 允许外网访问
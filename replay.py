@@ -0,0 +1,265 @@
+"""
+QFlow 轨迹回放：把 TRACE_ENABLED 录下的调度轨迹 (qflow-trace.jsonl 及其滚动分段) 喂给不同的
+调度策略 / 僵尸阈值，不睡眠、按轨迹里的时间戳快进跑完，对比吞吐、磁盘峰值和白下载的字节。
+
+    python3 replay.py qflow-trace.jsonl --policy greedy --policy knapsack
+    python3 replay.py qflow-trace.jsonl --set ZOMBIE_MAX_ETA=14400 --set SCHED_UNHEALTHY_MIN=0.5
+    python3 replay.py qflow-trace.jsonl --plugin my_policy.py --policy mine
+
+模型 (都从轨迹里估出来)：
+  * 种子下载速度：真实运行里这个种子在下载时，用当时观测到的速度；没在下载时用它下载时的平均速度，
+    从没下载过的种子用所有种子的中位数。种子的速度在它正在下载的文件之间平分，总量不超过观测到的峰值带宽
+  * 可用度 < 1 的文件最多下到可用度那么多
+  * 上传耗时：真实上传过的文件用实测耗时，其余按实测单文件吞吐的中位数估算，并发 = MAX_UPLOAD_THREADS
+  * 磁盘：轨迹里 (总量 - 剩余 - QFlow 自己的文件) 视为其他程序的占用，原样保留
+不模拟：piece 边界溢出/相邻文件放行、打包和流式上传、背压限速、AIMD 上传并发。
+插件文件里定义 SchedulePolicy 的子类并注册到 main.SCHED_POLICIES 即可用 --policy 选它。
+"""
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import tempfile
+
+GB = 1024**3
+
+def load_trace(path):
+    """按时间顺序读出所有分段 (path.N ... path.1, path)"""
+    parts = []
+    i = 1
+    while os.path.exists(f"{path}.{i}"):
+        parts.append(f"{path}.{i}")
+        i += 1
+    parts = parts[::-1] + ([path] if os.path.exists(path) else [])
+    lines = []
+    for p in parts:
+        with open(p) as fp:
+            for raw in fp:
+                try: lines.append(json.loads(raw))
+                except ValueError: pass # 进程被杀时可能留下半行
+    lines.sort(key=lambda x: x['t'])
+    return lines
+
+class Workload:
+    """第一遍扫描：文件目录、各种子各时刻的观测速度、上传耗时、其他程序的磁盘占用，以及真实运行的结果"""
+    def __init__(self, lines):
+        self.lines = lines
+        self.files = {}         # { file_id: (hash, size) }
+        self.rates = []         # 每轮 { hash: 观测下载速度 B/s }，只含当时真实在下载的种子
+        self.other = []         # 每轮其他程序占用的字节
+        self.upload_time = {}   # { file_id: 实测上传秒数 }
+        status, prog, up_start = {}, {}, {}
+        active_rates = {}       # { hash: [在下载时的速度] }
+        self.recorded = {'done': 0, 'done_bytes': 0, 'killed': 0, 'requeued': 0, 'wasted': 0, 'high_water': 0}
+        prev_t = None
+        for line in lines:
+            t = line['t']
+            for fid, h, size, st in line.get('new', []):
+                self.files.setdefault(fid, (h, size))
+                status.setdefault(fid, st)
+            delta = {}
+            for fid, p in line.get('prog', []):
+                if fid in self.files and p > prog.get(fid, 0):
+                    h, size = self.files[fid]
+                    delta[h] = delta.get(h, 0) + (p - prog.get(fid, 0)) * size
+                prog[fid] = p
+            for fid, st in line.get('ev', []):
+                old = status.get(fid)
+                status[fid] = st
+                size = self.files.get(fid, (None, 0))[1]
+                if st == 3: up_start[fid] = t
+                elif st == 4:
+                    self.recorded['done'] += 1
+                    self.recorded['done_bytes'] += size
+                    if fid in up_start: self.upload_time[fid] = max(0.0, t - up_start.pop(fid))
+                elif old == 1 and st in (0, 5):
+                    self.recorded['wasted'] += prog.get(fid, 0) * size
+                    self.recorded['killed' if st == 5 else 'requeued'] += 1
+                if st != 1: prog.pop(fid, None)
+            downloading = {self.files[fid][0] for fid, st in status.items() if st == 1 and fid in self.files}
+            dt = t - prev_t if prev_t is not None else 0
+            rates = {h: (delta.get(h, 0) / dt if dt > 0 else 0) for h in downloading}
+            for h, r in rates.items():
+                active_rates.setdefault(h, []).append(r)
+            self.rates.append(rates)
+            total, free, allocated = line['disk']
+            own = allocated + sum(self.files[fid][1] for fid, st in status.items() if st in (2, 3) and fid in self.files)
+            self.other.append(max(0, total - free - own))
+            self.recorded['high_water'] = max(self.recorded['high_water'], total - free)
+            prev_t = t
+        self.mean_rate = {h: sum(v) / len(v) for h, v in active_rates.items() if v}
+        self.default_rate = statistics.median(self.mean_rate.values()) if self.mean_rate else 1024**2
+        self.link = max((sum(r.values()) for r in self.rates), default=0) or float('inf')
+        speeds = [self.files[fid][1] / s for fid, s in self.upload_time.items() if s > 0]
+        self.upload_rate = statistics.median(speeds) if speeds else 10 * 1024**2
+        self.duration = lines[-1]['t'] - lines[0]['t'] if lines else 0
+        self.total = lines[0]['disk'][0] if lines else 0
+
+class Item:
+    """回放里的文件 (SchedulePolicy 只用到 id / size)"""
+    __slots__ = ('id', 'torrent_hash', 'size', 'status', 'done', 'started_at', 'requeues', 'upload_end')
+
+    def __init__(self, fid, h, size):
+        self.id, self.torrent_hash, self.size = fid, h, size
+        self.status, self.done, self.started_at, self.requeues, self.upload_end = 0, 0.0, 0, 0, 0
+
+def replay(main, work, policy_name):
+    """第二遍：按轨迹的时间线用指定策略重新调度"""
+    CONFIG = main.CONFIG
+    policy = main.SCHED_POLICIES[policy_name]()
+    speed = main.SpeedModel()
+    margin = CONFIG["DISK_SAFE_MARGIN_GB"] * GB
+    usable = work.total - margin
+    items, avail, uploads = {}, {}, []
+    known = set() # 滚动后的关键帧会把还活着的文件再登记一遍
+    result = {'done': 0, 'done_bytes': 0, 'killed': 0, 'requeued': 0, 'wasted': 0, 'high_water': 0}
+    prev_t = None
+
+    def kill(f, reason):
+        result['wasted'] += f.done
+        speed.forget(f.id)
+        f.done = 0
+        if f.requeues < CONFIG["ZOMBIE_REQUEUE"]:
+            f.status, f.started_at = 0, 0
+            f.requeues += 1
+            result['requeued'] += 1
+        else:
+            f.status = 5
+            result['killed'] += 1
+            del items[f.id]
+
+    for i, line in enumerate(work.lines):
+        t = line['t']
+        dt = t - prev_t if prev_t is not None else 0
+        prev_t = t
+        for fid, h, size, st in line.get('new', []):
+            if fid in known or st >= 4: continue
+            known.add(fid)
+            f = items[fid] = Item(fid, h, size)
+            if st == 1: f.status, f.started_at = 1, t # 录制开始时已在下载的，从零开始算
+            elif st in (2, 3): f.status, f.done = 2, size
+        for fid, a in line.get('avail', []):
+            avail[fid] = a
+
+        # 1. 下载推进
+        by_hash = {}
+        for f in items.values():
+            if f.status == 1: by_hash.setdefault(f.torrent_hash, []).append(f)
+        observed = work.rates[i]
+        want = {h: observed.get(h, work.mean_rate.get(h, work.default_rate)) for h in by_hash}
+        scale = min(1.0, work.link / sum(want.values())) if want and sum(want.values()) > 0 else 1.0
+        for h, files in by_hash.items():
+            share = want[h] * scale * dt / len(files)
+            for f in files:
+                a = avail.get(f.id, 1.0)
+                cap = f.size if a >= 1 or a < 0 else a * f.size
+                f.done = min(cap, f.done + share)
+                if f.done >= f.size:
+                    f.status = 2
+                    speed.forget(f.id)
+
+        # 2. 上传：完成的释放空间，空出的槽位按完成顺序补上
+        still = []
+        for f in uploads:
+            if f.upload_end <= t:
+                f.status = 4
+                del items[f.id]
+                result['done'] += 1
+                result['done_bytes'] += f.size
+            else:
+                still.append(f)
+        uploads = still
+        for f in sorted((f for f in items.values() if f.status == 2), key=lambda f: f.id):
+            if len(uploads) >= CONFIG["MAX_UPLOAD_THREADS"]: break
+            f.status = 3
+            f.upload_end = t + work.upload_time.get(f.id, f.size / work.upload_rate)
+            uploads.append(f)
+
+        # 3. 僵尸查杀 (和线上同一个判定函数)
+        for f in [f for f in items.values() if f.status == 1]:
+            speed.sample(f.id, t, f.done)
+            reason = main.zombie_reason(f.size, t - f.started_at, f.done / f.size if f.size else 1,
+                                        avail.get(f.id, -1), speed.rates(f.id), usable)
+            if reason: kill(f, reason)
+
+        # 4. 磁盘预算 + 调度 (和线上同一个策略对象)
+        downloading = [f for f in items.values() if f.status == 1]
+        own = sum(f.done for f in downloading) + sum(f.size for f in items.values() if f.status in (2, 3))
+        used = work.other[i] + own
+        result['high_water'] = max(result['high_water'], used)
+        budget = work.total - used - margin - sum(f.size - f.done for f in downloading)
+        if budget > 0:
+            pending = sorted((f for f in items.values() if f.status == 0),
+                             key=lambda f: (-policy.score(f, avail.get(f.id, 0)), f.id))
+            candidates = []
+            for f in pending:
+                if len(candidates) >= CONFIG["SCHED_PACK_WINDOW"]: break
+                if f.size < budget: candidates.append((f, avail.get(f.id, 0)))
+            for f, _ in policy.pack(candidates, budget):
+                f.status, f.started_at = 1, t
+    return result
+
+def report(name, r, duration, total):
+    hours = duration / 3600 if duration > 0 else 1
+    return [name, r['done'], f"{r['done_bytes'] / GB:.1f}", f"{r['done'] / hours:.1f}", f"{r['done_bytes'] / GB / hours:.2f}",
+            f"{r['high_water'] / GB:.1f} ({r['high_water'] / total:.0%})" if total else f"{r['high_water'] / GB:.1f}",
+            f"{r['wasted'] / GB:.2f}", f"{r['killed']}/{r['requeued']}"]
+
+def main():
+    ap = argparse.ArgumentParser(description="用录下的调度轨迹离线比较调度 / 僵尸策略")
+    ap.add_argument('trace', help="轨迹文件 (自动带上 .1 .2 ... 滚动分段)")
+    ap.add_argument('--policy', action='append', help="要回放的调度策略 (可多次指定)，默认用录制时的策略")
+    ap.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help="覆盖 CONFIG (值按 JSON 解析)，作用于所有策略")
+    ap.add_argument('--plugin', action='append', default=[], help="额外加载的策略文件")
+    ap.add_argument('--json', help="结果另存为 JSON")
+    args = ap.parse_args()
+
+    lines = load_trace(args.trace)
+    if not lines:
+        sys.exit(f"❌ 没有读到轨迹: {args.trace}")
+
+    # import main 会在当前目录建 qflow.db，挪到临时目录里去，导入完就删掉 (回放不碰数据库)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='qflow-replay-') as workdir:
+        os.chdir(workdir)
+        try:
+            import main as qflow
+        finally:
+            os.chdir(cwd)
+    qflow.logger.setLevel('WARNING')
+    cfg = next((x['cfg'] for x in lines if 'cfg' in x), {})
+    qflow.CONFIG.update(cfg) # 先还原录制时的安全线 / 上传并发 / 策略，再叠加 --set
+    for item in args.set:
+        key, _, value = item.partition('=')
+        if key not in qflow.CONFIG: sys.exit(f"❌ 未知配置项: {key}")
+        try: qflow.CONFIG[key] = json.loads(value)
+        except ValueError: qflow.CONFIG[key] = value
+    for path in args.plugin:
+        spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+        spec.loader.exec_module(importlib.util.module_from_spec(spec))
+    policies = args.policy or [qflow.CONFIG["SCHED_POLICY"]]
+    for name in policies:
+        if name not in qflow.SCHED_POLICIES:
+            sys.exit(f"❌ 未知策略: {name} (可选: {', '.join(qflow.SCHED_POLICIES)})")
+
+    work = Workload(lines)
+    print(f"📼 轨迹: {len(lines)} 轮 | {work.duration / 3600:.1f}h | {len(work.files)} 个文件 | 磁盘 {work.total / GB:.0f}G")
+    results = {'recorded': work.recorded}
+    for name in policies:
+        results[name] = replay(qflow, work, name)
+
+    rows = [["策略", "完成", "GB", "个/小时", "GB/小时", "磁盘峰值 GB", "白下载 GB", "判死/重排"]]
+    rows += [report(name, r, work.duration, work.total) for name, r in results.items()]
+    widths = [max(len(str(row[c])) for row in rows) for c in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(str(v).rjust(w) for v, w in zip(row, widths)))
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump({'duration': work.duration, 'config': {k: qflow.CONFIG[k] for k in sorted(qflow.CONFIG) if k.startswith(('SCHED_', 'ZOMBIE_', 'DISK_SAFE'))},
+                       'results': results}, fp, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()